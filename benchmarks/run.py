@@ -0,0 +1,293 @@
+'''Benchmarks of MetaPython expansion and import
+
+Generates corpora of .mpy modules of increasing size, in several styles:
+
+``plain``
+    ordinary Python with no escapes
+``unroll``
+    large ``$for`` loops unrolled at expansion time
+``namedtuple``
+    many invocations of the namedtuple macro (examples/namedtuple.mpy)
+``properties``
+    many classes using has_properties (examples/dsl.mpy)
+``nested``
+    functions with deeply nested suites containing escapes
+
+For each corpus it measures the time to import all its modules through the
+import hook in a fresh interpreter, both cold (nothing cached) and warm
+(from the on-disk cache); the throughput of ``expand_string`` in tokens per
+second, with the macro modules already imported; and the size of the
+expanded output.  The results are printed as a table and saved as JSON.
+
+Usage::
+
+    python benchmarks/run.py [-s 10,100,1000] [-k plain,namedtuple]
+                             [-o results.json] [-c baseline.json]
+
+With ``-c``, each time is compared with the same measurement in an earlier
+results file, and the exit status is 1 if any is slower by more than the
+threshold (``-t``, 1.25 by default).
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import metapython
+from metapython import core
+from metapython import parse
+
+KINDS = ('plain', 'unroll', 'namedtuple', 'properties', 'nested')
+TIMES = ('cold_import', 'warm_import', 'expand')
+
+def plain(i, size):
+    chunks = [ "'''Plain module %d'''\nimport os\n" % i ]
+    for j in xrange(size):
+        chunks.append('''
+def f%(j)d(a, b=%(j)d):
+    c = a + b
+    if c > 0:
+        return [ x * 2 for x in range(c) ]
+    return os.path.join(str(a), str(b))
+
+class C%(j)d(object):
+    def m(self, x):
+        return f%(j)d(x, x)
+''' % dict(j=j))
+    return ''.join(chunks)
+
+def unroll(i, size):
+    return '''\'\'\'Unrolling module %d\'\'\'
+values = []
+$for i in range(%d):
+    values.append($i * 2)
+    if len(values) > $i:
+        values.pop()
+''' % (i, size)
+
+def namedtuple(i, size):
+    chunks = [ "'''namedtuple module %d'''\n$import bench_namedtuple\n" % i ]
+    for j in xrange(size):
+        chunks.append('$(bench_namedtuple.namedtuple(?P%d, ?x, ?y, ?z))\n'
+                      % j)
+    return ''.join(chunks)
+
+def properties(i, size):
+    chunks = [ "'''has_properties module %d'''\n"
+               "$from bench_dsl import has_properties\n" % i ]
+    for j in xrange(size):
+        chunks.append('''
+class K%d(object):
+    $has_properties(?a, ?b, ?c, ?d)
+''' % j)
+    return ''.join(chunks)
+
+# Nesting deeper than this hits the compiler's limits
+DEPTH = 15
+
+def nested(i, size):
+    chunks = [ "'''Nested module %d'''\n" % i ]
+    for j in xrange(size):
+        lines = [ 'def g%d(x):' % j ]
+        for depth in xrange(1, DEPTH + 1):
+            lines.append('    ' * depth + 'if x > %d:' % depth)
+        lines.append('    ' * (DEPTH + 1) + 'return $(%d * %d)' % (j, DEPTH))
+        lines.append('    return None\n')
+        chunks.append('\n'.join(lines) + '\n')
+    return ''.join(chunks)
+
+GENERATORS = dict(plain=plain, unroll=unroll, namedtuple=namedtuple,
+                  properties=properties, nested=nested)
+
+def make_corpus(kind, size, modules):
+    '''Write a corpus of modules .mpy files of the given kind and size (and
+    the macro modules they use) to a new directory, returning the directory
+    and the module names'''
+    dirname = tempfile.mkdtemp(prefix='mpybench-')
+    shutil.copy(os.path.join(ROOT, 'examples', 'namedtuple.mpy'),
+                os.path.join(dirname, 'bench_namedtuple.mpy'))
+    shutil.copy(os.path.join(ROOT, 'examples', 'dsl.mpy'),
+                os.path.join(dirname, 'bench_dsl.mpy'))
+    names = []
+    for i in xrange(modules):
+        name = '%s_%d' % (kind, i)
+        fp = open(os.path.join(dirname, name + '.mpy'), 'w')
+        fp.write(GENERATORS[kind](i, size))
+        fp.close()
+        names.append(name)
+    return dirname, names
+
+_IMPORT_SCRIPT = '''
+import sys, time
+start = time.time()
+import metapython
+metapython.install_import_hook()
+for name in sys.argv[1:]:
+    __import__(name)
+print time.time() - start
+'''
+
+def time_import(dirname, names):
+    '''Return the seconds taken to import the modules names from dirname in
+    a fresh interpreter (as measured by the interpreter itself)'''
+    env = dict(os.environ, PYTHONPATH=ROOT, METAPYTHON_STORE='',
+               METAPYTHON_SERVER='')
+    for var in ('PYTHONDONTWRITEBYTECODE', 'METAPYTHON_TRACE',
+                'METAPYTHON_PROFILE'):
+        env.pop(var, None)
+    child = subprocess.Popen(
+        [ sys.executable, '-c', _IMPORT_SCRIPT ] + names, cwd=dirname,
+        env=env, stdout=subprocess.PIPE)
+    output = child.communicate()[0]
+    if child.returncode:
+        raise RuntimeError('importing the corpus in %s failed' % dirname)
+    return float(output)
+
+def clear_cache(dirname):
+    shutil.rmtree(os.path.join(dirname, '__mpycache__'), ignore_errors=True)
+
+def count_tokens(text):
+    return sum(1 for pair in parse.parse_string(text).pairs())
+
+def measure(kind, size, modules, repeat):
+    '''Run the benchmarks of one corpus, returning the results as a dict'''
+    dirname, names = make_corpus(kind, size, modules)
+    try:
+        cold = warm = None
+        for i in xrange(repeat):
+            clear_cache(dirname)
+            t = time_import(dirname, names)
+            cold = min(cold or t, t)
+            t = time_import(dirname, names)
+            warm = min(warm or t, t)
+        sources = []
+        for name in names:
+            fp = open(os.path.join(dirname, name + '.mpy'))
+            sources.append(fp.read())
+            fp.close()
+        sys.path.insert(0, dirname)
+        core.install_import_hook()
+        core.MetaImporter.invalidate_caches()
+        try:
+            expand = None
+            for i in xrange(repeat):
+                start = time.time()
+                outputs = [ core.expand_string(source)[2]
+                            for source in sources ]
+                t = time.time() - start
+                expand = min(expand or t, t)
+        finally:
+            sys.path.remove(dirname)
+            for name in ('bench_namedtuple', 'bench_dsl'):
+                sys.modules.pop(name, None)
+    finally:
+        shutil.rmtree(dirname)
+    tokens_in = sum(count_tokens(source) for source in sources)
+    tokens_out = sum(count_tokens(output) for output in outputs)
+    return dict(kind=kind, size=size, modules=modules,
+                source_bytes=sum(len(source) for source in sources),
+                expanded_bytes=sum(len(output) for output in outputs),
+                tokens_in=tokens_in, tokens_out=tokens_out,
+                cold_import=cold, warm_import=warm, expand=expand,
+                tokens_per_second=tokens_in / expand)
+
+def run(kinds, sizes, modules, repeat, log=None):
+    '''Run the benchmarks, returning the results document'''
+    results = []
+    for kind in kinds:
+        for size in sizes:
+            result = measure(kind, size, modules, repeat)
+            if log is not None:
+                log.write(format_result(result) + '\n')
+                log.flush()
+            results.append(result)
+    return dict(metapython=metapython.__version__,
+                python=sys.version.split()[0],
+                platform=platform.platform(),
+                time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                modules=modules, repeat=repeat, results=results)
+
+HEADER = '%-11s %6s %9s %9s %9s %10s %9s %9s' % (
+    'kind', 'size', 'cold ms', 'warm ms', 'expand ms', 'tok/s', 'tok in',
+    'tok out')
+
+def format_result(result):
+    return '%-11s %6d %9.1f %9.1f %9.1f %10.0f %9d %9d' % (
+        result['kind'], result['size'], result['cold_import'] * 1000,
+        result['warm_import'] * 1000, result['expand'] * 1000,
+        result['tokens_per_second'], result['tokens_in'],
+        result['tokens_out'])
+
+def compare(document, baseline, threshold, log):
+    '''Report how the times in document compare with those in baseline,
+    returning the number which are slower by more than threshold'''
+    old = dict(((r['kind'], r['size']), r) for r in baseline['results'])
+    regressions = 0
+    log.write('\nCompared with metapython %s (%s):\n' % (
+            baseline.get('metapython'), baseline.get('time')))
+    for result in document['results']:
+        before = old.get((result['kind'], result['size']))
+        if before is None:
+            continue
+        cells = []
+        for key in TIMES:
+            ratio = result[key] / before[key]
+            flag = ''
+            if ratio > threshold:
+                regressions += 1
+                flag = '!'
+            cells.append('%s %.2fx%s' % (key, ratio, flag))
+        log.write('%-11s %6d  %s\n' % (result['kind'], result['size'],
+                                       '  '.join(cells)))
+    return regressions
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-k', '--kinds', default=','.join(KINDS),
+                      help='comma-separated corpus kinds (default: all)')
+    parser.add_option('-s', '--sizes', default='10,100,500',
+                      help='comma-separated corpus sizes, in units per '
+                      'module (default: %default)')
+    parser.add_option('-m', '--modules', type='int', default=10,
+                      help='modules per corpus (default: %default)')
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help='keep the best of this many runs '
+                      '(default: %default)')
+    parser.add_option('-o', '--output', default='benchmark.json',
+                      metavar='FILE', help='write the results to FILE '
+                      '(default: %default)')
+    parser.add_option('-c', '--compare', metavar='FILE',
+                      help='compare the results with those in FILE')
+    parser.add_option('-t', '--threshold', type='float', default=1.25,
+                      help='ratio of times counted as a regression '
+                      '(default: %default)')
+    options, args = parser.parse_args(argv)
+    kinds = options.kinds.split(',')
+    for kind in kinds:
+        if kind not in GENERATORS:
+            parser.error('unknown corpus kind %r' % kind)
+    sizes = [ int(size) for size in options.sizes.split(',') ]
+    sys.stdout.write(HEADER + '\n')
+    document = run(kinds, sizes, options.modules, options.repeat, sys.stdout)
+    fp = open(options.output, 'w')
+    json.dump(document, fp, indent=1, sort_keys=True)
+    fp.write('\n')
+    fp.close()
+    if options.compare:
+        fp = open(options.compare)
+        baseline = json.load(fp)
+        fp.close()
+        if compare(document, baseline, options.threshold, sys.stdout):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
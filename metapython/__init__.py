@@ -1 +1,3 @@
+__version__ = '0.2.1'
+
 from core import install_import_hook, expand_file, expand_string
@@ -0,0 +1,259 @@
+'''Ahead-of-time expansion of MetaPython source trees
+
+``metapython build PATH...`` expands every .mpy file under the given
+directories to an ordinary .py file (and optionally a .pyc), either next to
+the source or mirrored into a build directory, so that deployed code can be
+imported without running the expander at all.  Files are expanded in parallel
+by a pool of worker processes.
+
+Each generated file starts with a header naming its source and the .mpy files
+its macros came from.  A file is rebuilt only when it is older than its
+source or any of those dependencies.
+
+``metapython build --bundle FILE PATH...`` instead expands them all into a
+single bundle file (see :mod:`metapython.bundle`).
+'''
+from __future__ import with_statement
+import os
+import sys
+import time
+import py_compile
+import traceback
+from optparse import OptionParser
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+from metapython import core
+from metapython import cache
+from metapython import bundle
+
+HEADER = '# Generated by metapython from %s; do not edit.\n'
+DEPENDS = '# metapython-depends:'
+
+def module_name(fn):
+    '''Return the dotted module name of a .mpy file, and the directory its
+    top-level package lives in (which must be on sys.path to import it)'''
+    dirname, basename = os.path.split(os.path.abspath(fn))
+    parts = [ os.path.splitext(basename)[0] ]
+    while (os.path.exists(os.path.join(dirname, '__init__.py'))
+           or os.path.exists(os.path.join(dirname, '__init__.mpy'))):
+        dirname, package = os.path.split(dirname)
+        parts.insert(0, package)
+    return '.'.join(parts), dirname
+
+def find_sources(paths, build_dir=None):
+    '''Yield (source, output) filename pairs for the .mpy files under paths
+    (which may also name .mpy files directly)'''
+    for path in paths:
+        if os.path.isfile(path):
+            root, names = os.path.dirname(path), [ path ]
+        else:
+            root, names = path, []
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames[:] = sorted(d for d in dirnames
+                                     if d != cache.CACHE_DIR)
+                names.extend(os.path.join(dirpath, fn)
+                             for fn in sorted(filenames)
+                             if fn.endswith('.mpy'))
+        for fn in names:
+            out_fn = os.path.splitext(fn)[0] + '.py'
+            if build_dir is not None:
+                out_fn = os.path.join(build_dir, os.path.relpath(out_fn, root))
+            yield fn, out_fn
+
+def read_dependencies(out_fn):
+    '''Return the dependencies recorded in the header of a generated file,
+    or None if it has no metapython header'''
+    try:
+        fp = open(out_fn)
+    except IOError:
+        return None
+    try:
+        if not fp.readline().startswith(HEADER[:HEADER.index('%')]):
+            return None
+        line = fp.readline()
+    finally:
+        fp.close()
+    if not line.startswith(DEPENDS):
+        return None
+    dirname = os.path.dirname(os.path.abspath(out_fn))
+    return [ os.path.join(dirname, dep)
+             for dep in line[len(DEPENDS):].split() ]
+
+def is_current(fn, out_fn, compile_pyc=False):
+    '''Is the output generated from fn newer than fn and its dependencies?'''
+    deps = read_dependencies(out_fn)
+    if deps is None:
+        return False
+    try:
+        built = os.stat(out_fn).st_mtime
+        if compile_pyc and os.stat(out_fn + 'c').st_mtime < built:
+            return False
+        for dep in [ fn ] + deps:
+            if os.stat(dep).st_mtime > built:
+                return False
+    except OSError:
+        return False
+    return True
+
+def _expand(fn):
+    '''Expand the .mpy file fn as its module would be when imported,
+    returning (name, ImportContext, doc, text).  Errors are raised rather
+    than stopping in the debugger, as builds run unattended.'''
+    name, root = module_name(fn)
+    if root not in sys.path:
+        sys.path.insert(0, root)
+    core.install_import_hook()
+    core.load_expander()
+    with core.parse.no_debugger():
+        if '.' in name:
+            # Import the package first, as importing the module would
+            __import__(name.rsplit('.', 1)[0])
+        imp, doc, text = core.expand_file(fn, name)
+    return name, imp, doc, text
+
+def build_file(fn, out_fn, compile_pyc=False):
+    '''Expand the .mpy file fn to the .py file out_fn (and out_fn + "c" if
+    compile_pyc is true)'''
+    name, imp, doc, text = _expand(fn)
+    dirname = os.path.dirname(os.path.abspath(out_fn))
+    deps = ' '.join(os.path.relpath(dep, dirname).replace(os.sep, '/')
+                    for dep in imp.dependencies)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    tmp_fn = '%s.%d.tmp' % (out_fn, os.getpid())
+    with open(tmp_fn, 'w') as fp:
+        fp.write(HEADER % os.path.basename(fn))
+        fp.write('%s %s\n' % (DEPENDS, deps))
+        fp.write(text)
+    if os.name == 'nt' and os.path.exists(out_fn):
+        os.remove(out_fn)
+    os.rename(tmp_fn, out_fn)
+    if compile_pyc:
+        py_compile.compile(out_fn, doraise=True)
+
+def _build_job(job):
+    '''Run build_file in a worker, returning (fn, out_fn, seconds, error)
+    where error is the formatted traceback of a failure (or None)'''
+    fn, out_fn, compile_pyc = job
+    start = time.time()
+    try:
+        build_file(fn, out_fn, compile_pyc)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return fn, out_fn, time.time() - start, error
+
+def build(paths, build_dir=None, compile_pyc=False, jobs=None, force=False,
+          log=None):
+    '''Expand the .mpy files under paths, reporting progress to log, and
+    return the number of files which failed to expand.  Up-to-date files are
+    skipped unless force is true.  jobs is the number of worker processes
+    (defaulting to the number of CPUs); with one job, or where
+    multiprocessing is unavailable, files are expanded in-process.'''
+    if log is None:
+        log = sys.stdout
+    start = time.time()
+    work, skipped = [], 0
+    for fn, out_fn in find_sources(paths, build_dir):
+        if not force and is_current(fn, out_fn, compile_pyc):
+            skipped += 1
+        else:
+            work.append((fn, out_fn, compile_pyc))
+    if multiprocessing is None:
+        jobs = 1
+    elif jobs is None:
+        jobs = multiprocessing.cpu_count()
+    jobs = min(jobs, len(work))
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap_unordered(_build_job, work)
+    else:
+        results = (_build_job(job) for job in work)
+    failed = 0
+    try:
+        for fn, out_fn, seconds, error in results:
+            if error is None:
+                log.write('%8.1f ms  %s -> %s\n' % (seconds * 1000, fn, out_fn))
+            else:
+                failed += 1
+                log.write('  FAILED     %s\n%s' % (fn, error))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    log.write('%d built, %d up to date, %d failed in %.2f s\n' % (
+            len(work) - failed, skipped, failed, time.time() - start))
+    return failed
+
+def build_bundle(paths, out_fn, log=None):
+    '''Expand the .mpy files under paths into the bundle out_fn (see
+    :mod:`metapython.bundle`), reporting progress to log, and return the
+    number of files which failed to expand (in which case no bundle is
+    written).  Files are expanded in-process, so that macro modules are
+    only imported once.'''
+    if log is None:
+        log = sys.stdout
+    start = time.time()
+    modules, failed = [], 0
+    for fn, py_fn in find_sources(paths):
+        t0 = time.time()
+        try:
+            name, imp, doc, text = _expand(fn)
+        except Exception:
+            failed += 1
+            log.write('  FAILED     %s\n%s' % (fn, traceback.format_exc()))
+            continue
+        modules.append((name, os.path.abspath(fn), doc, text, imp.code,
+                        imp.dependencies, imp.lines))
+        log.write('%8.1f ms  %s -> %s\n' % ((time.time() - t0) * 1000, fn,
+                                            name))
+    if not failed:
+        bundle.write(out_fn, modules)
+    log.write('%d bundled into %s, %d failed in %.2f s\n' % (
+            len(modules), out_fn, failed, time.time() - start))
+    return failed
+
+def main(argv=None):
+    '''Entry point of the metapython console script'''
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ['serve']:
+        from metapython import server
+        return server.main(argv[1:])
+    parser = OptionParser(
+        prog='metapython',
+        usage='%prog build [options] PATH...\n       %prog serve [options]',
+        description='Expand the .mpy files under each PATH to .py files.')
+    parser.add_option('-d', '--build-dir', dest='build_dir',
+                      help='write the .py files under DIR, mirroring each '
+                      'PATH, rather than next to the .mpy files',
+                      metavar='DIR')
+    parser.add_option('-c', '--compile', dest='compile_pyc',
+                      action='store_true', default=False,
+                      help='also write .pyc files')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int',
+                      help='number of worker processes (default: one per CPU)')
+    parser.add_option('-b', '--bundle', dest='bundle', metavar='FILE',
+                      help='write a bundle of all the modules to FILE '
+                      'instead of .py files')
+    parser.add_option('-f', '--force', dest='force', action='store_true',
+                      default=False, help='rebuild up-to-date files too')
+    options, args = parser.parse_args(argv)
+    if not args or args[0] != 'build':
+        parser.error('expected the build or serve command')
+    if len(args) < 2:
+        parser.error('no paths given')
+    if options.bundle:
+        failed = build_bundle(args[1:], options.bundle)
+    else:
+        failed = build(args[1:], options.build_dir, options.compile_pyc,
+                       options.jobs, options.force)
+    return failed and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main())
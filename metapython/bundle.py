@@ -0,0 +1,130 @@
+'''Bundles of expanded MetaPython modules
+
+A bundle is a single file holding the expanded, compiled code of every .mpy
+module of an application (``metapython build --bundle FILE PATH...``).
+:func:`install` maps it into memory and puts a :class:`Bundle` importer at
+the front of sys.meta_path, which imports the modules it holds straight from
+the mapping: there is no per-module stat or open, nor any search along
+sys.path.  Processes forked after the bundle is installed share its pages.
+
+Like the output of ``metapython build``, a bundle is a deployment artifact:
+it is not checked against the .mpy sources, and must be rebuilt when they
+change.
+
+The file starts with a magic number and the offset of the index, followed by
+the marshalled (doc, text, code) tuple of each module.  The index, a
+marshalled dict, maps each module name to the offset and length of its
+entry, its source filename and its dependencies.
+'''
+from __future__ import with_statement
+import os
+import sys
+import imp
+import mmap
+import struct
+import marshal
+
+from metapython import core
+
+# As for the cache, the interpreter's bytecode magic guards the marshalled
+# code objects
+MAGIC = imp.get_magic() + 'MPB\x02'
+_OFFSET = struct.Struct('!Q')
+
+def write(out_fn, modules):
+    '''Write a bundle of the (name, filename, doc, text, code, dependencies,
+    lines) tuples modules to out_fn, replacing it atomically (so that processes
+    which have the old bundle mapped are unaffected)'''
+    tmp_fn = '%s.%d.tmp' % (out_fn, os.getpid())
+    index = {}
+    try:
+        with open(tmp_fn, 'wb') as fp:
+            fp.write(MAGIC)
+            fp.write(_OFFSET.pack(0))
+            for name, fn, doc, text, code, deps, lines in modules:
+                data = marshal.dumps((doc, text, code, lines))
+                index[name] = (fp.tell(), len(data), fn, tuple(deps))
+                fp.write(data)
+            index_offset = fp.tell()
+            marshal.dump(index, fp)
+            fp.seek(len(MAGIC))
+            fp.write(_OFFSET.pack(index_offset))
+        if os.name == 'nt' and os.path.exists(out_fn):
+            os.remove(out_fn)
+        os.rename(tmp_fn, out_fn)
+    except:
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+        raise
+
+def install(fn):
+    '''Open the bundle fn and put it at the front of sys.meta_path,
+    returning the Bundle'''
+    bundle = Bundle(fn)
+    sys.meta_path.insert(0, bundle)
+    return bundle
+
+class Bundle(object):
+    '''Importer (and loader) of the modules in a memory-mapped bundle'''
+
+    def __init__(self, fn):
+        self.filename = fn
+        fp = open(fn, 'rb')
+        try:
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fp.close()
+        header = len(MAGIC) + _OFFSET.size
+        if len(self._map) < header or self._map[:len(MAGIC)] != MAGIC:
+            self._map.close()
+            raise ImportError('%s is not a metapython bundle for this '
+                              'interpreter' % fn)
+        index_offset, = _OFFSET.unpack(self._map[len(MAGIC):header])
+        self.index = marshal.loads(self._map[index_offset:])
+
+    def close(self):
+        '''Remove the bundle from sys.meta_path and unmap it'''
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+        self._map.close()
+
+    def names(self):
+        '''Return the names of the modules in the bundle'''
+        return sorted(self.index)
+
+    def load(self, name):
+        '''Return the (doc, text, code, lines) tuple of the module name'''
+        offset, length = self.index[name][:2]
+        return marshal.loads(self._map[offset:offset + length])
+
+    def find_module(self, fullname, path=None):
+        if fullname in self.index:
+            return self
+        return None
+
+    def load_module(self, name):
+        module = sys.modules.get(name)
+        if module is not None:
+            return module
+        fn, deps = self.index[name][2:]
+        doc, text, code, lines = self.load(name)
+        module = imp.new_module(name)
+        module.__file__ = fn
+        module.__loader__ = self
+        module.__mpy_depends__ = deps
+        module.__mpy_lines__ = lines
+        core._add_builder(module, code)
+        # As with other loaders, the module is in sys.modules while its code
+        # runs, so that circular imports find it
+        sys.modules[name] = module
+        try:
+            exec code in module.__dict__
+        except:
+            del sys.modules[name]
+            raise
+        module.__doc__ = doc
+        module.__expanded__ = text
+        if '.' in name:
+            parent_name, child_name = name.rsplit('.', 1)
+            setattr(sys.modules[parent_name], child_name, module)
+        return module
@@ -0,0 +1,135 @@
+'''On-disk cache of expanded MetaPython modules
+
+Much like CPython's .pyc files, the result of expanding a .mpy file is saved
+in an ``__mpycache__`` directory next to the source.  The cache file holds the
+expanded module text, its docstring, its line table (see
+:mod:`metapython.lines`) and the marshalled code object compiled from it, and
+is validated against the source file's mtime and size.  A cache
+hit lets the import hook skip parsing, quoting and macro expansion entirely.
+
+An expansion also depends on the .mpy modules whose macros it used (see
+:attr:`metapython.core.ImportContext.dependencies`).  Their stamps are
+stored with the expansion too, so changing a macro module invalidates the
+cached expansions of the modules using it.  :func:`stale` and
+:func:`dependents` answer which expansions need redoing.
+'''
+from __future__ import with_statement
+import os
+import sys
+import imp
+import marshal
+
+CACHE_DIR = '__mpycache__'
+CACHE_EXT = '.mpyc'
+
+# The interpreter's bytecode magic guards the marshalled code object; the
+# trailing bytes version the metapython cache layout itself.
+MAGIC = imp.get_magic() + 'MPY\x03'
+
+def cache_path(fn):
+    '''Return the path of the cache file for the .mpy file fn'''
+    dirname, basename = os.path.split(os.path.abspath(fn))
+    name = os.path.splitext(basename)[0]
+    return os.path.join(dirname, CACHE_DIR, name + CACHE_EXT)
+
+def source_stamp(fn):
+    '''Return the (mtime, size) pair used to validate a cache entry'''
+    st = os.stat(fn)
+    return st.st_mtime, st.st_size
+
+def _open_entry(fn):
+    '''Open the cache file of fn, returning it positioned after the header
+    together with the recorded dependencies, or None if there is no valid
+    entry (or the source or any dependency has changed since)'''
+    try:
+        stamp = source_stamp(fn)
+        fp = open(cache_path(fn), 'rb')
+    except (IOError, OSError):
+        return None
+    try:
+        if fp.read(len(MAGIC)) == MAGIC and marshal.load(fp) == stamp:
+            dep_stamps = marshal.load(fp)
+            for dep, dep_stamp in dep_stamps:
+                if source_stamp(dep) != dep_stamp:
+                    break
+            else:
+                return fp, tuple(dep for dep, dep_stamp in dep_stamps)
+    except (EOFError, ValueError, TypeError, OSError):
+        pass
+    fp.close()
+    return None
+
+def load(fn):
+    '''Load the cached expansion of fn, returning a (doc, text, code,
+    dependencies, lines) tuple, or None if there is no valid cache entry.'''
+    entry = _open_entry(fn)
+    if entry is None:
+        return None
+    fp, deps = entry
+    try:
+        doc, text, code, lines = marshal.load(fp)
+    except (EOFError, ValueError, TypeError):
+        return None
+    finally:
+        fp.close()
+    return doc, text, code, deps, lines
+
+def dependencies(fn):
+    '''Return the dependencies recorded with the valid cached expansion of fn,
+    or None if there is none'''
+    entry = _open_entry(fn)
+    if entry is None:
+        return None
+    entry[0].close()
+    return entry[1]
+
+def stale(fns):
+    '''Return those of the .mpy files fns whose cached expansions are missing
+    or out of date, because the file or one of its dependencies changed'''
+    return [ fn for fn in fns if dependencies(fn) is None ]
+
+def dependents(dep, fns):
+    '''Return those of the .mpy files fns whose cached expansions depend on
+    the .mpy file dep'''
+    dep = os.path.abspath(dep)
+    result = []
+    for fn in fns:
+        entry = _open_entry(fn)
+        if entry is None:
+            continue
+        entry[0].close()
+        if dep in entry[1]:
+            result.append(fn)
+    return result
+
+def store(fn, doc, text, code, deps=(), lines=(), stamp=None):
+    '''Save the expansion of fn (with its line table lines), and the stamps
+    of the .mpy files deps it depends on, to its cache file.  stamp is the
+    source_stamp of fn taken before it was read, so that an edit made while
+    it was expanded leaves the entry stale (as with .pyc files); it defaults
+    to the current stamp.  Failures (e.g. read-only directories) are
+    silently ignored, as with .pyc files.'''
+    if getattr(sys, 'dont_write_bytecode', False):
+        return
+    path = cache_path(fn)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        if stamp is None:
+            stamp = source_stamp(fn)
+        dep_stamps = tuple((dep, source_stamp(dep)) for dep in deps)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.mkdir(dirname)
+        with open(tmp_path, 'wb') as fp:
+            fp.write(MAGIC)
+            marshal.dump(stamp, fp)
+            marshal.dump(dep_stamps, fp)
+            marshal.dump((doc, text, code, lines), fp)
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
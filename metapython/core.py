@@ -1,31 +1,100 @@
 '''Metapython syntax extensions
+
+Importing this module (and installing the import hook) is cheap: the parser
+and everything else needed to expand a module (see :func:`load_expander`)
+is only imported once a module actually has to be expanded, so a program
+whose .mpy modules all come from the cache never loads it.
 '''
 from __future__ import with_statement
 import os
 import new
+import imp
 import sys
-import token
-from cStringIO import StringIO
+import types
+import thread
+import threading
+
+from metapython import cache
+from metapython import trace
+
+# metapython.parse, once load_expander has imported it
+parse = None
 
-from metapython import parse
+def load_expander():
+    '''Import the parser used to expand modules, if that has not been done'''
+    global parse
+    if parse is None:
+        from metapython import parse
 
-def install_import_hook():
-    '''Installs the MetaImporter import hook along sys.meta_path'''
+def install_import_hook(lazy=None):
+    '''Installs the MetaImporter import hook along sys.meta_path.  If lazy is
+    given, it turns lazy imports (see lazy_imports) on or off.'''
+    if lazy is not None:
+        global lazy_imports
+        lazy_imports = lazy
     if MetaImporter not in sys.meta_path:
         sys.meta_path.append(MetaImporter)
 
 class MetaImporter(object):
-    '''This is the class responsible for finding .mpy files to import'''
+    '''This is the class responsible for finding .mpy files to import.
 
-    @staticmethod
-    def find_module(fullname, path=None):
+    Rather than stat'ing a candidate file in every directory along the path,
+    the importer caches the set of .mpy files in each directory, along with
+    a negative cache of lookups that found nothing.  Both are refreshed when
+    the mtime of a directory changes, so that after the first attempt an
+    import only stats the directories along the path.  Call
+    :meth:`invalidate_caches` after creating .mpy files at runtime on
+    filesystems whose mtimes are too coarse to notice.'''
+
+    # directory -> (mtime, set of module names with a .mpy file)
+    _listings = {}
+    # (name, search path) -> mtimes of the search path's directories when
+    # the name was last found not to be a .mpy module there
+    _misses = {}
+
+    @classmethod
+    def find_module(cls, fullname, path=None):
         '''This method locates an .mpy file along either
         sys.path or the given path'''
         lastname = fullname.rsplit('.', 1)[-1]
-        for d in (path or sys.path):
-            mpy = os.path.join(d, lastname + '.mpy')
-            if os.path.exists(mpy):
-                return MetaLoader(mpy)
+        search_path = tuple(path or sys.path)
+        key = (lastname, search_path)
+        mtimes = tuple([ _mtime(d) for d in search_path ])
+        if cls._misses.get(key) == mtimes:
+            return None
+        for d, mtime in zip(search_path, mtimes):
+            if lastname in cls._listing(d, mtime):
+                return MetaLoader(os.path.join(d, lastname + '.mpy'))
+        cls._misses[key] = mtimes
+
+    @classmethod
+    def invalidate_caches(cls):
+        '''Forget all cached directory listings and failed lookups'''
+        cls._listings.clear()
+        cls._misses.clear()
+
+    @classmethod
+    def _listing(cls, d, mtime):
+        '''Return the names of the .mpy modules in directory d, whose mtime
+        is mtime (None if it cannot be stat'ed)'''
+        if mtime is None:
+            return ()
+        entry = cls._listings.get(d)
+        if entry is None or entry[0] != mtime:
+            try:
+                names = set(fn[:-4] for fn in os.listdir(d or os.curdir)
+                            if fn.endswith('.mpy'))
+            except OSError:
+                names = set()
+            entry = cls._listings[d] = (mtime, names)
+        return entry[1]
+
+def _mtime(d):
+    '''Return the mtime of the directory d on sys.path, or None'''
+    try:
+        return os.stat(d or os.curdir).st_mtime
+    except (OSError, TypeError):
+        return None
 
 class MetaLoader(object):
     '''This is the class responsible for actually loading the .mpy files'''
@@ -34,53 +103,322 @@ class MetaLoader(object):
         self.path = path
 
     def load_module(self, name):
-        '''Load a .mpy file from the loader's given path'''
-        mod = sys.modules.get(name)
-        if mod is None:
+        '''Load a .mpy file from the loader's given path.
+
+        The hold on the interpreter's global import lock taken for this
+        import is released while the module is expanded (the module's own
+        lock keeps other threads from importing it meanwhile), so that
+        independent modules can expand in parallel.  Holds taken by
+        enclosing imports are kept: a plain module importing a .mpy module
+        must not become visible to other threads before it is initialized,
+        so that expansion runs under the lock, as any import would.  A
+        loader called directly, outside an import statement, holds no lock
+        and leaves it alone.'''
+        held = imp.lock_held()
+        if held:
+            try:
+                imp.release_lock()
+            except RuntimeError:
+                # Held by another thread, not for this import
+                held = False
+        try:
             mod = import_file(self.path, name)
-            if '.' in name:
-                parent_name, child_name = name.rsplit('.', 1)
-                setattr(sys.modules[parent_name], child_name, mod)
+        finally:
+            if held:
+                imp.acquire_lock()
+        if '.' in name:
+            parent_name, child_name = name.rsplit('.', 1)
+            setattr(sys.modules[parent_name], child_name, mod)
         return mod
 
+class _DeadlockError(RuntimeError):
+    pass
+
+class _ModuleLock(object):
+    '''A re-entrant lock held while a module is imported.  Acquiring a lock
+    held by a thread which is (directly or transitively) waiting for a lock
+    held by the caller raises _DeadlockError rather than blocking forever.'''
+
+    # Guards the state of all module locks
+    _cond = threading.Condition(threading.Lock())
+    # thread id -> the _ModuleLock the thread is waiting for
+    _waiting = {}
+
+    def __init__(self, name):
+        self.name = name
+        self.owner = None
+        self.count = 0
+
+    def acquire(self):
+        tid = thread.get_ident()
+        with self._cond:
+            while self.owner not in (None, tid):
+                if self._deadlocked(tid):
+                    raise _DeadlockError(
+                        'deadlock detected importing %s' % self.name)
+                self._waiting[tid] = self
+                try:
+                    self._cond.wait()
+                finally:
+                    del self._waiting[tid]
+            self.owner = tid
+            self.count += 1
+
+    def release(self):
+        with self._cond:
+            self.count -= 1
+            if not self.count:
+                self.owner = None
+                self._cond.notifyAll()
+
+    def _deadlocked(self, tid):
+        owner, seen = self.owner, set()
+        while owner is not None and owner not in seen:
+            if owner == tid:
+                return True
+            seen.add(owner)
+            lock = self._waiting.get(owner)
+            if lock is None:
+                return False
+            owner = lock.owner
+        return False
+
+# If true, importing a .mpy module (other than from a meta-program) only
+# creates a LazyModule, which is loaded on first use
+lazy_imports = False
+
+class LazyModule(types.ModuleType):
+    '''A MetaPython module imported lazily: it is only expanded (or loaded
+    from the cache) when an attribute it does not have yet is first looked
+    up, so that modules a program never uses cost nothing at startup.
+    Errors expanding or running the module are raised from that lookup.  If
+    loading fails, the next lookup tries again.'''
+
+    def __init__(self, name, fn):
+        types.ModuleType.__init__(self, name)
+        self.__file__ = fn
+        self.__mpy_lazy__ = fn
+
+    def __getattr__(self, attr):
+        if attr == '__path__':
+            # Probed by "from module import ..." under the interpreter's
+            # import lock; .mpy modules are never packages anyway
+            raise AttributeError(attr)
+        load_lazy(self)
+        return types.ModuleType.__getattribute__(self, attr)
+
+def is_loaded(module):
+    '''Is module not a LazyModule still waiting to be loaded?'''
+    return '__mpy_lazy__' not in module.__dict__
+
+def load_lazy(module):
+    '''Load module now if it is a LazyModule which has not been loaded'''
+    fn = module.__dict__.get('__mpy_lazy__')
+    if fn is None:
+        return
+    lock = _module_lock(module.__name__)
+    lock.acquire()
+    try:
+        # Another thread may have loaded it meanwhile; lookups from the
+        # module's own code while it loads see it as partially initialized
+        if '__mpy_lazy__' in module.__dict__:
+            del module.__mpy_lazy__
+            try:
+                _load(module, fn)
+            except:
+                module.__mpy_lazy__ = fn
+                raise
+    finally:
+        lock.release()
+
+# If true, the ImportContext which expanded each module is kept in _contexts
+# (by module name), so that the module can be re-expanded incrementally
+# (see metapython.watch)
+retain_contexts = False
+_contexts = {}
+
+# The ImportContexts running meta-programs in each thread (innermost last)
+_meta_phase = threading.local()
+
+def _record_import(module):
+    '''Note that module was imported by the meta-program being run (if any)'''
+    contexts = getattr(_meta_phase, 'contexts', None)
+    if contexts:
+        contexts[-1].imported.append(module)
+
+# module name -> _ModuleLock, for modules being imported
+_module_locks = {}
+# module name -> module object, for modules being imported
+_loading = {}
+
+def _module_lock(name):
+    with _ModuleLock._cond:
+        lock = _module_locks.get(name)
+        if lock is None:
+            lock = _module_locks[name] = _ModuleLock(name)
+        return lock
+
 def import_file(fn, name=None):
-    '''Import a .mpy file, creating a new module object'''
+    '''Import a .mpy file, creating a new module object (or returning the
+    module already in sys.modules).  The expansion is cached in an
+    __mpycache__ directory next to the file (see :mod:`metapython.cache`).
+
+    Importing is safe from several threads: a module is only expanded once,
+    and is only put in sys.modules once it is fully initialized.  (Until
+    then, recursive imports of the module from the importing thread get the
+    partially initialized module.)  With lazy_imports set, a LazyModule is
+    returned instead, except to meta-programs (whose macros are needed at
+    once).'''
     if name is None:
         name = os.path.splitext(os.path.basename(fn))[0]
-    result = new.module(name)
-    sys.modules[name] = result
+    lock = _module_lock(name)
     try:
-        imp, module_doc, module_text = expand_file(fn)
-        result.__doc__ = module_doc
-        result.__dict__.update(imp.namespace)
-        result.__expanded__ = module_text
+        lock.acquire()
+    except _DeadlockError:
+        # Another thread is importing the module and waiting (transitively)
+        # on us: treat it as a circular import
+        return _loading[name]
+    try:
+        result = sys.modules.get(name)
+        if result is None:
+            result = _loading.get(name)
+        if result is not None:
+            _record_import(result)
+        else:
+            if lazy_imports and not getattr(_meta_phase, 'contexts', None):
+                result = LazyModule(name, fn)
+            else:
+                result = new.module(name)
+                _loading[name] = result
+                try:
+                    _load(result, fn)
+                finally:
+                    del _loading[name]
+            sys.modules[name] = result
         return result
-    except:
-        del sys.modules[name]
-        raise
+    finally:
+        lock.release()
+
+def _load(result, fn):
+    result.__file__ = fn
+    _record_import(result)
+    tracer = trace.begin(result.__name__, fn)
+    # Stamp the source before reading it, so that an edit made meanwhile
+    # is not cached as if it had been expanded
+    try:
+        stamp = cache.source_stamp(fn)
+    except OSError:
+        stamp = None
+    cached = cache.load(fn)
+    if cached is None:
+        from metapython import store
+        from metapython import server
+        # The same source may have been expanded before, here or elsewhere
+        cached = store.lookup(fn, result.__name__)
+        if cached is None:
+            # A local expansion server may already have expanded it
+            cached = server.fetch(fn, result.__name__)
+            if cached is not None:
+                store.save(fn, result.__name__, *cached)
+        if cached is not None:
+            cache.store(fn, stamp=stamp, *cached)
+    if cached is None:
+        # The expansion is traced by the ImportContext
+        trace.cancel(tracer)
+        imp, module_doc, module_text = expand_file(fn, result.__name__)
+        cache.store(fn, module_doc, module_text, imp.code, imp.dependencies,
+                    imp.lines, stamp)
+        store.save(fn, result.__name__, module_doc, module_text, imp.code,
+                   imp.dependencies, imp.lines)
+        result.__dict__.update(imp.namespace)
+        result.__mpy_depends__ = tuple(imp.dependencies)
+        result.__mpy_lines__ = imp.lines
+        if retain_contexts:
+            _contexts[result.__name__] = imp
+    else:
+        # The meta-program has already run; just exec the expanded code
+        module_doc, module_text, code, deps, lines = cached
+        result.__mpy_depends__ = deps
+        result.__mpy_lines__ = lines
+        _add_builder(result, code)
+        tracer.mark('load')
+        try:
+            exec code in result.__dict__
+        except Exception, e:
+            trace.end(tracer, e)
+            raise
+        tracer.mark('exec')
+        trace.end(tracer)
+    result.__doc__ = module_doc
+    result.__expanded__ = module_text
+
+def _add_builder(module, code):
+    '''Give module the _mpy Builder its expanded code uses, if it does (which
+    is the only reason loading an expanded module would need the parser)'''
+    if _uses_builder(code):
+        load_expander()
+        module._mpy = parse.Builder()
+
+def _uses_builder(code):
+    '''Does code (or any code object nested in it) refer to _mpy?'''
+    if '_mpy' in code.co_names:
+        return True
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType) and _uses_builder(const):
+            return True
+    return False
 
 def expand_string(text):
     '''Expand MetaPython text'''
+    from cStringIO import StringIO
     imp = ImportContext()
-    doc, text = imp.expand(StringIO(text).readline)
+    doc, text = imp.expand(StringIO(text))
     return imp, doc, text
 
-def expand_file(fn):
-    '''Expand a MetaPython file'''
-    imp = ImportContext(fn)
+def expand_file(fn, name=None):
+    '''Expand a MetaPython file, as the module name if given'''
+    imp = ImportContext(fn, name)
     doc, text = imp.expand(fn)
     return imp, doc, text
 
 
 
 class ImportContext(object):
-    '''Provides a context to import MetaPython (including local & global
-    dicts in which to exec the module code'''
+    '''Provides a context to import MetaPython: meta_namespace is the dict in
+    which the meta-program runs, and namespace (after expansion) the dict in
+    which the expanded module ran.  The meta-program's names are not part of
+    the module, just as when it is loaded from the cache.
+
+    After expansion, dependencies lists the .mpy files the module's
+    meta-program used: those of the MetaPython modules it imported or
+    references, or whose functions and classes it references, along with
+    their own dependencies, and lines the line table of the expanded text
+    (see :func:`metapython.lines.line_table`).
+
+    A context can expand its file again after it has been edited.  The
+    outputs of top-level statements which are unchanged (and follow the same
+    meta-program state) are then reused rather than expanded again; see
+    :class:`metapython.parse.ExpansionMemo`.'''
 
-    def __init__(self, filename = '<string>'):
+    def __init__(self, filename = '<string>', name=None):
+        if name is None:
+            name = os.path.splitext(os.path.basename(filename))[0]
+        load_expander()
         self.filename = filename
+        self.name = name
+        self.memo = parse.ExpansionMemo()
+        self._dep_stamps = ()
+        self._used = False
+        self._reset()
+
+    def _reset(self):
         self._mpy = parse.Builder()
-        self.namespace = dict(_mpy=self._mpy)
+        self.meta_namespace = dict(_mpy=self._mpy, __name__=self.name)
+        self.namespace = None
+        self.code = None
+        self.lines = ()
+        self.dependencies = []
+        self.imported = []
 
     def syntax_error(self, message, pos, line):
         '''Helper to raise an appropriate syntax error'''
@@ -89,16 +427,74 @@ class ImportContext(object):
 
     def expand(self, fn):
         '''Token-based macro and code quoting expander'''
+        if self._used:
+            # Expanding again: start from a fresh namespace, and forget the
+            # outputs of the last expansion if a dependency has changed
+            self._reset()
+            if _stamps(dep for dep, stamp in self._dep_stamps) \
+                    != self._dep_stamps:
+                self.memo.clear()
+        self._used = True
+        self.memo.start()
+        tracer = trace.begin(self.name, self.filename)
+        try:
+            with parse.gensym.scope(self.name):
+                result = self._expand(fn, tracer)
+        except Exception, e:
+            trace.end(tracer, e)
+            raise
+        trace.end(tracer)
+        return result
+
+    def _expand(self, fn, tracer):
+        import token
         inp = parse.parse_file(fn)
-        # Expand the defcode blocks
-        inp1 = inp.expand_defcode_blocks()
-        # Quote and exec to get the macros expanded
-        inp2 = inp1.quote()
-        self._mpy.push()
-        inp2.exec_(self.namespace, self.namespace)
-        inp3 = self._mpy.pop()
-        # Exec the module in the namespace
-        inp3.exec_(self.namespace, self.namespace)
+        tracer.mark('parse')
+        if inp.has_escapes():
+            # Expand the defcode blocks
+            inp1 = inp.expand_defcode_blocks()
+            tracer.mark('defcode')
+            # Quote and exec to get the macros expanded, noting the .mpy
+            # modules imported meanwhile
+            contexts = getattr(_meta_phase, 'contexts', None)
+            if contexts is None:
+                contexts = _meta_phase.contexts = []
+            contexts.append(self)
+            try:
+                self._mpy.push()
+                inp1.exec_quoted(self._mpy, self.meta_namespace,
+                                 self.meta_namespace, self.filename,
+                                 self.memo)
+                tracer.mark('meta')
+                inp3 = self._mpy.pop()
+            finally:
+                contexts.pop()
+            self.dependencies = _dependencies(
+                self.meta_namespace.values() + self.imported,
+                self.filename)
+            self._dep_stamps = _stamps(self.dependencies)
+            tracer.mark('pop')
+        else:
+            # Plain Python: nothing to expand
+            inp3 = inp
+        # Compile the expanded module once (the code object is what gets
+        # cached), with line numbers referring to the .mpy source, and exec
+        # it in a namespace of its own, as when it is loaded from the cache
+        lines = []
+        text, self.code = parse.compile_located(inp3, self.filename,
+                                                lines=lines)
+        self.lines = tuple(lines)
+        tracer.mark('compile')
+        self.namespace = dict(__name__=self.name)
+        if self.filename != '<string>':
+            self.namespace['__file__'] = self.filename
+        if _uses_builder(self.code):
+            self.namespace['_mpy'] = parse.Builder()
+        exec self.code in self.namespace
+        tracer.mark('exec')
+        if trace.enabled:
+            tracer.tokens_in = trace.count_tokens(inp)
+            tracer.tokens_out = trace.count_tokens(inp3)
         try:
             first_token = iter(inp3).next()
             if first_token.match(token.STRING):
@@ -107,5 +503,48 @@ class ImportContext(object):
                 doc = None
         except StopIteration, si:
             doc = None
-        return doc, inp3.as_python()
+        return doc, text
+
+def _dependencies(values, filename):
+    '''Return the sorted .mpy files a meta-program depends on: those of the
+    MetaPython modules among values (the meta-program's namespace and the
+    modules it imported), or which define the functions and classes among
+    them, or which are submodules of the packages among them (as bound by
+    "$import pkg.macros"), and their own dependencies'''
+    deps = set()
+    modules, seen = [], set()
+    for value in values:
+        if isinstance(value, types.ModuleType):
+            modules.append(value)
+        else:
+            module_name = getattr(value, '__module__', None)
+            if isinstance(module_name, basestring):
+                modules.append(sys.modules.get(module_name))
+    while modules:
+        module = modules.pop()
+        if module is None or id(module) in seen:
+            continue
+        seen.add(id(module))
+        if hasattr(module, '__path__'):
+            prefix = module.__name__ + '.'
+            modules.extend(
+                sub for sub in module.__dict__.values()
+                if isinstance(sub, types.ModuleType)
+                and sub.__name__.startswith(prefix))
+        fn = getattr(module, '__file__', None)
+        if fn is None or not fn.endswith('.mpy'):
+            continue
+        deps.add(os.path.abspath(fn))
+        deps.update(getattr(module, '__mpy_depends__', ()))
+    deps.discard(os.path.abspath(filename))
+    return sorted(deps)
 
+def _stamps(fns):
+    '''Return (filename, stamp) pairs for the current stamps of files'''
+    result = []
+    for dep in fns:
+        try:
+            result.append((dep, cache.source_stamp(dep)))
+        except OSError:
+            result.append((dep, None))
+    return tuple(result)
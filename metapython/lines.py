@@ -0,0 +1,71 @@
+'''Relating expanded MetaPython code to its .mpy source
+
+The code of a MetaPython module is compiled with line numbers referring to
+its .mpy file (see :func:`metapython.parse.compile_located`), so tracebacks,
+profilers and coverage tools report .mpy lines; code generated by a macro is
+reported at the line of the macro call which generated it.
+
+The line table of a module, recorded as it is expanded (and cached with the
+expansion), relates each line of its expanded text (``__expanded__``) to the
+.mpy line it was expanded from, which shows the expanded code standing behind
+a hot (or failing) .mpy line.  For generated code it also records the line
+of the macro's code which generated it (see :func:`definition`).  Code
+objects cannot step back to an earlier line, so where expanded code goes
+back to earlier .mpy lines (as the body of an unrolled ``$for`` loop does),
+the table has the lines which tracebacks cannot report.
+
+:func:`register` puts the expanded text of modules into :mod:`linecache`,
+under the name given by :func:`expanded_filename`, for tools which display
+expanded lines.
+'''
+import sys
+import linecache
+
+def line_table(module):
+    '''Return a tuple giving, for each line of the module's expanded text
+    (the first line at index 0), the .mpy line it was expanded from: its own
+    line for code copied from the source, and the line of the macro call (or
+    other $-escape) which generated it otherwise.  Lines before any code map
+    to None.'''
+    return tuple([ row for row, definition in module.__mpy_lines__ ])
+
+def source_line(module, lineno):
+    '''Return the .mpy line from which line lineno of the module's expanded
+    text was expanded'''
+    return module.__mpy_lines__[lineno - 1][0]
+
+def definition(module, lineno):
+    '''Return the (filename, line) of the code which generated line lineno of
+    the module's expanded text, such as a line of a macro's defcode block (or
+    of the module's own meta-program), or None if the line was copied from
+    the .mpy source'''
+    return module.__mpy_lines__[lineno - 1][1]
+
+def expanded_lines(module, lineno):
+    '''Return the lines of the module's expanded text expanded from line
+    lineno of its .mpy file (e.g., all the code a macro call generated)'''
+    return [ i + 1 for i, line in enumerate(line_table(module))
+             if line == lineno ]
+
+def expanded_filename(module):
+    '''Return the name the module's expanded text is registered under'''
+    return '<expanded %s>' % module.__file__
+
+def register(module=None):
+    '''Register the expanded text of module (or of every MetaPython module
+    loaded) with linecache, returning the filenames registered'''
+    if module is None:
+        modules = [ m for m in sys.modules.values()
+                    if m is not None
+                    and isinstance(m.__dict__.get('__expanded__'), str) ]
+    else:
+        modules = [ module ]
+    filenames = []
+    for m in modules:
+        text = m.__expanded__
+        fn = expanded_filename(m)
+        # An mtime of None keeps linecache.checkcache from dropping it
+        linecache.cache[fn] = (len(text), None,
+                               text.splitlines(True), fn)
+        filenames.append(fn)
+    return filenames
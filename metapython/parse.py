@@ -1,8 +1,20 @@
 from __future__ import with_statement
+import copy
+import sys
 import token
+import keyword
 import tokenize
+import itertools
+import threading
+from array import array
 from operator import itemgetter
+from contextlib import contextmanager
+from hashlib import md5
 from cStringIO import StringIO
+from types import CodeType, ModuleType
+
+from metapython import trace
+from metapython import profiler
 
 NESTING_OPS = {
     '(':')',
@@ -14,31 +26,410 @@ CLOSING_OPS = set(NESTING_OPS.values())
 KEYWORDS = [
     'for', 'while', 'if', 'else', 'import', 'from' ]
 
+ESCAPE_OPS = ('$', '?')
+
 SUITE_HEADERS = set([
         'for', 'while', 'if', 'else',
         'try', 'except', 'class', 'def',
         'defcode'])
 
-class GenSym(object):
+class GenSym(threading.local):
+    '''Generator of hygienic names.  Rather than numbering names in the order
+    they are asked for, each name is a hash of the expansion scope (the name
+    of the module being expanded), the site being expanded (a top-level
+    statement's fingerprint and how many identical statements came before
+    it; see enter), the original name and how often that name has been asked
+    for at that site.  Expanding the same source thus always produces the
+    same names, whatever has been expanded before it, and editing one
+    statement does not rename the others.
+
+    The scope state is per-thread, so that expansions running in different
+    threads do not disturb each other.'''
 
     def __init__(self):
-        self.count = 0
+        self.name = ''
+        self.site = ''
+        self.sites = {}
+        self.counts = {}
+        self.issued = set()
+
+    @contextmanager
+    def scope(self, name):
+        '''Context manager generating names for the expansion of the named
+        module, restoring the enclosing scope afterwards (expanding a module
+        can import, and so expand, another)'''
+        saved = self.name, self.site, self.sites, self.counts, self.issued
+        self.name, self.site = name, ''
+        self.sites, self.counts, self.issued = {}, {}, set()
+        try:
+            yield self
+        finally:
+            (self.name, self.site, self.sites,
+             self.counts, self.issued) = saved
+
+    def enter(self, fingerprint):
+        '''Generate names for the statement with the given fingerprint (see
+        fingerprint), returning the new site'''
+        occurrence = self.sites.get(fingerprint, 0)
+        self.sites[fingerprint] = occurrence + 1
+        self.site = '%s/%d' % (fingerprint, occurrence)
+        return self.site
+
+    def __call__(self, name=''):
+        key = (self.site, name)
+        while True:
+            count = self.counts.get(key, 0)
+            self.counts[key] = count + 1
+            digest = md5('%s\0%s\0%s\0%d' % (
+                    self.name, self.site, name, count)).hexdigest()
+            result = '_mpy_' + digest[:8]
+            # Skip the (unlikely) hash collisions within the scope
+            if result not in self.issued:
+                break
+        self.issued.add(result)
+        return result
+
+def fingerprint(stmt):
+    '''Return a digest of a statement's tokens (ignoring their positions)'''
+    return md5(repr(_token_key(stmt.pairs()))).hexdigest()[:16]
 
-    def __call__(self):
-        self.count += 1
-        return '_mpy_%d' % self.count
+class ExpansionMemo(object):
+    '''Remembers the output of each top-level statement a module's
+    meta-program expanded, so that re-expanding the module after an edit only
+    re-runs the statements which changed (see Block.exec_quoted).
+
+    Only the outputs of statements whose inputs are explicit are remembered:
+    statements each of whose $-escapes calls a macro declared with
+    :func:`pure`, passing it only literals and ?-quotes.  Such a statement is
+    reused if the same statement (by site; see GenSym.enter) calling the same
+    macros was expanded last time, after the same meta-program state.  Every
+    other statement is always re-run, and their fingerprints make up that
+    state, so changing one re-runs every statement after it.'''
+
+    def __init__(self):
+        self.outputs = {}
+        self.reused = 0
+        self.expanded = 0
+        self._previous = {}
+        self._state = md5()
+
+    def start(self):
+        '''Begin a new expansion of the module'''
+        self._previous, self.outputs = self.outputs, {}
+        self._state = md5()
+        self.reused = self.expanded = 0
+
+    def clear(self):
+        '''Forget all remembered outputs'''
+        self.outputs.clear()
+
+    def lookup(self, site, inputs):
+        '''Return the remembered output statements of site, which calls the
+        macros inputs (see _memo_inputs), or None'''
+        key = (self._state.hexdigest(), site, inputs)
+        output = self._previous.get(key)
+        if output is not None:
+            self.outputs[key] = output
+            self.reused += 1
+        return output
+
+    def record(self, site, output, inputs):
+        '''Remember the output statements of site.  If its inputs are not
+        explicit (inputs is None), it is not remembered but becomes part of
+        the state later statements are keyed by.'''
+        self.expanded += 1
+        if inputs is not None:
+            self.outputs[(self._state.hexdigest(), site, inputs)] = output
+        else:
+            self._state.update(site)
+
+def pure(macro):
+    '''Decorator declaring that a macro's output depends only on its
+    arguments (and the code of its module), so that the outputs of top-level
+    statements calling it can be reused when a module is re-expanded (see
+    ExpansionMemo)'''
+    macro.__mpy_pure__ = True
+    return macro
+
+def _memo_inputs(stmt, glbls, lcls):
+    '''Return the (module, name) pairs of the macros a top-level statement
+    calls if its output depends only on its tokens and those macros: if each
+    of its $-escapes calls a pure macro with only literals and ?-quotes as
+    arguments.  Otherwise return None.'''
+    inputs = []
+    inp = iter(list(stmt))
+    for t in inp:
+        if t.match(token.ERRORTOKEN, '?'):
+            return None
+        while t.match(token.ERRORTOKEN, '$'):
+            expr_toks = list(_read_expr(inp))
+            expr_toks, t = expr_toks[:-1], expr_toks[-1]
+            macro = _pure_call(expr_toks, glbls, lcls)
+            if macro is None:
+                return None
+            inputs.append(macro)
+    return tuple(inputs) or None
+
+def _pure_call(expr_toks, glbls, lcls):
+    '''Return the (module, name) pair of the pure macro a $-escape's
+    expression calls with explicit arguments, or None'''
+    name = _macro_name(expr_toks)
+    if name is None:
+        return None
+    toks = [ t for t in expr_toks if not _is_ignored(t) ]
+    while toks[0].match(token.OP, '('):
+        toks = toks[1:-1]
+    names = name.split('.')
+    args = iter(toks[2 * len(names):-1])
+    for t in args:
+        if t.match(token.ERRORTOKEN, '?'):
+            # A quoted expression: its names are not evaluated
+            for tok in _read_expr(args):
+                pass
+        elif t.match(token.ERRORTOKEN, '$'):
+            return None
+        elif t.match(token.NAME) and t.value not in ('None', 'True', 'False'):
+            # The only other names allowed are those of keyword arguments
+            following = _next_token(args)
+            if following is None or not following.match(token.OP, '='):
+                return None
+    macro = _resolve(names, glbls, lcls)
+    if not getattr(macro, '__mpy_pure__', False):
+        return None
+    return (getattr(macro, '__module__', None),
+            getattr(macro, '__name__', None))
+
+def _resolve(names, glbls, lcls):
+    '''Return the object the dotted name split into names refers to in the
+    namespaces of a $-escape (looking up attributes of modules only), or
+    None'''
+    if names[0] in lcls:
+        obj = lcls[names[0]]
+    elif names[0] in glbls:
+        obj = glbls[names[0]]
+    else:
+        return None
+    for attr in names[1:]:
+        if not isinstance(obj, ModuleType):
+            return None
+        obj = getattr(obj, attr, None)
+    return obj
+
+def _next_token(inp):
+    for t in inp:
+        if not _is_ignored(t):
+            return t
+    return None
 
 gensym = GenSym()
 
+class LRUCache(object):
+    '''A small bounded least-recently-used cache which counts its hits and
+    misses.  When full, the least recently used quarter of the entries is
+    evicted.
+    '''
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = {}
+        self._tick = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        '''Return the value cached under key, or None'''
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._tick += 1
+            entry[1] = self._tick
+            return entry[0]
+
+    def put(self, key, value):
+        '''Cache value under key'''
+        with self._lock:
+            if key not in self._data and len(self._data) >= self.maxsize:
+                self._evict()
+            self._tick += 1
+            self._data[key] = [value, self._tick]
+
+    def clear(self):
+        '''Empty the cache and reset its counters'''
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        '''Return a dict of the cache's size and hit/miss counters'''
+        return dict(size=len(self._data), maxsize=self.maxsize,
+                    hits=self.hits, misses=self.misses)
+
+    def _evict(self):
+        by_age = sorted(self._data.iteritems(), key=lambda kv: kv[1][1])
+        for key, entry in by_age[:max(1, len(by_age) // 4)]:
+            del self._data[key]
+
+# Compiled code objects for expressions, $: blocks and exec'd blocks, keyed
+# by (mode, source text) or by (mode, token values) for $-escapes
+code_cache = LRUCache(1024)
+
+# Code objects compiled by compile_located, which are often whole modules,
+# keyed by a digest of their text and line map rather than the text itself
+located_cache = LRUCache(64)
+
+# Whether errors in meta-programs print the failing code and stop in the
+# debugger, for interactive use; batch tools expand with it off (see
+# no_debugger), and the errors are just raised
+debug_on_error = True
+
+@contextmanager
+def no_debugger():
+    '''Context in which errors in meta-programs are raised without printing
+    the failing code or entering the debugger'''
+    global debug_on_error
+    saved = debug_on_error
+    debug_on_error = False
+    try:
+        yield
+    finally:
+        debug_on_error = saved
+
+# Templates of the strings passed to Builder.append & friends (the skeletons
+# of quoted code, not the values substituted into them), keyed by the string
+template_cache = LRUCache(1024)
+
+def compile_cached(text, mode='exec'):
+    '''Compile text (as with the compile builtin), reusing the code object
+    from code_cache when the same text has been compiled before'''
+    key = (mode, text)
+    code = code_cache.get(key)
+    if code is None:
+        code = compile(text, '<string>', mode)
+        code_cache.put(key, code)
+    return code
+
+def compile_located(block, filename, mode='exec', lines=None):
+    '''Compile a Block (or Stmt) to a code object whose line numbers refer
+    to the lines of filename the block's statements were expanded from,
+    returning a (text, code) pair.  The rendered text is compiled once, and
+    the line number tables of the resulting code objects are mapped back to
+    the source.  Results are kept in located_cache.
+
+    If lines is a list, the line table of the text is appended to it (see
+    _line_table).  Unlike the line numbers of code objects, which cannot
+    decrease, it records every line's source row.'''
+    chunks, locations = [], []
+    write_tokens(block.located(), chunks.append, mode == 'eval', locations)
+    text = ''.join(chunks)
+    if mode == 'exec' and text[-1:] != '\n':
+        text += '\n'
+    if lines is not None:
+        lines.extend(_line_table(locations, len(text.splitlines())))
+    linemap = _monotonic_rows([ row for row, definition in locations ])
+    key = md5('%s\0%s\0%s\0%r' % (mode, filename, text, linemap)).digest()
+    code = located_cache.get(key)
+    if code is not None:
+        return text, code
+    def source_line(lineno):
+        if not linemap:
+            return lineno
+        return linemap[min(lineno, len(linemap)) - 1]
+    try:
+        code = compile(text, filename, mode)
+    except SyntaxError, se:
+        if se.lineno:
+            se.lineno = source_line(se.lineno)
+        raise
+    code = _relocate(code, source_line)
+    located_cache.put(key, code)
+    return text, code
+
+def _relocate(code, source_line):
+    '''Return a copy of code (and the code objects nested in it) with its
+    line numbers mapped by source_line, which must not decrease'''
+    consts = tuple([ isinstance(c, CodeType) and _relocate(c, source_line) or c
+                     for c in code.co_consts ])
+    first = source_line(code.co_firstlineno)
+    # Decode the (address increment, line increment) byte pairs of co_lnotab
+    # and encode them again for the mapped lines
+    lnotab = []
+    addr, line = 0, code.co_firstlineno
+    prev_addr, prev_line = 0, first
+    increments = map(ord, code.co_lnotab)
+    for i in xrange(0, len(increments), 2):
+        addr += increments[i]
+        line += increments[i + 1]
+        new_line = source_line(line)
+        if new_line == prev_line:
+            continue
+        d_addr, d_line = addr - prev_addr, new_line - prev_line
+        while d_addr > 255:
+            lnotab += [255, 0]
+            d_addr -= 255
+        while d_line > 255:
+            lnotab += [d_addr, 255]
+            d_addr = 0
+            d_line -= 255
+        lnotab += [d_addr, d_line]
+        prev_addr, prev_line = addr, new_line
+    return CodeType(
+        code.co_argcount, code.co_nlocals, code.co_stacksize, code.co_flags,
+        code.co_code, consts, code.co_names, code.co_varnames,
+        code.co_filename, code.co_name, first, ''.join(map(chr, lnotab)),
+        code.co_freevars, code.co_cellvars)
+
+def _line_table(locations, count):
+    '''Turn the (row, definition) locations recorded for each output line
+    into a table of count (row, definition) pairs.  Unknown rows (0) take the
+    location of the line before them, or (None, None) at the start.'''
+    result = []
+    last = (None, None)
+    for location in locations[:count]:
+        if location[0]:
+            last = location
+        result.append(last)
+    result.extend([ last ] * (count - len(result)))
+    return tuple(result)
+
+def _monotonic_rows(rows):
+    '''Turn the source rows recorded for each output line into a line table.
+    Unknown rows (0) carry the previous row forward, and the table never
+    decreases (code objects cannot encode negative line steps).'''
+    result = []
+    last = 1
+    for row in rows:
+        if row > last:
+            last = row
+        result.append(last)
+    return result
+
 class Builder(object):
     '''Helper class for building up blocks of code.
 
     A builder maintains a stack of Block objects called the statement stack.
     This stack can be pushed & popped, and the top of the stack can have new
-    statements appended to it.
+    statements appended to it.  Each thread has its own statement stack, as
+    a module's macros (and so its builder) may be used by expansions running
+    in several threads at once.
     '''
     def __init__(self):
-        self.stack = [ ]
+        self._local = threading.local()
+
+    @property
+    def stack(self):
+        '''The calling thread's statement stack'''
+        try:
+            return self._local.stack
+        except AttributeError:
+            stack = self._local.stack = [ ]
+            return stack
 
     @property
     def top(self):
@@ -46,14 +437,25 @@ class Builder(object):
         return self.stack[-1]
 
     def append(self, stmt, glbls, lcls):
-        '''Append a statement to the current top of the statement stack'''
+        '''Append a statement to the current top of the statement stack.  The
+        statements appended record the line of the code calling append (such
+        as a line of a macro's defcode block) as their definition.'''
+        if trace.enabled:
+            trace.current().appends += 1
+        top = self.top
+        start = len(top.statements)
         try:
-            self.top.append(stmt, glbls, lcls)
+            top.append(stmt, glbls, lcls)
         except NameError, ne:
-            print ne
-            print 'Exception in %s' % stmt
-            import pdb; pdb.set_trace()
+            if debug_on_error:
+                print ne
+                print 'Exception in %s' % stmt
+                import pdb; pdb.set_trace()
             raise
+        definition = _code_location(sys._getframe(1))
+        for s in top.statements[start:]:
+            if s.definition is None:
+                s.definition = definition
 
     def push(self):
         '''Push an empty block onto the statement stack.'''
@@ -68,82 +470,424 @@ class Builder(object):
         of the stack (which will be popped and used as the body).  Then append
         the newly created suite to the new top of the statement stack.
         '''
+        if trace.enabled:
+            trace.current().suites += 1
         if isinstance(header, basestring):
-            header = list(tokens_from_string(header))
-        # print 'old header: %r' % string_from_tokens(header, True)
-        new_header = list(expand_macros(header, glbls, lcls))
+            new_header = list(expand_template(header, glbls, lcls))
+        else:
+            new_header = list(expand_macros(header, glbls, lcls))
         # print 'new header: %r' % string_from_tokens(new_header, True)
         suite = Suite(new_header, self.pop())
+        suite.definition = _code_location(sys._getframe(1))
         self.append(suite, glbls, lcls)
 
     def q(self, code, inline=True):
         '''Quote a code fragment and parse it.'''
-        return parse_string(str(code), inline=inline)
+        return parse_stream(get_template(str(code)).tokens, inline=inline)
 
 def string_from_tokens(toks, inline=False):
-    '''Build a string from a sequence of tokens.  This is a "better" version of
-    `tokenize.untokenize`, as it verifies that INDENT and DEDENT tokens are
-    appropriately converted to valid Python code (which tokenize.untokenize can
-    fail to do correctly.
+    '''Build a string from a sequence of tokens.  This replaces
+    `tokenize.untokenize`: INDENT and DEDENT tokens are converted to valid,
+    consistent indentation, and the other tokens are spaced normally
+    (see write_tokens).
+
+    Only the (type, value) part of each token is used, so toks may also be a
+    sequence of pairs.  Objects with a pairs() method (blocks, statements and
+    TokenBuffers) are rendered from that, avoiding building Token objects.
     '''
-    def reindent():
-        indent = ['']
-        for tok in toks:
-            if tok.match(token.INDENT):
-                cur_indent = indent[-1]
-                if (tok.value.startswith(cur_indent)
-                    and len(tok.value) > indent):
-                    cur_indent = tok.value
-                    yield tok
+    chunks = []
+    write_tokens(toks, chunks.append, inline)
+    return ''.join(chunks)
+
+# Rendered text is memoized on statements and blocks along with the value of
+# this counter, which is bumped whenever any of them is changed via append()
+# Unique stamps (the counter's next is atomic, unlike += on a global)
+_mutations = itertools.count(1)
+_mutation_count = [0]
+
+def _mutated():
+    _mutation_count[0] = _mutations.next()
+
+def _memoized_text(obj, inline):
+    memo = obj._text
+    if (memo is not None and memo[0] == _mutation_count[0]
+        and memo[1] == inline):
+        return memo[2]
+    return None
+
+def _memoize_text(obj, inline, text):
+    obj._text = (_mutation_count[0], inline, text)
+
+OPENING_OPS = set(NESTING_OPS.keys())
+UNARY_OPS = set(['-', '+', '~', '*', '**'])
+
+def write_tokens(toks, write, inline=False, rows=None):
+    '''Render a sequence of tokens as Python source in a single pass, passing
+    each chunk of text to the write callable (e.g. a file's write method).
+    Indentation is tracked from the INDENT and DEDENT tokens (the values of
+    which are ignored) as four spaces per level.  If inline is true, trailing
+    NEWLINEs are omitted.
+
+    If rows is a list, toks must be (type, value, row, definition) tuples
+    (see Block.located) and the (row, definition) of the first token written
+    on each output line (or of the line before, for blank lines) is appended
+    to it.'''
+    if hasattr(toks, 'pairs'):
+        toks = toks.pairs()
+    if rows is not None:
+        cur_row = [(0, None)]
+        line = [0]
+        raw_write = write
+        def write(chunk):
+            if len(rows) <= line[0]:
+                if rows and chunk[:1] == '\n':
+                    # Blank lines go with the line before them
+                    rows.append(rows[-1])
                 else:
-                    cur_indent += '    '
-                    tok = Token.make(
-                        tok.token, cur_indent,
-                        tok.begin, tok.end, tok.line)
-                indent.append(cur_indent)
-                yield tok
-            elif tok.match(token.DEDENT):
-                if len(indent) > 1:
-                    indent.pop()
-                    if tok.value != indent[-1]:
-                        tok = Token.make(
-                            tok.token, indent[-1],
-                            tok.begin, tok.end, tok.line)
-                    yield tok
+                    rows.append(cur_row[0])
+            newlines = chunk.count('\n')
+            rows.extend([ rows[-1] ] * (newlines - 1))
+            line[0] += newlines
+            raw_write(chunk)
+    level = 0
+    pending_newlines = 0
+    brackets = []
+    prev = None         # previous (type, value) on the current line
+    prev_unary = False
+    for tok in toks:
+        typ, value = tok[0], tok[1]
+        if rows is not None:
+            cur_row[0] = tok[2:]
+        if typ == token.NEWLINE:
+            if brackets:
+                continue
+            pending_newlines += 1
+            prev = None
+            continue
+        if (typ == token.ENDMARKER
+            or (typ == token.ERRORTOKEN and value == ' ')):
+            continue
+        if pending_newlines:
+            write('\n' * pending_newlines)
+            pending_newlines = 0
+        if typ == token.INDENT:
+            level += 1
+            continue
+        elif typ == token.DEDENT:
+            if level: level -= 1
+            continue
+        elif typ == tokenize.NL:
+            if brackets:
+                write('\n' + '    ' * (level + 2))
+                prev = (tokenize.NL, '')
             else:
-                yield tok
-    toks = list(reindent())
-    if inline:
-        while toks and toks[-1].match(token.NEWLINE):
-            toks.pop()
-    return tokenize.untokenize(toks)
+                write('\n')
+                prev = None
+            continue
+        elif typ == tokenize.COMMENT:
+            if prev is None:
+                write('    ' * level)
+            elif prev[0] != tokenize.NL:
+                write('  ')
+            if value.endswith('\n'):
+                # Whole-line comment (see _generate_tokens)
+                write(value)
+                prev = None
+            else:
+                write(value)
+                prev = (typ, value)
+            continue
+        if prev is None:
+            write('    ' * level)
+        elif prev[0] == tokenize.NL:
+            pass
+        elif _needs_space(prev, tok, brackets, prev_unary):
+            write(' ')
+        write(value)
+        prev_unary = (typ == token.OP and value in UNARY_OPS
+                      and _is_prefix_position(prev))
+        if typ == token.OP:
+            if value in OPENING_OPS:
+                brackets.append(value)
+            elif value in CLOSING_OPS:
+                if brackets: brackets.pop()
+            elif (value == '<' and prev is not None
+                  and prev[0] == token.ERRORTOKEN and prev[1] == '$'):
+                # $<name> escape
+                brackets.append(value)
+            elif value == '>' and brackets and brackets[-1] == '<':
+                brackets.pop()
+                # Space what follows as if after a closing bracket
+                prev = (token.OP, ')')
+                continue
+        prev = (typ, value)
+    if pending_newlines and not inline:
+        write('\n' * pending_newlines)
+
+def _is_keyword_pair(tok):
+    return tok[0] == token.NAME and keyword.iskeyword(tok[1])
+
+def _is_prefix_position(prev):
+    '''Would an operator following prev be a prefix (unary) operator?'''
+    if prev is None:
+        return True
+    if prev[0] == token.OP:
+        return prev[1] not in CLOSING_OPS
+    if prev[0] == token.ERRORTOKEN:
+        return True
+    return _is_keyword_pair(prev)
+
+def _needs_space(prev, cur, brackets, prev_unary):
+    '''Decide whether to put a space between the tokens prev and cur'''
+    ptype, pval = prev[0], prev[1]
+    ctype, cval = cur[0], cur[1]
+    if prev_unary:
+        return False
+    if ptype == token.OP:
+        if pval in OPENING_OPS:
+            return False
+        if pval == '<' and brackets and brackets[-1] == '<':
+            return False
+        if pval == '.':
+            return ctype == token.NAME and cval == 'import'
+        if pval == '@':
+            return False
+    if ptype == token.ERRORTOKEN and pval in ESCAPE_OPS:
+        return False
+    if ctype == token.OP:
+        if cval in CLOSING_OPS or cval in (',', ';', ':'):
+            return False
+        if cval == '>' and brackets and brackets[-1] == '<':
+            return False
+        if cval == '.':
+            return _is_keyword_pair(prev) or ptype == token.NUMBER
+        if cval in ('(', '['):
+            if ptype == token.OP:
+                return pval not in CLOSING_OPS
+            return _is_keyword_pair(prev) or ptype == token.NUMBER
+    if ptype == token.OP and pval == ':':
+        return not (brackets and brackets[-1] == '[')
+    if ((ctype == token.OP and cval == '=')
+        or (ptype == token.OP and pval == '=')):
+        # Keyword arguments and parameter defaults
+        return not brackets
+    return True
 
 def tokens_from_string(s):
     '''Convert a string to a stream of tokens'''
-    if not isinstance(s, basestring):
+    if not isinstance(s, basestring) and debug_on_error:
         import pdb; pdb.set_trace()
     readline = StringIO(s).readline
     strm = ( Token.make(*py_tok)
-             for py_tok in tokenize.generate_tokens(readline))
+             for py_tok in _generate_tokens(readline))
     return strm
 
+class Template(object):
+    '''A pre-tokenized code template, such as the text of a quoted statement
+    in a defcode block.  The tokens are split once into static runs, which
+    are copied as they are on expansion, and the $-escape "holes" between them,
+    which are evaluated on each expansion.  Templates containing $: blocks or
+    $-escaped keywords are expanded by running expand_macros over the tokens.
+    '''
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = tuple(tokens_from_string(text))
+        self.escaped = False
+        for t in self.tokens:
+            if t.match(token.ERRORTOKEN, '$'):
+                self.escaped = True
+                break
+        self._parts = None
+        self._simple = None
+        self._names = None
+
+    def parts(self):
+        '''Return the list of static token tuples and _Hole objects making up
+        the template, or None if it can only be expanded by expand_macros.
+        (Computed on first use.)'''
+        if self._parts is None:
+            try:
+                self._parts = list(_split_template(self.tokens))
+            except _DynamicTemplate:
+                self._parts = False
+        return self._parts or None
+
+    def expand(self, glbls, lcls):
+        '''Return the list of tokens of the template with $-escapes expanded
+        (and whitespace, NL and ENDMARKER tokens omitted).  Also returns
+        whether any of the substituted values spanned more than one line.'''
+        parts = self.parts()
+        if parts is None:
+            return list(expand_macros(self.tokens, glbls, lcls)), True
+        result = []
+        multiline = False
+        for part in parts:
+            if part.__class__ is tuple:
+                result.extend(part)
+            else:
+                value = part.eval(glbls, lcls)
+                for tok in value:
+                    if tok.token == token.NEWLINE:
+                        multiline = True
+                        break
+                result.extend(value)
+        if len(parts) == 2 and isinstance(value, _Spliced) \
+                and parts[0].__class__ is _Hole and len(parts[1]) == 1:
+            # "$macro(...)" on its own: its statements are those substituted
+            spliced = _Spliced(result)
+            spliced.definitions = value.definitions
+            return spliced, multiline
+        return result, multiline
+
+    def build(self, glbls, lcls):
+        '''Expand the template into a Block of statements.  A template that is
+        a single simple statement builds its Stmt directly, without going
+        through parse_stream.'''
+        toks, multiline = self.expand(glbls, lcls)
+        if (not multiline and self._is_simple()
+            and toks and toks[-1].token == token.NEWLINE
+            and not (_has_op(toks, ':') and _is_suite_header(toks))):
+            stmt = Stmt(toks)
+            if len(self.parts()) == 1:
+                # No holes: every expansion binds the same names
+                if self._names is None:
+                    self._names = stmt.local_names()
+                stmt._names = self._names
+            return _keep_definitions(Block([stmt]), toks)
+        return _keep_definitions(parse_stream(toks), toks)
+
+    def _is_simple(self):
+        '''Is the static part of the template a single simple statement?'''
+        if self._simple is None:
+            newlines = [ t for part in self.parts() or ()
+                         if part.__class__ is tuple
+                         for t in part
+                         if t.token in (token.NEWLINE, token.INDENT) ]
+            self._simple = len(newlines) == 1
+        return self._simple
+
+class _Spliced(list):
+    '''The tokens of the statements of quoted code substituted for a
+    $-escape, with the definitions (see Stmt.definition) of the statements'''
+
+    def __init__(self, toks=()):
+        list.__init__(self, toks)
+        self.definitions = []
+
+def _keep_definitions(block, toks):
+    '''Give the statements of a block built from the tokens of a template
+    which only substituted quoted code (such as a macro call on its own) the
+    definitions of the statements substituted'''
+    definitions = getattr(toks, 'definitions', None)
+    if definitions and len(definitions) == len(block.statements):
+        for stmt, definition in zip(block.statements, definitions):
+            stmt.definition = definition
+    return block
+
+class _Hole(object):
+    '''A $-escaped expression in a Template'''
+
+    def __init__(self, expr_toks):
+        self.expr_toks = expr_toks
+
+    def eval(self, glbls, lcls):
+        return _eval_escape(self.expr_toks, glbls, lcls)
+
+class _DynamicTemplate(Exception):
+    pass
+
+def _split_template(toks):
+    '''Generator splitting a template's tokens into static runs and holes.
+    Follows the same reading rules as expand_macros.'''
+    static = []
+    inp = iter(toks)
+    while True:
+        try:
+            t = inp.next()
+        except StopIteration:
+            break
+        while t.match(token.ERRORTOKEN, '$'):
+            expr_toks = list(_read_expr(inp))
+            expr_toks, t = expr_toks[:-1], expr_toks[-1]
+            if not expr_toks or expr_toks[0].match(token.NAME, *KEYWORDS):
+                raise _DynamicTemplate()
+            if static:
+                yield tuple(static)
+                static = []
+            yield _Hole(expr_toks)
+        if not _is_ignored(t):
+            static.append(t)
+    if static:
+        yield tuple(static)
+
+def get_template(s):
+    '''Return the Template for the string s from template_cache, creating
+    it if necessary.  The same template strings are appended on every
+    iteration of a loop and every call of a macro.'''
+    tmpl = template_cache.get(s)
+    if tmpl is None:
+        tmpl = Template(s)
+        template_cache.put(s, tmpl)
+    return tmpl
+
+def tokens_from_template(s):
+    '''Return a (tokens, escaped) pair for the string s, where tokens is the
+    tuple of tokens in s and escaped is True if it contains $-escapes.'''
+    tmpl = get_template(s)
+    return tmpl.tokens, tmpl.escaped
+
+def expand_template(s, glbls, lcls):
+    '''Return the tokens of the string s with $-escapes expanded'''
+    tmpl = get_template(s)
+    if tmpl.escaped:
+        return tmpl.expand(glbls, lcls)[0]
+    return tmpl.tokens
+
 def tokens_from_file(fp):
     '''Convert a file to a stream of tokens.'''
     strm = ( Token.make(*py_tok)
-             for py_tok in tokenize.generate_tokens(fp.readline))
+             for py_tok in _generate_tokens(fp.readline))
     return strm
 
+def _generate_tokens(readline):
+    '''Wrapper around tokenize.generate_tokens that folds the NL following a
+    whole-line COMMENT back into the comment, as tokenize did before Python
+    2.6.  parse_stream discards NL tokens, so otherwise the comment would
+    swallow the line after it.
+    '''
+    pending = None
+    for py_tok in tokenize.generate_tokens(readline):
+        if pending is not None:
+            if py_tok[0] == tokenize.NL:
+                pending = (pending[0], pending[1] + py_tok[1],
+                           pending[2], py_tok[3], pending[4])
+                yield pending
+                pending = None
+                continue
+            yield pending
+            pending = None
+        if py_tok[0] == tokenize.COMMENT:
+            pending = py_tok
+        else:
+            yield py_tok
+    if pending is not None:
+        yield pending
+
 def parse_file(fn, namespace=None):
-    '''Convert a file to a Block of statements.'''
-    def gen():
-        with open(fn) as fp:
-            for tok in tokens_from_file(fp):
-                yield tok
-    return parse_stream(gen(), filename=fn)
+    '''Convert a file (given by name or as a file-like object) to a Block of
+    statements, whose simple statements are views of a TokenBuffer.'''
+    if hasattr(fn, 'readline'):
+        return parse_buffer(TokenBuffer.from_file(fn, parsed=True),
+                            filename=getattr(fn, 'name', '<string>'))
+    with open(fn) as fp:
+        buf = TokenBuffer.from_file(fp, parsed=True)
+    return parse_buffer(buf, filename=fn)
 
 def parse_string(s, filename='<string>', inline=False):
-    '''Convert a string to a Block of statements.'''
-    return parse_stream(tokens_from_string(s), filename=filename, inline=inline)
+    '''Convert a string to a Block of statements (see parse_file).'''
+    return parse_buffer(TokenBuffer.from_string(s, parsed=True),
+                        filename=filename, inline=inline)
 
 def expand_macros(tokenstream, glbls=None, lcls=None, filename=None):
     '''Expand $-escapes in a token stream'''
@@ -162,7 +906,12 @@ def expand_macros(tokenstream, glbls=None, lcls=None, filename=None):
                         suite[0], suite[1:-1], suite[-1]
                 else:
                     suite = [t] + list(_read_to_newline(inp))
-                exec string_from_tokens(suite) in glbls, lcls
+                key = ('exec', _token_key(suite))
+                code = code_cache.get(key)
+                if code is None:
+                    code = compile(string_from_tokens(suite), '<string>', 'exec')
+                    code_cache.put(key, code)
+                exec code in glbls, lcls
                 t = inp.next()
                 continue
             if expr_toks[0].match(token.NAME, *KEYWORDS):
@@ -170,18 +919,124 @@ def expand_macros(tokenstream, glbls=None, lcls=None, filename=None):
                 for tok in expr_toks:
                     yield tok
                 continue
-            expanded_expr_toks = expand_inline_codequotes(
-                iter(expr_toks), filename)
-            expanded_expr_toks = expand_macros(
-                expanded_expr_toks, glbls, lcls, filename)
-            block = parse_stream(expanded_expr_toks, filename)
-            result = block.eval(glbls, lcls)
-            if hasattr(result, 'as_python'):
-                result = result.as_python(True)
-            for tok in parse_string(str(result)):
+            for tok in _eval_escape(expr_toks, glbls, lcls, filename):
                 yield tok
         yield t
 
+def _profile_escape(expr_toks, glbls, lcls, filename):
+    '''_eval_escape, timing the escape if it is a macro call'''
+    name = _profile_name(expr_toks, glbls, lcls)
+    if name is None:
+        return _eval_escape(expr_toks, glbls, lcls, filename, False)
+    frame = profiler.begin(name)
+    toks = ()
+    try:
+        toks = _eval_escape(expr_toks, glbls, lcls, filename, False)
+    finally:
+        profiler.end(frame, len(expr_toks) + 1, len(toks))
+    return toks
+
+def _profile_name(expr_toks, glbls, lcls):
+    '''Return the name a $-escape's macro call is profiled under: the module
+    and name of the function called, so that aliases of a macro are counted
+    together, or the name at the call site if the function cannot be found
+    (None if the escape is not a call)'''
+    name = _macro_name(expr_toks)
+    if name is None:
+        return None
+    macro = _resolve(name.split('.'), glbls, lcls)
+    module = getattr(macro, '__module__', None)
+    macro_name = getattr(macro, '__name__', None)
+    if module is None or macro_name is None:
+        return name
+    return '%s.%s' % (module, macro_name)
+
+def _macro_name(expr_toks):
+    '''Return the dotted name of the function a $-escape's expression calls
+    (as in "$f(x)", "$(mod.f(x))"), or None if it is not a call'''
+    toks = [ t for t in expr_toks if not _is_ignored(t) ]
+    while (toks and toks[0].match(token.OP, '(')
+           and _closing_paren(toks, 0) == len(toks) - 1):
+        toks = toks[1:-1]
+    names = []
+    i = 0
+    while i < len(toks) and toks[i].match(token.NAME):
+        names.append(toks[i].value)
+        i += 1
+        if i < len(toks) and toks[i].match(token.OP, '.'):
+            i += 1
+        else:
+            break
+    if (not names or i >= len(toks) or not toks[i].match(token.OP, '(')
+        or _closing_paren(toks, i) != len(toks) - 1):
+        return None
+    return '.'.join(names)
+
+def _closing_paren(toks, start):
+    '''Return the index of the parenthesis closing the one at start'''
+    depth = 0
+    for i in xrange(start, len(toks)):
+        if toks[i].match(token.OP, '('):
+            depth += 1
+        elif toks[i].match(token.OP, ')'):
+            depth -= 1
+            if not depth:
+                return i
+    return None
+
+def _eval_escape(expr_toks, glbls, lcls, filename=None, profile=True):
+    '''Evaluate the expression of a $-escape, returning the tokens of its
+    value.  Macro calls are timed while the profiler is enabled.'''
+    if profile and profiler.enabled:
+        return _profile_escape(expr_toks, glbls, lcls, filename)
+    if [ tok for tok in expr_toks
+         if tok.match(token.ERRORTOKEN, '$') ]:
+        # Nested $-escapes must be re-expanded every time
+        key = code = None
+    else:
+        key = ('eval', _token_key(expr_toks))
+        code = code_cache.get(key)
+    if code is None:
+        expanded_expr_toks = expand_inline_codequotes(
+            iter(expr_toks), filename)
+        expanded_expr_toks = expand_macros(
+            expanded_expr_toks, glbls, lcls, filename)
+        block = parse_stream(expanded_expr_toks, filename)
+        code = block.compile('eval')
+        if key is not None:
+            code_cache.put(key, code)
+    result = eval(code, glbls, lcls)
+    if isinstance(result, (Block, Stmt)):
+        # Splice the tokens of quoted code (e.g. a macro's output) directly
+        # rather than rendering and re-tokenizing them
+        if isinstance(result, Block):
+            statements = result.statements
+        else:
+            statements = [ result ]
+        toks = _Spliced()
+        for stmt in statements:
+            start = len(toks)
+            for t in stmt:
+                if _is_ignored(t):
+                    continue
+                # Drop the empty logical lines Block.append can leave after
+                # a suite (tokenizing the rendered text would drop them too)
+                if (t.token == token.NEWLINE
+                    and (not toks or toks[-1].token in (token.NEWLINE,
+                                                        token.DEDENT))):
+                    continue
+                toks.append(t)
+            if len(toks) > start:
+                toks.definitions.append(stmt.definition)
+        while toks and toks[-1].match(token.NEWLINE):
+            toks.pop()
+        return toks
+    if hasattr(result, 'as_python'):
+        result = result.as_python(True)
+    # Substituted values are mostly one-off, so they are tokenized afresh
+    # rather than through template_cache (where they would evict templates)
+    return tuple(parse_stream(tokens_from_string(str(result))))
+
 def expand_inline_codequotes(inp, filename='<string>'):
     '''Expand ?-escapes in a token stream'''
     while True:
@@ -197,15 +1052,15 @@ def expand_inline_codequotes(inp, filename='<string>'):
 
 def parse_stream(tokenstream, filename='<string>', inline=False):
     '''Convert a stream of tokens into a Block of statements.'''
+    if isinstance(tokenstream, TokenBuffer):
+        return parse_buffer(tokenstream, filename, inline)
     def gen():
         cur_line = []
         inp = iter(tokenstream)
         try:
             while True:
                 t = inp.next()
-                if (t.match(token.ERRORTOKEN, ' ')
-                    or t.match(token.ENDMARKER)
-                    or t.tok_name == 'NL'):
+                if _is_ignored(t):
                     continue
                 cur_line.append(t)
                 if t.match(token.NEWLINE):
@@ -256,9 +1111,76 @@ class Stmt(object):
         for t in self.tokens:
             yield t
 
+    def pairs(self):
+        '''Iterate over the (type, value) pairs of the statement's tokens'''
+        if isinstance(self.tokens, TokenView):
+            return self.tokens.pairs()
+        return iter(self.tokens)
+
     def first(self):
         return self.tokens[0]
 
+    # Source line of a statement generated from (rather than parsed from) the
+    # source, e.g. the line of the macro call which produced it
+    origin = None
+    # (filename, line) of the code which generated the statement, e.g. the
+    # line of a macro's defcode block (see Builder.append)
+    definition = None
+
+    def lineno(self):
+        '''Return the line of the source file the statement came from'''
+        if self.origin is not None:
+            return self.origin
+        return self.first().begin[0]
+
+    def located(self, origin=None, definition=None):
+        '''Iterate over (type, value, row, definition) tuples for the
+        statement's tokens, where row is the source line the token came from,
+        and definition the (filename, line) of the code which generated it (or
+        None).  Within generated statements, every token is placed at the
+        statement's origin.'''
+        if self.origin is not None:
+            origin = self.origin
+        if self.definition is not None:
+            definition = self.definition
+        if origin is None:
+            for t in self.tokens:
+                yield t[0], t[1], t[2][0], definition
+        else:
+            for t in self.pairs():
+                yield t[0], t[1], origin, definition
+
+    def has_escapes(self):
+        '''Return True if the statement contains any $ or ? escapes (or a
+        defcode block), i.e. if it needs to be quoted and exec'd to expand'''
+        return _has_escapes(self)
+
+    _names = None
+
+    def local_names(self):
+        '''Return a (bound, fixed) pair of frozensets: the names this
+        statement binds in the enclosing function scope, and the names which
+        must not be renamed (those declared global or bound by a dotted
+        import).  The result is memoized on the statement.'''
+        if self._names is None:
+            bound, fixed = set(), set()
+            _scan_simple_stmt(self.tokens, bound, fixed)
+            self._names = frozenset(bound), frozenset(fixed)
+        return self._names
+
+    def replace_names(self, newnames):
+        '''Return a copy of the statement with its NAMEs replaced according
+        to the newnames mapping.  Names bound by imports are aliased with
+        "as" rather than renamed.'''
+        if self.tokens[0].match(token.NAME, 'import', 'from'):
+            result = Stmt(_rename_import(self.tokens, newnames))
+        else:
+            result = Stmt(_rename_tokens(self.tokens, newnames))
+        result.eol = self.eol
+        result.origin = self.origin
+        result.definition = self.definition
+        return result
+
     def __repr__(self):
         return self.as_python(True)
     #return 'Stmt(%r)' % self.tokens
@@ -266,8 +1188,18 @@ class Stmt(object):
     def __str__(self):
         return self.as_python(True)
 
+    _text = None
+
     def as_python(self, inline=False):
-        return string_from_tokens(self, inline)
+        text = _memoized_text(self, inline)
+        if text is None:
+            text = string_from_tokens(self, inline)
+            _memoize_text(self, inline, text)
+        return text
+
+    def write_python(self, fp):
+        '''Write the statement's source to the file-like object fp'''
+        write_tokens(self, fp.write)
 
     def expand_defcode_blocks(self):
         def gen_toks():
@@ -283,7 +1215,9 @@ class Stmt(object):
                     yield expr_end
                 else:
                     yield tok
-        for stmt in parse_stream(gen_toks()).statements:
+        statements = parse_stream(gen_toks()).statements
+        _set_origin(statements, self.lineno())
+        for stmt in statements:
             yield stmt
 
     def quote(self):
@@ -295,9 +1229,13 @@ class Stmt(object):
         else:
             s_str = self.as_python()
             result = parse_string('_mpy.append(%r, globals(), locals())' % s_str)
+            _set_origin(result.statements, self.lineno())
             return result
 
     def append(self, token):
+        _mutated()
+        if not isinstance(self.tokens, list):
+            self.tokens = list(self.tokens)
         self.tokens.append(token)
 
     def __eq__(self, other):
@@ -324,6 +1262,31 @@ class Suite(Stmt):
     def first(self):
         return self.header[0]
 
+    def local_names(self):
+        '''Return a (bound, fixed) pair of frozensets: the names this suite
+        binds in the enclosing function scope (not descending into nested def
+        and class bodies) and the names which must not be renamed.'''
+        if self._names is None:
+            bound, fixed = set(), set()
+            _scan_suite_header(self.header, bound)
+            if not self.first().match(token.NAME, 'def', 'class'):
+                b, f = self.body.local_names()
+                bound.update(b)
+                fixed.update(f)
+            self._names = frozenset(bound), frozenset(fixed)
+        return self._names
+
+    def replace_names(self, newnames):
+        '''Return a copy of the suite with its NAMEs replaced according to the
+        newnames mapping'''
+        result = Suite(_rename_tokens(self.header, newnames),
+                       self.body.replace_names(**newnames),
+                       list(self.prologue), list(self.epilogue))
+        result.eol = self.eol
+        result.origin = self.origin
+        result.definition = self.definition
+        return result
+
 #     def __repr__(self):
 #         return 'Suite(%r, %r, %r, %r)' % (
 #             self.header, self.body, self.prologue, self.epilogue)
@@ -334,6 +1297,25 @@ class Suite(Stmt):
         for tok in self.body: yield tok
         for tok in self.epilogue: yield tok
 
+    def pairs(self):
+        for tok in self.header: yield tok
+        for tok in self.prologue: yield tok
+        for tok in self.body.pairs(): yield tok
+        for tok in self.epilogue: yield tok
+
+    def located(self, origin=None, definition=None):
+        if self.origin is not None:
+            origin = self.origin
+        if self.definition is not None:
+            definition = self.definition
+        for toks in (self.header, self.prologue):
+            for t in toks:
+                yield t[0], t[1], origin or t[2][0], definition
+        for t in self.body.located(origin, definition):
+            yield t
+        for t in self.epilogue:
+            yield t[0], t[1], origin or t[2][0], definition
+
     def expand_defcode_blocks(self):
         if self.first().match(token.NAME, 'defcode'):
             code_name = self.header[1].value
@@ -345,7 +1327,8 @@ class Suite(Stmt):
                 args = (repr(a) for a in args)
                 omit_names = ','.join(args)
             else:
-                import pdb; pdb.set_trace()
+                if debug_on_error:
+                    import pdb; pdb.set_trace()
                 raise SyntaxError, 'Expected arglist'
             block = Block()
             block.append('_mpy.push()', {}, {})
@@ -356,6 +1339,7 @@ class Suite(Stmt):
                     code_name,
                     code_name,
                     omit_names), {}, {})
+            _set_origin(block.statements, self.lineno())
             for stmt in block.statements:
                 yield stmt
         else:
@@ -381,9 +1365,11 @@ class Suite(Stmt):
             result.append(
                 '_mpy.append_suite(%r, globals(), locals())' % header,
                 {}, {})
+            _set_origin(result.statements, self.lineno())
             return result
         
     def append(self, token):
+        _mutated()
         self.epilogue.append(token)
         
 class Block(object):
@@ -397,47 +1383,55 @@ class Block(object):
         '''Ask this block's builder to sanitize this block,
         omitting the listed names'''
         omit_names = list(eval_names(glbls, lcls, *omit_names))
-        myfun = Suite(
-            list(parse_string('def _():')),
-            self,
-            [ Token.make(token.INDENT, '    ', (0,0), (0,0), '') ],
-            [ Token.make(token.DEDENT, '    ', (0,0), (0,0), ''),
-              Token.make(token.NEWLINE, '\n', (0,0), (0,0), '\n')])
-        ns = {}
-        exec myfun.as_python() in ns
-        code = ns['_'].func_code
-        names = set(code.co_varnames)
+        bound, fixed = self.local_names()
+        names = bound - fixed
         for on in omit_names:
             try:
                 names.remove(on)
             except KeyError:
                 pass
-        newnames = dict((n, gensym()) for n in names)
+        newnames = dict((n, gensym(n)) for n in sorted(names))
         result = self.replace_names(**newnames)
-#         print 'Santize result:'
-#         print self.as_python()
-#         print '==='
-#         print result.as_python()
         return result
 
+    def local_names(self):
+        '''Return a (bound, fixed) pair of sets: the names the statements in
+        this block would bind as locals if the block were the body of a
+        function, and the names which must not be renamed (those declared
+        global or bound by a dotted import).  This is worked out from the
+        tokens, without compiling the block.'''
+        bound, fixed = set(), set()
+        for stmt in self.statements:
+            b, f = stmt.local_names()
+            bound.update(b)
+            fixed.update(f)
+        return bound, fixed
+
     def replace_names(self, **newnames):
         '''Replace the NAMEs in this block according to the newnames mapping.'''
-        def translate():
-            for tok in self:
-                if tok.match(token.NAME):
-                    yield tok.replace(
-                        value=newnames.get(tok.value, tok.value))
-                elif tok.match(token.ENDMARKER):
-                    continue
-                else:
-                    yield tok
-        return parse_stream(translate())
+        return Block([ stmt.replace_names(newnames)
+                       for stmt in self.statements ])
 
     def __iter__(self):
         for s in self.statements:
             for t in s:
                 yield t
 
+    def pairs(self):
+        '''Iterate over the (type, value) pairs of the block's tokens.  Unlike
+        iterating over the block itself, statements parsed from a TokenBuffer
+        do not create Token objects.'''
+        for s in self.statements:
+            for t in s.pairs():
+                yield t
+
+    def located(self, origin=None, definition=None):
+        '''Iterate over (type, value, row, definition) tuples for the block's
+        tokens (see Stmt.located)'''
+        for s in self.statements:
+            for t in s.located(origin, definition):
+                yield t
+
 #     def __repr__(self):
 #         return 'Block(%r)' % self.statements
 
@@ -447,18 +1441,86 @@ class Block(object):
     def __repr__(self):
         return self.as_python(True)
 
+    _text = None
+
     def as_python(self, inline=False):
-        text = string_from_tokens(self, inline)
-        if not inline and (not text or text[-1] != '\n'):
-            text += '\n'
+        text = _memoized_text(self, inline)
+        if text is None:
+            text = string_from_tokens(self, inline)
+            if not inline and (not text or text[-1] != '\n'):
+                text += '\n'
+            _memoize_text(self, inline, text)
         return text
 
+    def write_python(self, fp):
+        '''Write the block's source to the file-like object fp, without
+        building it up as one string first (for very large outputs)'''
+        last = ['']
+        def write(chunk):
+            if chunk:
+                fp.write(chunk)
+                last[0] = chunk
+        write_tokens(self, write)
+        if last[0][-1:] != '\n':
+            fp.write('\n')
+
     def expand_defcode_blocks(self):
         result = Block()
         for s in self.statements:
-            result.append(Block(list(s.expand_defcode_blocks())), {}, {})
+            if s.has_escapes():
+                result.append(Block(list(s.expand_defcode_blocks())), {}, {})
+            else:
+                result.append(s, {}, {})
         return result
 
+    def has_escapes(self):
+        '''Return True if any statement in the block contains escapes'''
+        return _has_escapes(self)
+
+    def exec_quoted(self, builder, glbls, lcls, filename=None, memo=None):
+        '''Quote and exec the statements in this block, leaving their
+        expansion on top of the builder's statement stack.  Statements
+        containing no escapes are appended to the builder directly rather
+        than being quoted, exec'd and re-parsed.  The statements generated by
+        each quoted statement are placed at its line, and if filename is
+        given the quoted code is compiled with its line numbers pointing
+        into that file.  If an ExpansionMemo is given, the remembered outputs
+        of unchanged statements are reused rather than expanded again.'''
+        site = gensym.site
+        try:
+            for stmt in self.statements:
+                top = builder.top
+                if not stmt.has_escapes():
+                    top.append(stmt, glbls, lcls)
+                    continue
+                row = stmt.lineno()
+                # Hygienic names are keyed on the statement being expanded
+                stmt_site = gensym.enter(fingerprint(stmt))
+                if memo is not None:
+                    inputs = _memo_inputs(stmt, glbls, lcls)
+                    output = None
+                    if inputs is not None:
+                        output = memo.lookup(stmt_site, inputs)
+                    if output is not None:
+                        # The remembered statements are shared with earlier
+                        # expansions, so they are copied to be re-homed
+                        for out_stmt in output:
+                            top.append(_rehomed(out_stmt, row), glbls, lcls)
+                        continue
+                start = len(top.statements)
+                tracer = trace.current()
+                tracer.mark('meta')
+                quoted = Block()
+                quoted.append(stmt.quote(), {}, {})
+                tracer.mark('quote')
+                quoted.exec_(glbls, lcls, filename)
+                output = top.statements[start:]
+                _set_origin(output, row)
+                if memo is not None:
+                    memo.record(stmt_site, output, inputs)
+        finally:
+            gensym.site = site
+
     def quote(self, code_name=None):
         '''Expand the code in the block under the assumption that
         it is part of a defcode: block'''
@@ -476,15 +1538,14 @@ class Block(object):
         return parse_stream(tokens)
         
     def append(self, statement, glbls, lcls):
+        _mutated()
         if self.statements:
             last_stmt = self.statements[-1]
             if not last_stmt.eol:
                 last_stmt.append(Token.make(token.NEWLINE, '\n', (0,0), (0,0), ''))
                 last_stmt.eol = True
         if isinstance(statement, basestring):
-            toks = tokens_from_string(statement)
-            toks = list(expand_macros(toks, glbls, lcls))
-            statement = parse_stream(toks)
+            statement = get_template(statement).build(glbls, lcls)
         if isinstance(statement, Block):
             for ss in statement.statements:
                 self.append(ss, glbls, lcls)
@@ -497,55 +1558,71 @@ class Block(object):
         return self.statements[0]
 
     def expand(self, glbls=None, lcls=None):
-        quoted = self.quote()
         if glbls == lcls == None:
+            # A standalone expansion gets its own gensym scope
             _mpy = Builder()
             glbls = lcls = dict(_mpy=_mpy)
+            with gensym.scope('<string>'):
+                return self.expand(glbls, lcls)
         else:
             _mpy = glbls.get('_mpy', lcls.get('_mpy'))
         _mpy.push()
-        quoted.exec_(glbls, lcls)
+        self.exec_quoted(_mpy, glbls, lcls)
         return _mpy.pop()
 
+    def compile(self, mode='exec', filename=None):
+        '''Compile the block in the given mode ('exec' or 'eval'), using the
+        shared code_cache.  If filename is given, the code's line numbers
+        refer to the lines of that file (see compile_located, which caches
+        separately).'''
+        if filename is not None:
+            return compile_located(self, filename, mode)[1]
+        return compile_cached(self.as_python(mode == 'eval'), mode)
+
     def eval(self, glbls, lcls):
         try:
-            return eval(self.as_python(True), glbls, lcls)
+            return eval(self.compile('eval'), glbls, lcls)
         except NameError, ne:
-            print self
-            print ne
-            import pdb; pdb.set_trace()
+            if debug_on_error:
+                print self
+                print ne
+                import pdb; pdb.set_trace()
             raise
         except TypeError, te:
-            print te
-            import pdb; pdb.set_trace()
+            if debug_on_error:
+                print te
+                import pdb; pdb.set_trace()
             raise
         except SyntaxError, se:
-            print se.text
-            print '-' * (se.offset-1) + '^'
-            print se
-            import pdb; pdb.set_trace()
+            if debug_on_error:
+                print se.text
+                print '-' * (se.offset-1) + '^'
+                print se
+                import pdb; pdb.set_trace()
             raise
             
 
-    def exec_(self, glbls, lcls):
-        text = self.as_python()
+    def exec_(self, glbls, lcls, filename=None):
         try:
-            exec text in glbls, lcls
+            exec self.compile('exec', filename) in glbls, lcls
         except SyntaxError, se:
-            print se.text
-            print '-' * (se.offset-1) + '^'
-            print se
-            import pdb; pdb.set_trace()
+            if debug_on_error:
+                print se.text
+                print '-' * (se.offset-1) + '^'
+                print se
+                import pdb; pdb.set_trace()
             raise
         except tokenize.TokenError, te:
-            print te
-            print self.as_python()
-            import pdb; pdb.set_trace()
+            if debug_on_error:
+                print te
+                print self.as_python()
+                import pdb; pdb.set_trace()
             raise
         except Exception,  ex:
-            print ex
-            print self.as_python()
-            import pdb; pdb.set_trace()
+            if debug_on_error:
+                print ex
+                print self.as_python()
+                import pdb; pdb.set_trace()
             raise
 
     def __eq__(self, other):
@@ -582,7 +1659,7 @@ class Token(tuple):
 
     def __repr__(self):
         t = ('_mpy.token.%s' % self.tok_name,) +  self[1:]
-        if len(self) != 5:
+        if len(self) != 5 and debug_on_error:
             print tuple(self)
             import pdb; pdb.set_trace()
         return '_mpy.Token.make(%s,%r,%r,%r,%r)' % t
@@ -613,6 +1690,251 @@ class Token(tuple):
         else:
             return self
 
+class TokenBuffer(object):
+    '''Compact, array-backed storage for a stream of tokens.
+
+    Token types are kept in an array('B'), values as indices into a table of
+    interned strings, and begin/end positions in an array('i'), with the
+    source lines in a table indexed by row.  Token objects are only built
+    when a token is accessed by index or iteration; TokenView slices, the
+    match/type/value accessors and pairs() work on the arrays directly.
+    '''
+
+    def __init__(self, tokens=()):
+        self.types = array('B')
+        self.values = array('i')
+        self.positions = array('i')
+        self.strings = []
+        self._string_index = {}
+        self.lines = {}
+        for tok in tokens:
+            self.append(tok)
+
+    @classmethod
+    def from_string(klass, s, parsed=False):
+        '''Tokenize a string into a new buffer.  If parsed is true, the
+        tokens parse_stream ignores are left out.'''
+        return klass._from_readline(StringIO(s).readline, parsed)
+
+    @classmethod
+    def from_file(klass, fp, parsed=False):
+        '''Tokenize a file-like object into a new buffer (see from_string)'''
+        return klass._from_readline(fp.readline, parsed)
+
+    @classmethod
+    def _from_readline(klass, readline, parsed):
+        toks = _generate_tokens(readline)
+        if parsed:
+            toks = ( t for t in toks if not _is_ignored_pair(t[0], t[1]) )
+        return klass(toks)
+
+    def compact(self):
+        '''Return a buffer holding the tokens of this one, less those
+        parse_stream ignores (or this buffer itself, if there are none)'''
+        keep = [ i for i in xrange(len(self))
+                 if not _is_ignored_pair(self.types[i], self.value(i)) ]
+        if len(keep) == len(self):
+            return self
+        result = TokenBuffer()
+        result.strings = self.strings
+        result._string_index = self._string_index
+        result.lines = self.lines
+        p = self.positions
+        for i in keep:
+            result.types.append(self.types[i])
+            result.values.append(self.values[i])
+            result.positions.extend(p[4*i:4*i+4])
+        return result
+
+    def append(self, tok):
+        '''Add a token (a Token or 5-tuple) to the end of the buffer'''
+        typ, value, begin, end, line = tok
+        index = self._string_index.get(value)
+        if index is None:
+            index = self._string_index[value] = len(self.strings)
+            self.strings.append(intern(value))
+        self.types.append(typ)
+        self.values.append(index)
+        self.positions.extend(begin)
+        self.positions.extend(end)
+        if begin[0] not in self.lines:
+            self.lines[begin[0]] = line
+
+    def __len__(self):
+        return len(self.types)
+
+    def type(self, i):
+        return self.types[i]
+
+    def value(self, i):
+        return self.strings[self.values[i]]
+
+    def match(self, i, tok, *values):
+        '''Token.match for the token at index i'''
+        if self.types[i] != tok: return False
+        if not values: return True
+        return self.strings[self.values[i]] in values
+
+    def token(self, i):
+        '''Build the Token at index i'''
+        p = self.positions
+        row = p[4*i]
+        return Token.make(self.types[i], self.strings[self.values[i]],
+                          (row, p[4*i+1]), (p[4*i+2], p[4*i+3]),
+                          self.lines.get(row, ''))
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            return TokenView(self, start, stop)
+        if i < 0:
+            i += len(self)
+        return self.token(i)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self.token(i)
+
+    def pairs(self, start=0, stop=None):
+        '''Iterate over (type, value) pairs without building Tokens'''
+        if stop is None:
+            stop = len(self)
+        types, values, strings = self.types, self.values, self.strings
+        for i in xrange(start, stop):
+            yield types[i], strings[values[i]]
+
+class TokenView(object):
+    '''A contiguous slice of a TokenBuffer.  Creating a view does not copy
+    or build any tokens.'''
+    __slots__ = ('buffer', 'start', 'stop')
+
+    def __init__(self, buffer, start, stop):
+        self.buffer, self.start, self.stop = buffer, start, stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def _index(self, i):
+        if i < 0:
+            i += self.stop - self.start
+        if not 0 <= i < self.stop - self.start:
+            raise IndexError(i)
+        return self.start + i
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            return TokenView(self.buffer, self.start + start,
+                             self.start + stop)
+        return self.buffer.token(self._index(i))
+
+    def __iter__(self):
+        for i in xrange(self.start, self.stop):
+            yield self.buffer.token(i)
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def match(self, i, tok, *values):
+        return self.buffer.match(self._index(i), tok, *values)
+
+    def pairs(self):
+        return self.buffer.pairs(self.start, self.stop)
+
+def parse_buffer(buf, filename='<string>', inline=False):
+    '''Convert a TokenBuffer into a Block of statements.  This is the same
+    as parse_stream, except that simple statements refer to TokenViews of the
+    buffer rather than holding lists of Tokens.  Ignorable tokens such as NLs
+    are dropped first (see TokenBuffer.compact).'''
+    buf = buf.compact()
+    block = Block(_parse_buffer(buf, 0, len(buf), filename))
+    if inline:
+        assert len(block.statements) == 1, 'Illegal multiline short-quote (?)'
+        return block.statements[0]
+    return block
+
+def _is_ignored_at(buf, i):
+    return _is_ignored_pair(buf.types[i], buf.value(i))
+
+def _is_ignored_pair(typ, value):
+    '''_is_ignored for a token given by its type and value'''
+    return (typ == token.ENDMARKER
+            or typ == tokenize.NL
+            or (typ == token.ERRORTOKEN and value == ' '))
+
+def _parse_buffer(buf, start, stop, filename):
+    statements = []
+    types = buf.types
+    stmt_start = None
+    i = start
+    while i < stop:
+        if _is_ignored_at(buf, i):
+            if stmt_start is None:
+                i += 1
+                continue
+        elif stmt_start is None:
+            stmt_start = i
+        typ = types[i]
+        if typ == token.NEWLINE:
+            statements.append(Stmt(TokenView(buf, stmt_start, i+1)))
+            stmt_start = None
+        elif (typ == token.OP and buf.value(i) == ':'
+              and _is_suite_header_at(buf, stmt_start, i+1)):
+            header = [ buf.token(j) for j in xrange(stmt_start, i+1)
+                       if not _is_ignored_at(buf, j) ]
+            stmt_start = None
+            i += 1
+            if i < stop and types[i] == token.NEWLINE:
+                # Indented block
+                header.append(buf.token(i))
+                end = _find_block_end(buf, i+1, stop)
+                body = Block(_parse_buffer(buf, i+2, end, filename))
+                statements.append(Suite(header, body, [buf.token(i+1)],
+                                        [buf.token(end)]))
+                i = end + 1
+            else:
+                # Inline block
+                end = i
+                while end < stop and types[end] != token.NEWLINE:
+                    end += 1
+                end = min(end + 1, stop)
+                body = Block(_parse_buffer(buf, i, end, filename))
+                statements.append(Suite(header, body))
+                i = end
+            continue
+        i += 1
+    if stmt_start is not None:
+        end = stop
+        while _is_ignored_at(buf, end - 1):
+            end -= 1
+        statements.append(Stmt(TokenView(buf, stmt_start, end)))
+    return statements
+
+def _find_block_end(buf, i, stop):
+    '''Return the index of the DEDENT closing the indented block whose
+    INDENT is at or after index i (cf. _read_indented_block)'''
+    types = buf.types
+    while types[i] != token.INDENT:
+        i += 1
+    depth = 1
+    while depth:
+        i += 1
+        if i >= stop:
+            raise SyntaxError('Unterminated indented block')
+        if types[i] == token.DEDENT:
+            depth -= 1
+        elif types[i] == token.INDENT:
+            depth += 1
+    return i
+
+def _is_suite_header_at(buf, start, stop):
+    '''_is_suite_header for the tokens buf[start:stop]'''
+    for i in xrange(start, stop):
+        if buf.types[i] < token.ERRORTOKEN:
+            break
+    return (buf.match(i, token.NAME, *SUITE_HEADERS)
+            or buf.match(i, token.OP, ':'))
+
 def _read_indented_block(inp):
     '''Generator that reads and yields tokens in an INDENT...DEDENT block.
     Handles nested indents and yields the INDENT and the DEDENT tokens.
@@ -699,6 +2021,287 @@ def _read_nested(tokenstream, *closing_ops):
             for tok in _read_nested(tokenstream, NESTING_OPS[t.value]):
                 yield tok
 
+def _rename_tokens(toks, newnames):
+    '''Return a list of the tokens with NAMEs replaced per newnames'''
+    result = []
+    for t in toks:
+        if t[0] == token.NAME and t[1] in newnames:
+            t = Token.make(t[0], newnames[t[1]], t[2], t[3], t[4])
+        result.append(t)
+    return result
+
+AUGASSIGN_OPS = set([
+        '+=', '-=', '*=', '/=', '//=', '%=', '**=',
+        '>>=', '<<=', '&=', '^=', '|='])
+
+def _is_keyword(t):
+    return t.token == token.NAME and keyword.iskeyword(t.value)
+
+def _split_toplevel(toks, *ops):
+    '''Split a list of tokens on the given operators, ignoring any nested
+    inside brackets.  Returns the list of pieces.'''
+    pieces = [ [] ]
+    depth = 0
+    for t in toks:
+        if t.token == token.OP:
+            if t.value in NESTING_OPS:
+                depth += 1
+            elif t.value in CLOSING_OPS:
+                depth -= 1
+            elif not depth and t.value in ops:
+                pieces.append([])
+                continue
+        pieces[-1].append(t)
+    return pieces
+
+def _target_names(toks, bound):
+    '''Add the names bound by the assignment target list toks to bound.
+    Attributes, subscripts and call results are not names; parenthesized
+    and bracketed target lists are descended into.'''
+    stack = []
+    prev = None
+    toks = [ t for t in toks if t.token < token.N_TOKENS
+             and not t.match(token.ERRORTOKEN) ]
+    for i, t in enumerate(toks):
+        if t.token == token.OP:
+            if t.value in NESTING_OPS:
+                trailer = (t.value == '{'
+                           or (prev is not None
+                               and ((prev.token == token.NAME
+                                     and not _is_keyword(prev))
+                                    or prev.match(token.OP, ')', ']')
+                                    or prev.token == token.STRING)))
+                stack.append(trailer)
+            elif t.value in CLOSING_OPS:
+                if stack: stack.pop()
+        elif (t.token == token.NAME and not _is_keyword(t)
+              and True not in stack
+              and not (prev is not None and prev.match(token.OP, '.'))
+              and not (i + 1 < len(toks)
+                       and toks[i+1].match(token.OP, '.', '(', '['))):
+            bound.add(t.value)
+        prev = t
+
+def _scan_listcomps(toks, bound):
+    '''Add the loop variables of any list comprehensions in toks to bound
+    (in Python 2 they leak into the enclosing scope).'''
+    stack = []
+    toks = list(toks)
+    i = 0
+    while i < len(toks):
+        t = toks[i]
+        if t.token == token.OP:
+            if t.value in NESTING_OPS:
+                stack.append(t.value)
+            elif t.value in CLOSING_OPS and stack:
+                stack.pop()
+        elif t.match(token.NAME, 'for') and stack and stack[-1] == '[':
+            depth = len(stack)
+            target = []
+            i += 1
+            while i < len(toks):
+                t = toks[i]
+                if t.match(token.NAME, 'in') and len(stack) == depth:
+                    break
+                if t.match(token.OP, *NESTING_OPS.keys()):
+                    stack.append(t.value)
+                elif t.match(token.OP, *CLOSING_OPS) and stack:
+                    stack.pop()
+                target.append(t)
+                i += 1
+            _target_names(target, bound)
+        i += 1
+
+def _import_names(toks, bound, fixed):
+    '''Add the names bound by the "a.b as c, d" part of an import.  The first
+    component of a dotted name imported without "as" cannot be aliased, so it
+    is added to fixed.'''
+    for piece in _split_toplevel(toks, ','):
+        piece = [ t for t in piece
+                  if t.token == token.NAME or t.match(token.OP, '*', '.') ]
+        if not piece or piece[0].match(token.OP, '*'):
+            continue
+        if len(piece) >= 3 and piece[-2].match(token.NAME, 'as'):
+            bound.add(piece[-1].value)
+        else:
+            bound.add(piece[0].value)
+            if len(piece) > 1:
+                fixed.add(piece[0].value)
+
+def _rename_import(toks, newnames):
+    '''Rename the names bound by an import statement by adding (or
+    replacing) "as" clauses, leaving the imported module and names alone'''
+    result = []
+    piece = None
+    for t in toks:
+        if piece is None:
+            result.append(t)
+            if t.match(token.NAME, 'import'):
+                piece = []
+            continue
+        if (t.match(token.OP, ',', '(', ')')
+            or t.token in (token.NEWLINE, token.ENDMARKER)
+            or t.token >= token.N_TOKENS):
+            result.extend(_rename_import_piece(piece, newnames))
+            result.append(t)
+            piece = []
+        else:
+            piece.append(t)
+    if piece:
+        result.extend(_rename_import_piece(piece, newnames))
+    return result
+
+def _rename_import_piece(piece, newnames):
+    names = [ t for t in piece if t.token == token.NAME ]
+    if len(names) >= 3 and names[-2].match(token.NAME, 'as'):
+        last = piece[-1]
+        if last.token == token.NAME and last.value in newnames:
+            piece = piece[:-1] + [ Token.make(
+                    last.token, newnames[last.value],
+                    last.begin, last.end, last.line) ]
+    elif len(piece) == 1 and piece[0].value in newnames:
+        t = piece[0]
+        piece = [ t,
+                  Token.make(token.NAME, 'as', t.end, t.end, t.line),
+                  Token.make(token.NAME, newnames[t.value],
+                             t.end, t.end, t.line) ]
+    return piece
+
+def _scan_simple_stmt(toks, bound, fixed):
+    '''Add the names bound by a simple statement to bound, and those which
+    cannot be renamed to fixed'''
+    toks = [ t for t in toks
+             if t.token not in (token.NEWLINE, token.INDENT, token.DEDENT)
+             and t.token < token.N_TOKENS
+             and not t.match(token.ERRORTOKEN) ]
+    if not toks:
+        return
+    first = toks[0]
+    if first.match(token.NAME, 'import'):
+        _import_names(toks[1:], bound, fixed)
+        return
+    elif first.match(token.NAME, 'from'):
+        for i, t in enumerate(toks):
+            if t.match(token.NAME, 'import'):
+                _import_names(
+                    [ tt for tt in toks[i+1:]
+                      if not tt.match(token.OP, '(', ')') ],
+                    bound, fixed)
+                break
+        return
+    elif first.match(token.NAME, 'global'):
+        for t in toks[1:]:
+            if t.token == token.NAME:
+                fixed.add(t.value)
+        return
+    elif first.match(token.NAME, 'del'):
+        _target_names(toks[1:], bound)
+        return
+    if _is_keyword(first) and toks[-1].match(token.OP, ':'):
+        # A compound statement header parse_stream did not recognize as a
+        # suite (e.g. with)
+        _scan_suite_header(toks, bound)
+        return
+    _scan_listcomps(toks, bound)
+    if _is_keyword(first):
+        return
+    # Assignments: everything before the last top-level '=' (up to any
+    # lambda, whose default arguments are not assignments) is a target
+    lambda_at = len(toks)
+    for i, t in enumerate(toks):
+        if t.match(token.NAME, 'lambda'):
+            lambda_at = i
+            break
+    pieces = _split_toplevel(toks[:lambda_at], '=')
+    for target in pieces[:-1]:
+        _target_names(target, bound)
+    for i, t in enumerate(toks):
+        if t.token == token.OP and t.value in AUGASSIGN_OPS:
+            _target_names(toks[:i], bound)
+            break
+
+def _scan_suite_header(header, bound):
+    '''Add the names bound by the header line of a suite'''
+    toks = [ t for t in header
+             if t.token not in (token.NEWLINE, token.INDENT, token.DEDENT)
+             and t.token < token.N_TOKENS
+             and not t.match(token.ERRORTOKEN) ]
+    if not toks:
+        return
+    first = toks[0]
+    _scan_listcomps(toks, bound)
+    if first.match(token.NAME, 'def', 'class'):
+        if len(toks) > 1:
+            bound.add(toks[1].value)
+    elif first.match(token.NAME, 'for'):
+        for i, t in enumerate(toks):
+            if t.match(token.NAME, 'in'):
+                _target_names(toks[1:i], bound)
+                break
+    elif first.match(token.NAME, 'with'):
+        rest = toks[1:-1]
+        for i, t in enumerate(rest):
+            if t.match(token.NAME, 'as'):
+                target = _split_toplevel(rest[i+1:], ',')[0]
+                _target_names(target, bound)
+    elif first.match(token.NAME, 'except'):
+        pieces = _split_toplevel(toks[1:-1], ',')
+        if len(pieces) == 2:
+            _target_names(pieces[1], bound)
+        else:
+            for i, t in enumerate(toks):
+                if t.match(token.NAME, 'as'):
+                    _target_names(toks[i+1:-1], bound)
+                    break
+
+def _is_ignored(t):
+    '''Is t one of the tokens parse_stream drops?'''
+    return (t.match(token.ERRORTOKEN, ' ')
+            or t.match(token.ENDMARKER)
+            or t.tok_name == 'NL')
+
+def _has_op(toks, op):
+    for t in toks:
+        if t.match(token.OP, op):
+            return True
+    return False
+
+def _token_key(toks):
+    '''Return a hashable key for a token sequence, ignoring positions'''
+    return tuple([ (t[0], t[1]) for t in toks ])
+
+def _code_location(frame):
+    '''Return the (filename, line) a frame is running (the filename interned,
+    so that line tables marshal it once)'''
+    return intern(frame.f_code.co_filename), frame.f_lineno
+
+def _set_origin(statements, row):
+    '''Place the generated statements which have no origin yet at row'''
+    for stmt in statements:
+        if stmt.origin is None:
+            stmt.origin = row
+
+def _rehomed(stmt, row):
+    '''Return a copy of a generated statement placed at row.  The lists of
+    tokens which appending to the statement can extend are copied too.'''
+    result = copy.copy(stmt)
+    if isinstance(stmt, Suite):
+        result.epilogue = list(stmt.epilogue)
+    elif isinstance(stmt.tokens, list):
+        result.tokens = list(stmt.tokens)
+    result.origin = row
+    return result
+
+def _has_escapes(toks):
+    '''Cheap scan of a token stream for $ and ? escapes and defcode blocks'''
+    for t in toks:
+        if t.token == token.ERRORTOKEN:
+            if t.value in ESCAPE_OPS:
+                return True
+        elif t.token == token.NAME and t.value == 'defcode':
+            return True
+    return False
+
 def _is_suite_header(cur_line):
     '''Determine whether the given list of tokens constitutes a suite header.
     Suite headers begin with one of the SUITE_HEADERS tokens and contain a
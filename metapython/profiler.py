@@ -0,0 +1,155 @@
+'''Profiling of macro calls
+
+While the profiler is enabled, every $-escape which calls a function (such as
+``$namedtuple('Point', 'x y')`` or ``$(macros.setx(42))``) is timed, and the
+statistics are gathered by the function called, named by its module and name
+(such as ``macros.setx``) whatever name the call site uses for it:
+
+- the number of calls;
+- the cumulative time of the calls, including the macros they called in
+  turn (but not counting recursive calls twice);
+- the time spent in the calls themselves, leaving out those other macros;
+- the number of tokens at the call sites and in the code they expanded to,
+  whose ratio shows which macros bloat the expanded code.
+
+Set the ``METAPYTHON_PROFILE`` environment variable to enable the profiler
+and print a :func:`report` to stderr at exit.  Unless it is ``1``, it names a
+file to which the statistics are also written, as JSON, at exit.  Programs
+can instead call :func:`enable` and :func:`report` or :func:`write_json`.
+'''
+from __future__ import with_statement
+import os
+import sys
+import time
+import atexit
+import threading
+
+enabled = False
+
+# callee module.name -> MacroStats
+_stats = {}
+_lock = threading.Lock()
+# The calls in progress in each thread (innermost last)
+_local = threading.local()
+
+class MacroStats(object):
+    '''The statistics of the calls to one macro'''
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.cumulative = 0.0
+        self.self_time = 0.0
+        self.tokens_in = 0
+        self.tokens_out = 0
+
+    @property
+    def ratio(self):
+        '''The number of tokens expanded to per token of the call sites'''
+        if not self.tokens_in:
+            return 0.0
+        return float(self.tokens_out) / self.tokens_in
+
+    def as_dict(self):
+        '''Return the statistics as a dict (of JSON-compatible values)'''
+        return dict(name=self.name, calls=self.calls,
+                    cumulative=self.cumulative, self_time=self.self_time,
+                    tokens_in=self.tokens_in, tokens_out=self.tokens_out,
+                    ratio=self.ratio)
+
+def begin(name):
+    '''Start timing a call to the macro name, returning its frame'''
+    frame = [ name, 0.0, time.time() ]
+    _stack().append(frame)
+    return frame
+
+def end(frame, tokens_in, tokens_out):
+    '''Stop timing the call started by begin, which had tokens_in tokens and
+    expanded to tokens_out tokens'''
+    name, nested, start = frame
+    elapsed = time.time() - start
+    stack = _stack()
+    stack.pop()
+    if stack:
+        stack[-1][1] += elapsed
+    recursive = [ f for f in stack if f[0] == name ]
+    with _lock:
+        stats = _stats.get(name)
+        if stats is None:
+            stats = _stats[name] = MacroStats(name)
+        stats.calls += 1
+        stats.self_time += elapsed - nested
+        if not recursive:
+            stats.cumulative += elapsed
+        stats.tokens_in += tokens_in
+        stats.tokens_out += tokens_out
+
+def _stack():
+    try:
+        return _local.stack
+    except AttributeError:
+        stack = _local.stack = []
+        return stack
+
+def enable():
+    '''Start profiling macro calls'''
+    global enabled
+    enabled = True
+
+def disable():
+    '''Stop profiling macro calls'''
+    global enabled
+    enabled = False
+
+def clear():
+    '''Forget the statistics gathered so far'''
+    with _lock:
+        _stats.clear()
+
+def stats(sort='self_time'):
+    '''Return the MacroStats of the macros called, most costly (by the
+    attribute sort) first'''
+    with _lock:
+        result = list(_stats.values())
+    result.sort(key=lambda s: (-getattr(s, sort), s.name))
+    return result
+
+def report(sort='self_time', limit=None):
+    '''Return a table of the statistics (times in milliseconds), most costly
+    first, of at most limit macros'''
+    lines = [ '%-40s %7s %10s %10s %8s %8s %7s' % (
+            'macro', 'calls', 'cum ms', 'self ms', 'tok in', 'tok out',
+            'ratio') ]
+    for s in stats(sort)[:limit]:
+        lines.append('%-40s %7d %10.1f %10.1f %8d %8d %7.1f' % (
+                s.name, s.calls, s.cumulative * 1000, s.self_time * 1000,
+                s.tokens_in, s.tokens_out, s.ratio))
+    return '\n'.join(lines) + '\n'
+
+def write_json(fp, sort='self_time'):
+    '''Write the statistics to the file fp as a JSON list, most costly
+    first'''
+    import json
+    json.dump([ s.as_dict() for s in stats(sort) ], fp, indent=1,
+              sort_keys=True)
+    fp.write('\n')
+
+def dump(fn=None):
+    '''Write the report to stderr, and the statistics to the file fn as JSON
+    if given'''
+    sys.stderr.write('metapython macro profile:\n' + report())
+    if fn is not None:
+        with open(fn, 'w') as fp:
+            write_json(fp)
+
+def _enable_from_environment():
+    setting = os.environ.get('METAPYTHON_PROFILE')
+    if not setting:
+        return
+    enable()
+    if setting == '1':
+        atexit.register(dump)
+    else:
+        atexit.register(dump, os.path.abspath(setting))
+
+_enable_from_environment()
@@ -0,0 +1,260 @@
+'''Local expansion server
+
+Processes which import the same .mpy modules (such as the workers of a
+prefork server) can share one expansion server rather than each expanding
+every module itself.  ``metapython serve`` listens on a Unix socket, expands
+the files it is asked for with its macro modules kept imported, and
+remembers the results, keyed by the source file's md5, until the file or any
+of its dependencies changes.
+
+Using a server is opt-in: when the ``METAPYTHON_SERVER`` environment
+variable names a socket (such as :func:`default_path`, where ``metapython
+serve`` listens by default), the import hook asks that server for the
+expansions which are not in the on-disk cache.  It falls back to expanding
+the module in-process if no server is running or the server fails to expand
+it.
+
+The code the server returns is run by the importing process, so the socket
+must only be connectable by the current user: the default socket lives in a
+directory readable only by them, and the import hook only uses a socket
+owned by the current user.
+'''
+import os
+import sys
+import stat
+import errno
+import struct
+import socket
+import marshal
+import tempfile
+import threading
+import traceback
+from hashlib import md5
+
+from metapython import cache
+
+# Seconds to wait for the server to expand a module before expanding it
+# in-process instead
+TIMEOUT = 60.0
+
+# Set in the server's threads while they expand, so that the imports of the
+# expansion do not ask the server itself
+_serving = threading.local()
+
+def runtime_dir():
+    '''Return the current user's private directory for the server socket'''
+    return os.path.join(tempfile.gettempdir(), 'metapython-%d' % os.getuid())
+
+def default_path():
+    '''Return the default socket path of the current user's server'''
+    return os.path.join(runtime_dir(), 'server.sock')
+
+def socket_path():
+    '''Return the socket path named by the METAPYTHON_SERVER environment
+    variable, or None if it is unset or empty'''
+    return os.environ.get('METAPYTHON_SERVER') or None
+
+def _is_own_socket(path):
+    '''Return whether path is a socket (and not a link to one) owned by the
+    current user, so that no other user can have put it there'''
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(st.st_mode) and st.st_uid == os.getuid()
+
+def _make_private_dir(dirname):
+    '''Create the directory dirname with access for the current user only,
+    or check that an existing one has no other access'''
+    try:
+        os.mkdir(dirname, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    st = os.lstat(dirname)
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid()
+        or st.st_mode & 077):
+        raise OSError(errno.EPERM,
+                      'Not a private directory of the current user', dirname)
+
+def _send(sock, data):
+    sock.sendall(struct.pack('!I', len(data)) + data)
+
+def _recv(sock):
+    header = _recv_exactly(sock, 4)
+    return _recv_exactly(sock, struct.unpack('!I', header)[0])
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            raise EOFError('connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+def fetch(fn, name, path=None):
+    '''Ask the expansion server for the expansion of the .mpy file fn as the
+    module name, returning a (doc, text, code, dependencies, lines) tuple,
+    or None
+    if no server is running or it could not expand the file'''
+    if getattr(_serving, 'active', False):
+        return None
+    if path is None:
+        path = socket_path()
+    if path is None or not _is_own_socket(path):
+        return None
+    try:
+        fp = open(fn, 'rb')
+        try:
+            digest = md5(fp.read()).hexdigest()
+        finally:
+            fp.close()
+    except IOError:
+        return None
+    search_path = [ os.path.abspath(p) for p in sys.path
+                    if isinstance(p, str) ]
+    request = (cache.MAGIC, os.path.abspath(fn), name, digest, search_path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.settimeout(TIMEOUT)
+            sock.connect(path)
+            _send(sock, marshal.dumps(request))
+            reply = marshal.loads(_recv(sock))
+        finally:
+            sock.close()
+    except (socket.error, EOFError, ValueError, TypeError):
+        return None
+    if reply[0] != 'ok' or reply[1] != digest:
+        return None
+    return tuple(reply[2:])
+
+def _stamps(fns):
+    result = []
+    for fn in fns:
+        try:
+            result.append(cache.source_stamp(fn))
+        except OSError:
+            result.append(None)
+    return result
+
+class ExpansionServer(object):
+    '''Expands .mpy files on behalf of other processes, remembering the
+    results.  Expansions run one at a time, each with the requesting
+    process's sys.path, and macro modules which have changed are reloaded
+    (see :class:`metapython.watch.Watcher`) before each one.
+
+    The server listens on the Unix socket path, by default
+    :func:`default_path` (creating its private directory).'''
+
+    def __init__(self, path=None):
+        from metapython import core
+        from metapython import watch
+        import SocketServer
+        if path is None:
+            _make_private_dir(runtime_dir())
+            path = default_path()
+        self.path = path
+        # (filename, module name) -> (md5, dependencies, dependency stamps,
+        #                             reply)
+        self.expansions = {}
+        self.hits = self.misses = 0
+        self._core = core
+        self._lock = threading.Lock()
+        self._watcher = watch.Watcher()
+        core.install_import_hook()
+        if _is_own_socket(path):
+            # Left over from a server which did not shut down cleanly
+            os.remove(path)
+        expansion_server = self
+        class Handler(SocketServer.BaseRequestHandler):
+            def handle(self):
+                try:
+                    request = marshal.loads(_recv(self.request))
+                    reply = expansion_server.expand(*request)
+                    _send(self.request, marshal.dumps(reply))
+                except (socket.error, EOFError, ValueError, TypeError):
+                    pass
+        class Server(SocketServer.ThreadingMixIn,
+                     SocketServer.UnixStreamServer):
+            daemon_threads = True
+        # Only the current user may connect
+        umask = os.umask(077)
+        try:
+            self.server = Server(path, Handler)
+        finally:
+            os.umask(umask)
+
+    def serve_forever(self):
+        '''Handle requests until shutdown is called'''
+        try:
+            self.server.serve_forever()
+        finally:
+            self._watcher.stop()
+            self.server.server_close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def shutdown(self):
+        '''Stop serve_forever (from another thread)'''
+        self.server.shutdown()
+
+    def expand(self, magic, fn, name, digest, search_path):
+        '''Return the reply to an expansion request: ('ok', md5, doc, text,
+        code, dependencies, lines) or ('error', message)'''
+        if magic != cache.MAGIC:
+            return ('error', 'incompatible interpreter or metapython version')
+        with self._lock:
+            self._watcher.check()
+            entry = self.expansions.get((fn, name))
+            if (entry is not None and entry[0] == digest
+                and _stamps(entry[1]) == entry[2]):
+                self.hits += 1
+                return entry[3]
+            self.misses += 1
+            saved_path = sys.path[:]
+            sys.path[:] = search_path
+            _serving.active = True
+            try:
+                fp = open(fn, 'rb')
+                try:
+                    actual = md5(fp.read()).hexdigest()
+                finally:
+                    fp.close()
+                if '.' in name:
+                    __import__(name.rsplit('.', 1)[0])
+                imp, doc, text = self._core.expand_file(fn, name)
+            except Exception:
+                return ('error', traceback.format_exc())
+            finally:
+                _serving.active = False
+                sys.path[:] = saved_path
+            deps = tuple(imp.dependencies)
+            reply = ('ok', actual, doc, text, imp.code, deps, imp.lines)
+            self.expansions[(fn, name)] = (actual, deps, _stamps(deps), reply)
+            return reply
+
+def main(argv=None):
+    '''Entry point of "metapython serve"'''
+    from optparse import OptionParser
+    parser = OptionParser(
+        prog='metapython',
+        usage='%prog serve [options]',
+        description='Run an expansion server for the local host.')
+    parser.add_option('-s', '--socket', dest='path', metavar='PATH',
+                      help='listen on the Unix socket PATH (default: %s)'
+                      % default_path())
+    options, args = parser.parse_args(argv)
+    if args:
+        parser.error('unexpected arguments')
+    # Expansion errors must not drop into the debugger and wait on a
+    # terminal
+    sys.stdin = open(os.devnull)
+    server = ExpansionServer(options.path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
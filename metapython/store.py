@@ -0,0 +1,196 @@
+'''Content-addressed store of MetaPython expansions
+
+Where :mod:`metapython.cache` remembers the expansion of a particular file,
+the store remembers expansions by content: an expansion is found again for
+any file with the same text, imported under the same module name, using
+macro modules with the same text, by the same version of metapython.  A
+store shared between checkouts, build agents or hosts (e.g. a directory on a
+shared filesystem) thus expands identical modules, such as ones vendored
+into several services or unchanged between releases, only once.
+
+A module's dependencies are only known once it has been expanded, so
+expansions are recorded in two steps.  A manifest, keyed by the hash of the
+metapython version, the module name and the source text, lists the sets of
+dependencies (as paths relative to the module's file) its expansions have
+had.  Each expansion is keyed by the manifest's key and the hashes of its
+dependencies' text.
+
+Stores implement the small :class:`Store` interface.  The store is off
+unless the ``METAPYTHON_STORE`` environment variable names a directory, in
+which case a :class:`DirectoryStore` rooted there is used.  Use
+:func:`set_store` to install another backend.
+'''
+from __future__ import with_statement
+import os
+import sys
+import socket
+import marshal
+from hashlib import sha1
+from types import CodeType
+
+import metapython
+from metapython import cache
+
+# The most dependency sets a manifest remembers
+MANIFEST_SIZE = 8
+
+class Store(object):
+    '''Interface of the storage backends: a mapping from keys (hex digests)
+    to strings, which may forget entries at any time'''
+
+    def get(self, key):
+        '''Return the data stored under key, or None'''
+        raise NotImplementedError
+
+    def put(self, key, data):
+        '''Store data under key, silently giving up on failure'''
+        raise NotImplementedError
+
+class DirectoryStore(Store):
+    '''Store keeping each entry in a file under the directory root.  Entries
+    are written atomically, so several processes (on several hosts, if root
+    is on a shared filesystem) can use the same directory.'''
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        '''Return the filename of the entry key'''
+        return os.path.join(self.root, key[:2], key[2:])
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as fp:
+                return fp.read()
+        except IOError:
+            return None
+
+    def put(self, key, data):
+        path = self.path(key)
+        tmp_path = '%s.%s.%d.tmp' % (path, socket.gethostname(), os.getpid())
+        try:
+            dirname = os.path.dirname(path)
+            if not os.path.isdir(dirname):
+                try:
+                    os.makedirs(dirname)
+                except OSError:
+                    # Another process may have made it meanwhile
+                    if not os.path.isdir(dirname):
+                        raise
+            with open(tmp_path, 'wb') as fp:
+                fp.write(data)
+            if os.name == 'nt' and os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+def default_store():
+    '''Return the store configured by the environment: a DirectoryStore
+    rooted at $METAPYTHON_STORE, or None if that is unset or empty'''
+    root = os.environ.get('METAPYTHON_STORE')
+    if not root:
+        return None
+    return DirectoryStore(root)
+
+_store = []
+
+def get_store():
+    '''Return the store in use, or None'''
+    if not _store:
+        _store.append(default_store())
+    return _store[0]
+
+def set_store(store):
+    '''Use store (or no store, if None) from now on'''
+    _store[:] = [ store ]
+
+def _read(fn):
+    with open(fn, 'rb') as fp:
+        return fp.read()
+
+def _manifest_key(name, source):
+    return sha1('\0'.join([ cache.MAGIC, metapython.__version__, name,
+                            source ])).hexdigest()
+
+def _expansion_key(manifest_key, fn, rel_deps):
+    '''Return the key of the expansion of the module in fn with the
+    dependencies rel_deps, or None if one of them is missing'''
+    dirname = os.path.dirname(os.path.abspath(fn))
+    h = sha1(manifest_key)
+    for dep in rel_deps:
+        try:
+            h.update(sha1(_read(os.path.join(dirname, dep))).digest())
+        except IOError:
+            return None
+    return h.hexdigest()
+
+def _refile(code, filename):
+    '''Return a copy of code (and the code objects nested in it) compiled
+    from filename'''
+    consts = tuple([ isinstance(c, CodeType) and _refile(c, filename) or c
+                     for c in code.co_consts ])
+    return CodeType(
+        code.co_argcount, code.co_nlocals, code.co_stacksize, code.co_flags,
+        code.co_code, consts, code.co_names, code.co_varnames,
+        filename, code.co_name, code.co_firstlineno, code.co_lnotab,
+        code.co_freevars, code.co_cellvars)
+
+def lookup(fn, name):
+    '''Return the stored expansion of the .mpy file fn as the module name,
+    as a (doc, text, code, dependencies, lines) tuple, or None'''
+    store = get_store()
+    if store is None:
+        return None
+    try:
+        key = _manifest_key(name, _read(fn))
+        manifest = store.get(key)
+        if manifest is None:
+            return None
+        candidates = marshal.loads(manifest)
+        for rel_deps in candidates:
+            expansion_key = _expansion_key(key, fn, rel_deps)
+            if expansion_key is None:
+                continue
+            data = store.get(expansion_key)
+            if data is not None:
+                doc, text, code, lines = marshal.loads(data)
+                break
+        else:
+            return None
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+    if code.co_filename != fn:
+        code = _refile(code, fn)
+    dirname = os.path.dirname(os.path.abspath(fn))
+    deps = tuple(os.path.normpath(os.path.join(dirname, dep))
+                 for dep in rel_deps)
+    return doc, text, code, deps, lines
+
+def save(fn, name, doc, text, code, deps=(), lines=()):
+    '''Store the expansion of the .mpy file fn as the module name (with its
+    line table lines), which depends on the .mpy files deps.  As with the
+    cache, nothing is stored when sys.dont_write_bytecode is set.'''
+    store = get_store()
+    if store is None or getattr(sys, 'dont_write_bytecode', False):
+        return
+    dirname = os.path.dirname(os.path.abspath(fn))
+    rel_deps = tuple(os.path.relpath(dep, dirname) for dep in deps)
+    try:
+        key = _manifest_key(name, _read(fn))
+        expansion_key = _expansion_key(key, fn, rel_deps)
+        if expansion_key is None:
+            return
+        store.put(expansion_key, marshal.dumps((doc, text, code, lines)))
+        try:
+            candidates = marshal.loads(store.get(key) or marshal.dumps([]))
+        except (EOFError, ValueError, TypeError):
+            candidates = []
+        if rel_deps not in candidates:
+            candidates = [ rel_deps ] + candidates[:MANIFEST_SIZE - 1]
+            store.put(key, marshal.dumps(candidates))
+    except IOError:
+        pass
@@ -0,0 +1,238 @@
+'''Tracing of MetaPython module expansion
+
+When tracing is enabled, each module expanded (see
+:meth:`metapython.core.ImportContext.expand`) or loaded from the cache
+produces a :class:`ModuleTrace`, recording the wall time spent in each phase
+of loading it:
+
+``parse``
+    tokenizing and parsing the .mpy source
+``defcode``
+    expanding the defcode blocks
+``quote``
+    quoting the statements of the meta-program
+``meta``
+    running the meta-program
+``pop``
+    collecting the expanded module from the builder
+``compile``
+    compiling the expanded module
+``load``
+    reading an expansion from the cache (instead of all the above)
+``exec``
+    running the expanded module
+
+along with the number of tokens in the source and in the expansion, and the
+number of statements and suites the meta-program appended to its builder.
+Time spent expanding other modules meanwhile (such as macro modules the
+meta-program imports) is only counted for those modules.
+
+Set the ``METAPYTHON_TRACE`` environment variable to enable tracing and
+print a :func:`summary` to stderr at exit.  Unless it is ``1``, it names a
+file to which each trace is also appended, as a line of JSON, as soon as it
+is complete.  Programs can instead call :func:`enable`, and
+:func:`add_listener` to be called with each trace.  While tracing is
+disabled, its cost is a few no-op calls per module.
+'''
+from __future__ import with_statement
+import os
+import sys
+import time
+import atexit
+import threading
+
+PHASES = ('parse', 'defcode', 'quote', 'meta', 'pop', 'compile', 'load',
+          'exec')
+
+enabled = False
+
+# The completed traces, in order of completion
+records = []
+_listeners = []
+_lock = threading.Lock()
+# The traces in progress in each thread (innermost last)
+_local = threading.local()
+
+class ModuleTrace(object):
+    '''The trace of loading one module'''
+
+    def __init__(self, name, filename):
+        self.name = name
+        self.filename = filename
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.tokens_in = self.tokens_out = 0
+        self.appends = self.suites = 0
+        self.total = 0.0
+        self.error = None
+        self._last = time.time()
+        self._paused = None
+
+    def mark(self, phase):
+        '''Count the time since the last mark as spent in phase'''
+        now = time.time()
+        self.phases[phase] += now - self._last
+        self._last = now
+
+    def _pause(self):
+        self._paused = time.time()
+
+    def _resume(self):
+        # Leave out the time spent on the nested trace
+        self._last += time.time() - self._paused
+
+    def as_dict(self):
+        '''Return the trace as a dict (of JSON-compatible values)'''
+        return dict(name=self.name, filename=self.filename,
+                    phases=dict(self.phases), total=self.total,
+                    tokens_in=self.tokens_in, tokens_out=self.tokens_out,
+                    appends=self.appends, suites=self.suites,
+                    error=self.error)
+
+class _NullTrace(object):
+    '''Stands in for a ModuleTrace while tracing is disabled'''
+
+    tokens_in = tokens_out = appends = suites = 0
+
+    def mark(self, phase):
+        pass
+
+_NULL = _NullTrace()
+
+def begin(name, filename):
+    '''Start the trace of loading a module, returning it (or a stand-in
+    ignoring everything if tracing is disabled)'''
+    if not enabled:
+        return _NULL
+    trace = ModuleTrace(name, filename)
+    stack = _stack()
+    if stack:
+        stack[-1]._pause()
+    stack.append(trace)
+    return trace
+
+def end(trace, error=None):
+    '''Complete a trace started by begin, noting the error (an exception)
+    which interrupted loading, if any'''
+    if trace is _NULL:
+        return
+    _pop(trace)
+    trace.total = sum(trace.phases.values())
+    if error is not None:
+        trace.error = '%s: %s' % (type(error).__name__, error)
+    with _lock:
+        records.append(trace)
+        listeners = list(_listeners)
+    for listener in listeners:
+        listener(trace)
+
+def cancel(trace):
+    '''Abandon a trace started by begin, without recording it'''
+    if trace is not _NULL:
+        _pop(trace)
+
+def _pop(trace):
+    stack = _stack()
+    if trace in stack:
+        stack.remove(trace)
+        if stack:
+            stack[-1]._resume()
+
+def current():
+    '''Return the innermost trace in progress in this thread (or the
+    stand-in)'''
+    stack = _stack()
+    if stack:
+        return stack[-1]
+    return _NULL
+
+def _stack():
+    try:
+        return _local.stack
+    except AttributeError:
+        stack = _local.stack = []
+        return stack
+
+def count_tokens(block):
+    '''Return the number of tokens in a parsed block (if tracing)'''
+    if not enabled:
+        return 0
+    return sum(1 for pair in block.pairs())
+
+def enable():
+    '''Start tracing'''
+    global enabled
+    enabled = True
+
+def disable():
+    '''Stop tracing (traces already begun are still completed)'''
+    global enabled
+    enabled = False
+
+def add_listener(listener):
+    '''Call listener with each ModuleTrace as it is completed'''
+    with _lock:
+        _listeners.append(listener)
+
+def remove_listener(listener):
+    '''Stop calling listener'''
+    with _lock:
+        _listeners.remove(listener)
+
+def clear():
+    '''Forget the completed traces'''
+    with _lock:
+        del records[:]
+
+def summary(traces=None):
+    '''Return a table of the time spent in each phase (in milliseconds) and
+    the other counts of each trace (records by default), with their totals'''
+    if traces is None:
+        with _lock:
+            traces = list(records)
+    columns = ('module',) + PHASES + ('total', 'tok in', 'tok out',
+                                      'appends', 'suites')
+    rows = []
+    totals = [0] * (len(columns) - 1)
+    for trace in traces:
+        values = ([ trace.phases[phase] * 1000 for phase in PHASES ]
+                  + [ trace.total * 1000, trace.tokens_in, trace.tokens_out,
+                      trace.appends, trace.suites ])
+        totals = [ t + v for t, v in zip(totals, values) ]
+        name = trace.name
+        if trace.error is not None:
+            name += ' (failed)'
+        rows.append([ name ] + values)
+    rows.append([ 'total (%d)' % len(traces) ] + totals)
+    width = max([ len(columns[0]) ] + [ len(row[0]) for row in rows ])
+    lines = [ columns[0].ljust(width)
+              + ''.join(c.rjust(9) for c in columns[1:]) ]
+    for row in rows:
+        cells = [ '%9.1f' % v for v in row[1:len(PHASES) + 2] ]
+        cells += [ '%9d' % v for v in row[len(PHASES) + 2:] ]
+        lines.append(row[0].ljust(width) + ''.join(cells))
+    return '\n'.join(lines) + '\n'
+
+def dump(fp=None):
+    '''Write the summary of the completed traces to fp (sys.stderr by
+    default)'''
+    if fp is None:
+        fp = sys.stderr
+    fp.write('metapython trace:\n' + summary())
+
+def _log_to(fn):
+    import json
+    def log(trace):
+        with open(fn, 'a') as fp:
+            fp.write(json.dumps(trace.as_dict(), sort_keys=True) + '\n')
+    return log
+
+def _enable_from_environment():
+    setting = os.environ.get('METAPYTHON_TRACE')
+    if not setting:
+        return
+    enable()
+    if setting != '1':
+        add_listener(_log_to(setting))
+    atexit.register(dump)
+
+_enable_from_environment()
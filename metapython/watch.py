@@ -0,0 +1,145 @@
+'''Hot reloading of MetaPython modules
+
+A :class:`Watcher` thread polls the .mpy files of the imported MetaPython
+modules, and of the macro modules they depend on.  When any of them changes,
+it re-expands the affected modules and swaps the new namespaces into the
+existing module objects, so that long-running processes pick up edits
+without a restart.  Modules are re-expanded incrementally (see
+:class:`metapython.parse.ExpansionMemo`) where the ImportContext which
+expanded them has been kept.
+
+Note that, as with the builtin reload, objects created from the old module
+(instances, and functions or classes imported elsewhere with "from")
+keep referring to the old definitions.
+'''
+import sys
+import types
+import threading
+import traceback
+
+from metapython import core
+from metapython import cache
+
+def start(interval=1.0, log=None):
+    '''Start and return a daemon Watcher thread'''
+    watcher = Watcher(interval, log)
+    watcher.start()
+    return watcher
+
+def mpy_modules():
+    '''Return the imported MetaPython modules (leaving out lazy modules which
+    have not been loaded yet, as they will load the current sources)'''
+    return [ module for name, module in sys.modules.items()
+             if isinstance(module, types.ModuleType)
+             and getattr(module, '__file__', '').endswith('.mpy')
+             and core.is_loaded(module) ]
+
+def reload_module(module):
+    '''Re-expand a MetaPython module from its source, and replace the
+    module's namespace with the new one in place.  If the expansion fails,
+    the module is left unchanged.'''
+    name, fn = module.__name__, module.__file__
+    lock = core._module_lock(name)
+    lock.acquire()
+    try:
+        imp = core._contexts.get(name)
+        if imp is None:
+            imp = core.ImportContext(fn, name)
+        stamp = _stamp(fn)
+        doc, text = imp.expand(fn)
+        cache.store(fn, doc, text, imp.code, imp.dependencies, imp.lines,
+                    stamp)
+        namespace = module.__dict__
+        for key in namespace.keys():
+            if (key not in imp.namespace
+                and not (key.startswith('__') and key.endswith('__'))):
+                del namespace[key]
+        namespace.update(imp.namespace)
+        module.__doc__ = doc
+        module.__expanded__ = text
+        module.__mpy_depends__ = tuple(imp.dependencies)
+        module.__mpy_lines__ = imp.lines
+        if core.retain_contexts:
+            core._contexts[name] = imp
+    finally:
+        lock.release()
+
+def _depends(module):
+    return getattr(module, '__mpy_depends__', ())
+
+def _stamp(fn):
+    try:
+        return cache.source_stamp(fn)
+    except OSError:
+        return None
+
+class Watcher(threading.Thread):
+    '''Thread polling the files of the imported MetaPython modules every
+    interval seconds, and reloading the modules affected by changes (see
+    check).  Failures to reload are reported to log (sys.stderr by default)
+    and leave the module as it was.
+
+    Creating a watcher keeps the ImportContexts of modules imported from
+    then on, so that they can be re-expanded incrementally, until it is
+    stopped.'''
+
+    def __init__(self, interval=1.0, log=None):
+        threading.Thread.__init__(self, name='metapython-watcher')
+        self.setDaemon(True)
+        self.interval = interval
+        self.log = log
+        # filename -> stamp when last seen
+        self._stamps = {}
+        self._stopped = threading.Event()
+        # The setting to restore when stopped (None once restored)
+        self._retained = core.retain_contexts
+        core.retain_contexts = True
+
+    def run(self):
+        while not self._stopped.isSet():
+            self.check()
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        '''Stop the watcher thread and wait for it to finish, and stop
+        keeping ImportContexts unless they were kept before it was created'''
+        self._stopped.set()
+        if self.isAlive():
+            self.join()
+        if self._retained is not None:
+            core.retain_contexts, self._retained = self._retained, None
+            if not core.retain_contexts:
+                core._contexts.clear()
+
+    def check(self):
+        '''Reload the modules whose .mpy files, or whose dependencies' files,
+        have changed since they were first seen, returning the modules
+        reloaded.  A module's macro modules are reloaded before it.'''
+        modules = mpy_modules()
+        changed = set()
+        for module in modules:
+            for fn in (module.__file__,) + _depends(module):
+                stamp = _stamp(fn)
+                if fn not in self._stamps:
+                    self._stamps[fn] = stamp
+                elif self._stamps[fn] != stamp:
+                    changed.add(fn)
+        stale = [ module for module in modules
+                  if module.__file__ in changed
+                  or changed.intersection(_depends(module)) ]
+        # Dependencies are transitive, so a module depends on more files
+        # than any of its macro modules
+        stale.sort(key=lambda module: len(_depends(module)))
+        reloaded = []
+        for module in stale:
+            try:
+                reload_module(module)
+            except Exception:
+                log = self.log or sys.stderr
+                log.write('Failed to reload %s:\n%s' % (
+                        module.__name__, traceback.format_exc()))
+            else:
+                reloaded.append(module)
+        for fn in changed:
+            self._stamps[fn] = _stamp(fn)
+        return reloaded
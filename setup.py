@@ -1,7 +1,10 @@
 from setuptools import setup, find_packages
-import sys, os
+import sys, os, re
 
-version = '0.2.1'
+# Read the version from the package, without importing it
+fp = open(os.path.join(os.path.dirname(__file__), 'metapython', '__init__.py'))
+version = re.search(r"^__version__ = '(.*)'", fp.read(), re.M).group(1)
+fp.close()
 
 setup(name='MetaPython',
       version=version,
@@ -34,5 +37,7 @@ definition, expansion, and code instantiation at import-time.
       install_requires=[],
       entry_points="""
       # -*- Entry points: -*-
+      [console_scripts]
+      metapython = metapython.build:main
       """,
       )
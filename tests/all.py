@@ -1,12 +1,32 @@
+from __future__ import with_statement
 import os
+import sys
+import imp
+import time
+import shutil
+import tempfile
+import threading
 import unittest
 
 import metapython
+from metapython import core
+from metapython import cache
+from metapython import build
+from metapython import watch
+from metapython import server
+from metapython import bundle
+from metapython import store
+from metapython import trace
+from metapython import profiler
+from metapython import lines
 from metapython import parse
 from metapython.parse import Builder
 
 from base import MetaPythonTest
 
+# Keep the tests away from the user's expansion store
+store.set_store(None)
+
 class TestCodeQuoting(MetaPythonTest):
 
     def testQuoteSimple(self):
@@ -47,7 +67,7 @@ print 2''')
         print "hi", $i''')
         golden1 = parse.parse_string('''_mpy.push()
 for i in range(10):
-    _mpy.append('print "hi",$i ', globals(), locals())
+    _mpy.append('print "hi", $i', globals(), locals())
 x = _mpy.pop()
 x = x.sanitize(globals(), locals(),)
 ''')
@@ -73,14 +93,17 @@ print "hi", 9''')
         print i''')
         inp1 = inp.expand_defcode_blocks()
         ns = dict(_mpy=Builder())
-        inp1.exec_(ns, ns)
-        self.assertEqualCode(ns['x'], '''for _mpy_1 in range(10):
-    print _mpy_1''')
+        with parse.gensym.scope('quote'):
+            inp1.exec_(ns, ns)
+        with parse.GenSym().scope('quote') as gensym:
+            name = gensym('i')
+        self.assertEqualCode(ns['x'], '''for %s in range(10):
+    print %s''' % (name, name))
 
     def testShortQuote(self):
         inp = parse.parse_string('''foo(?pass)''')
         inp1 = inp.expand_defcode_blocks()
-        self.assertEqualCode(inp1, "foo(_mpy.q('pass '))")
+        self.assertEqualCode(inp1, "foo(_mpy.q('pass'))")
 
 class TestMacro(MetaPythonTest):
 
@@ -121,7 +144,7 @@ defcode result():
         expanded = _mpy.pop()
         expanded.exec_(ns, ns)
         self.assertEqual(str(ns['Point'](1,2)),
-                         'Point (x =1, y =2)')
+                         'Point(x=1, y=2)')
 
 class TestImport(MetaPythonTest):
 
@@ -131,7 +154,7 @@ class TestImport(MetaPythonTest):
     def testNamedTuple(self):
         import test1
         p = test1.Point(1,2)
-        self.assertEqual(str(p), 'Point (x =1, y =2)')
+        self.assertEqual(str(p), 'Point(x=1, y=2)')
 
     def testNested(self):
         import test2
@@ -146,6 +169,300 @@ class TestImport(MetaPythonTest):
         self.assertEqual((f.a, f.b, f.c, f.d),
                          (1,2,3,4))
         
+class TestFastPath(MetaPythonTest):
+
+    def testHasEscapes(self):
+        inp = parse.parse_string('''x = "$not an escape"
+class Foo(object):
+    def bar(self):
+        return $x
+print ?y
+''')
+        self.assertEqual(
+            [ s.has_escapes() for s in inp.statements ],
+            [False, True, True])
+        self.assert_(not parse.parse_string('x = 1').has_escapes())
+        self.assert_(parse.parse_string('''defcode x():
+    pass''').has_escapes())
+
+    def testPassThrough(self):
+        inp = parse.parse_string('''x = 1
+$for i in range(2):
+    y = $i
+class Foo(object):
+    pass''')
+        inp1 = inp.expand()
+        self.assertEqualCode(inp1, '''x = 1
+y = 0
+y = 1
+class Foo(object):
+    pass''')
+        self.assert_(inp1.statements[0] is inp.statements[0])
+        self.assert_(inp1.statements[-1] is inp.statements[-1])
+
+    def testPlainModule(self):
+        imp, doc, text = metapython.expand_string('''"doc"
+def f():
+    return 42
+''')
+        self.assertEqual(doc, '"doc"')
+        self.assertEqual(imp.namespace['f'](), 42)
+
+class TestCodeCache(MetaPythonTest):
+
+    def testLRU(self):
+        c = parse.LRUCache(4)
+        for i in range(4):
+            c.put(i, str(i))
+        self.assertEqual(c.get(0), '0')
+        c.put(4, '4')
+        self.assertEqual(len(c), 4)
+        self.assertEqual(c.get(1), None)
+        self.assertEqual(c.get(0), '0')
+        self.assertEqual(c.stats()['hits'], 2)
+        self.assertEqual(c.stats()['misses'], 1)
+
+    def testExpandHits(self):
+        parse.code_cache.clear()
+        inp = parse.parse_string('''$for i in range(10):
+    print $(i * 2)''')
+        inp1 = inp.expand()
+        self.assertEqualCode(
+            inp1, '\n'.join('print %d' % (i * 2) for i in range(10)))
+        self.assert_(parse.code_cache.hits >= 9)
+
+    def testCompileCached(self):
+        code = parse.compile_cached('x = 1')
+        self.assert_(parse.compile_cached('x = 1') is code)
+
+    def testCompileLocated(self):
+        # Located (module) compiles are kept out of code_cache
+        parse.code_cache.clear()
+        inp = parse.parse_string('x = 1\ny = 2\n')
+        text, code = parse.compile_located(inp, 'located.mpy')
+        self.assertEqual(len(parse.code_cache), 0)
+        self.assert_(parse.compile_located(inp, 'located.mpy')[1] is code)
+        self.assert_(parse.compile_located(inp, 'other.mpy')[1] is not code)
+
+class TestTemplateCache(MetaPythonTest):
+
+    def testTokens(self):
+        toks, escaped = parse.tokens_from_template('print $x\n')
+        self.assert_(escaped)
+        self.assert_(parse.tokens_from_template('print $x\n')[0] is toks)
+        toks, escaped = parse.tokens_from_template('print "$x"\n')
+        self.assert_(not escaped)
+
+    def testMacroCalls(self):
+        parse.template_cache.clear()
+        ns = dict(_mpy=Builder())
+        inp = parse.parse_string('''
+def double(x):
+    defcode result():
+        print $x * 2
+    return result
+''')
+        inp.expand_defcode_blocks().exec_(ns, ns)
+        inp1 = parse.parse_string('''$double(1)
+$double(2)
+$double(3)''')
+        self.assertEqualCode(inp1.expand(ns, ns), '''print 1 * 2
+print 2 * 2
+print 3 * 2''')
+        self.assert_(parse.template_cache.hits >= 2)
+        # Only the template is cached, not the values substituted into it
+        size = parse.template_cache.stats()['size']
+        inp2 = parse.parse_string('$for i in range(50):\n    $double(i)\n')
+        inp2.expand(ns, ns)
+        self.assert_(parse.template_cache.stats()['size'] <= size + 2)
+
+class TestTemplate(MetaPythonTest):
+
+    def testParts(self):
+        tmpl = parse.Template('print "hi", $i, $(j + 1)\n')
+        parts = tmpl.parts()
+        self.assertEqual(
+            [ p.__class__ is tuple for p in parts ],
+            [True, False, True, False, True])
+        self.assertEqual(parse.Template('$: x = 1\n').parts(), None)
+
+    def testBuild(self):
+        ns = dict(i=3, j=4)
+        for text in ('print "hi", $i, $(j + 1)\n',
+                     '$<"x%d" % i> = {$i: $j}\n',
+                     'if $i: pass\n',
+                     '$: k = 5\n'):
+            tmpl = parse.Template(text)
+            golden = parse.parse_stream(
+                parse.expand_macros(parse.tokens_from_string(text), ns, ns))
+            self.assertEqualCode(tmpl.build(ns, ns), golden)
+
+    def testMultilineValue(self):
+        ns = dict(_mpy=Builder())
+        ns['body'] = parse.parse_string('''x = 1
+y = 2''')
+        block = parse.Template('$body\n').build(ns, ns)
+        self.assertEqual(len(block.statements), 2)
+
+class TestTokenBuffer(MetaPythonTest):
+
+    source = '''class Foo(object):
+    def bar(self, x):
+        # comment
+        return (x +
+                self.x)
+foo = Foo()
+'''
+
+    def testRoundTrip(self):
+        toks = list(parse.tokens_from_string(self.source))
+        buf = parse.TokenBuffer(toks)
+        self.assertEqual(len(buf), len(toks))
+        self.assertEqual([ tuple(t) for t in buf ],
+                         [ tuple(t) for t in toks ])
+        self.assertEqual(tuple(buf[-1]), tuple(toks[-1]))
+        self.assertEqual(list(buf.pairs()),
+                         [ (t.token, t.value) for t in toks ])
+        self.assert_(buf.match(0, parse.token.NAME, 'class'))
+        self.assertEqual(len(buf.strings), len(set(t.value for t in toks)))
+
+    def testView(self):
+        buf = parse.TokenBuffer.from_string(self.source)
+        view = buf[1:4]
+        self.assert_(isinstance(view, parse.TokenView))
+        self.assertEqual([ t.value for t in view ], ['Foo', '(', 'object'])
+        self.assertEqual(view[-1].value, 'object')
+        self.assert_(view.match(0, parse.token.NAME, 'Foo'))
+
+    def testParse(self):
+        buf = parse.TokenBuffer.from_string(self.source)
+        block = parse.parse_stream(buf)
+        self.assertEqual(len(block.statements), 2)
+        self.assert_(isinstance(block.statements[1].tokens, parse.TokenView))
+        # The same tokens as parsing a stream of them
+        stream = parse.parse_stream(parse.tokens_from_string(self.source))
+        self.assertEqual([ tuple(t) for t in block ],
+                         [ tuple(t) for t in stream ])
+        self.assertEqual(block.as_python(), stream.as_python())
+        self.assertEqual(list(parse.parse_string(self.source)), list(stream))
+
+    def testParseFile(self):
+        from cStringIO import StringIO
+        block = parse.parse_file(StringIO(self.source))
+        self.assert_(isinstance(block.statements[1].tokens, parse.TokenView))
+        self.assertEqual(block.as_python(),
+                         parse.parse_stream(
+                parse.tokens_from_string(self.source)).as_python())
+
+    def testExpand(self):
+        buf = parse.TokenBuffer.from_string('''$for i in range(3):
+    print $i
+x = 1
+''')
+        self.assertEqualCode(parse.parse_buffer(buf).expand(), '''print 0
+print 1
+print 2
+x = 1''')
+
+class TestEmitter(MetaPythonTest):
+
+    def assertRoundTrip(self, text):
+        self.assertEqual(parse.parse_string(text).as_python(), text)
+
+    def testSpacing(self):
+        self.assertRoundTrip('''from . import x
+@classmethod
+def f(a, b=1, *args, **kw):
+    return -a + b[1:2] * f(*args, k=-1)[0].real
+x = {'a': [1, 2], 'b': lambda y: not y}
+print >> sys.stderr, "%s" % (x,)
+''')
+
+    def testEscapes(self):
+        self.assertRoundTrip('''class $<name>(tuple):
+    x = $y + f($(z * 2), ?q)
+''')
+
+    def testIndent(self):
+        inp = parse.parse_string('''if x:
+  if y:
+          pass
+  z = 1
+w = 2''')
+        self.assertEqual(inp.as_python(), '''if x:
+    if y:
+        pass
+    z = 1
+w = 2
+''')
+
+    def testMemoized(self):
+        inp = parse.parse_string('x = 1')
+        text = inp.as_python()
+        self.assert_(inp.as_python() is text)
+        inp.append('y = 2', {}, {})
+        self.assertEqual(inp.as_python(), 'x = 1\ny = 2\n')
+
+    def testWrite(self):
+        from cStringIO import StringIO
+        inp = parse.parse_string('''for i in range(3):
+    print i''')
+        fp = StringIO()
+        inp.write_python(fp)
+        self.assertEqual(fp.getvalue(), inp.as_python())
+
+class TestLineNumbers(MetaPythonTest):
+
+    def testPassThrough(self):
+        inp = parse.parse_string('''x = 1
+
+
+# comment
+def f():
+    return 1
+''')
+        text, code = parse.compile_located(inp, 'f.mpy')
+        self.assertEqual(text, inp.as_python())
+        ns = {}
+        exec code in ns
+        self.assertEqual(ns['f'].func_code.co_filename, 'f.mpy')
+        self.assertEqual(ns['f'].func_code.co_firstlineno, 5)
+
+    def testGenerated(self):
+        ns = dict(_mpy=Builder())
+        parse.parse_string('''
+def seti(value):
+    defcode result(?i):
+        i = $value
+        i += 1
+    return result
+''').expand_defcode_blocks().exec_(ns, ns)
+        inp = parse.parse_string('''x = 1
+
+$seti(5)
+def g():
+    pass
+''')
+        out = inp.expand(ns, ns)
+        self.assertEqual([ s.lineno() for s in out.statements ],
+                         [1, 3, 3, 4])
+        code = out.compile('exec', 'g.mpy')
+        exec code in ns
+        self.assertEqual(ns['i'], 6)
+        self.assertEqual(ns['g'].func_code.co_firstlineno, 4)
+
+    def testSyntaxError(self):
+        inp = parse.parse_string('''x = 1
+
+y = = 2
+''')
+        try:
+            parse.compile_located(inp, 'e.mpy')
+        except SyntaxError, se:
+            self.assertEqual(se.lineno, 3)
+        else:
+            self.fail('SyntaxError not raised')
+
 class TestHygiene(MetaPythonTest):
 
     def testReplaceName(self):
@@ -165,6 +482,42 @@ class TestHygiene(MetaPythonTest):
         self.assert_('j' not in str(inp1))
         self.assert_('i' in str(inp1))
 
+    def testLocalNames(self):
+        inp = parse.parse_string('''from operator import itemgetter as ig
+import os.path, sys
+global g
+g = 1
+x, (y, z[0]), w.v = 1, (2, 3), 4
+a = b = [q for q in range(3)]
+f(k=1)
+n += 1
+for i, j in []:
+    pass
+try:
+    pass
+except E, e:
+    pass
+def fn(arg):
+    inner = 1
+class C:
+    attr = 2
+''')
+        bound, fixed = inp.local_names()
+        self.assertEqual(
+            sorted(bound),
+            ['C', 'a', 'b', 'e', 'fn', 'g', 'i', 'ig', 'j', 'n', 'os', 'q',
+             'sys', 'x', 'y'])
+        self.assertEqual(sorted(fixed), ['g', 'os'])
+
+    def testSanitizeImport(self):
+        inp = parse.parse_string('''from operator import itemgetter
+x = itemgetter(0)''')
+        inp1 = inp.sanitize({}, {})
+        ns = {}
+        inp1.exec_(ns, ns)
+        self.assert_('itemgetter' not in ns)
+        self.assertEqual(len(ns) - 1, 2)
+
     def testAutoSanitize(self):
         inp = parse.parse_string('''
 defcode result(?i):
@@ -217,5 +570,1091 @@ def seti(value):
         inp3 = inp2.expand(ns, ns)
         self.assertEqualCode(inp3, 'i=5')
 
+class TestGenSym(MetaPythonTest):
+
+    source = '''
+$:
+    def setj(value):
+        defcode result():
+            j = $value
+        return result
+
+$setj(1)
+$setj(2)
+'''
+
+    def names(self, text):
+        return [ line.split()[0] for line in text.splitlines() if line ]
+
+    def testReproducible(self):
+        text0 = core.expand_string(self.source)[2]
+        for i in range(3):
+            parse.gensym()
+        core.expand_string(self.source.replace('(1)', '(0)\n$setj(3)'))
+        text1 = core.expand_string(self.source)[2]
+        self.assertEqual(text0, text1)
+
+    def testUnique(self):
+        text = core.expand_string(self.source + '$setj(3)\n')[2]
+        names = self.names(text)
+        self.assertEqual(len(names), 3)
+        self.assertEqual(len(set(names)), 3)
+        # Editing or moving macro calls does not rename the others
+        text1 = core.expand_string('x = 1\n\n' + self.source)[2]
+        self.assertEqual(self.names(text1)[1:], names[:2])
+        text2 = core.expand_string(
+            self.source.replace('$setj(1)', '$setj(0)'))[2]
+        names2 = self.names(text2)
+        self.assertNotEqual(names2[0], names[0])
+        self.assertEqual(names2[1], names[1])
+
+    def testScope(self):
+        with parse.gensym.scope('a') as gensym:
+            a = gensym('x')
+            with gensym.scope('b'):
+                b = gensym('x')
+            self.assertNotEqual(gensym('x'), a)
+        with parse.gensym.scope('a') as gensym:
+            self.assertEqual(gensym('x'), a)
+        self.assertNotEqual(a, b)
+
+class TestThreads(MetaPythonTest):
+
+    def run_threads(self, func, n=4):
+        results, errors = [None] * n, []
+        def run(i):
+            try:
+                results[i] = func(i)
+            except Exception, ex:
+                errors.append(ex)
+        threads = [ threading.Thread(target=run, args=(i,))
+                    for i in range(n) ]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        self.assertEqual(errors, [])
+        return results
+
+    def testBuilder(self):
+        ns = dict(_mpy=Builder())
+        parse.parse_string('''
+import time
+def slow(value):
+    defcode result():
+        j = $value
+    time.sleep(0.01)
+    return result
+''').expand_defcode_blocks().exec_(ns, ns)
+        def expand(i):
+            with parse.gensym.scope('m'):
+                return str(parse.parse_string(
+                        '$slow(%d)\n$slow(%d)' % (i, i)).expand(ns, ns))
+        results = self.run_threads(expand)
+        for i, result in enumerate(results):
+            self.assertEqual(result, expand(i))
+        self.assertEqual(ns['_mpy'].stack, [])
+
+    def testImportOnce(self):
+        tmpdir = tempfile.mkdtemp()
+        fn = os.path.join(tmpdir, 'threaded.mpy')
+        fp = open(fn, 'w')
+        fp.write('''$:
+    import sys, time
+    sys.mpy_expansions = getattr(sys, 'mpy_expansions', 0) + 1
+    time.sleep(0.05)
+x = 1
+''')
+        fp.close()
+        try:
+            modules = self.run_threads(
+                lambda i: core.import_file(fn, 'threaded'))
+            self.assertEqual(sys.mpy_expansions, 1)
+            for mod in modules:
+                self.assert_(mod is sys.modules['threaded'])
+            self.assertEqual(mod.x, 1)
+        finally:
+            sys.modules.pop('threaded', None)
+            del sys.mpy_expansions
+            shutil.rmtree(tmpdir)
+
+    def testNestedPlainImport(self):
+        tmpdir = tempfile.mkdtemp()
+        fp = open(os.path.join(tmpdir, 'slowmac.mpy'), 'w')
+        fp.write('''$:
+    import sys, time
+    sys.mpy_expanding.set()
+    time.sleep(0.1)
+x = 1
+''')
+        fp.close()
+        fp = open(os.path.join(tmpdir, 'plainouter.py'), 'w')
+        fp.write('import slowmac\nX = 1\n')
+        fp.close()
+        metapython.install_import_hook()
+        sys.path.insert(0, tmpdir)
+        sys.mpy_expanding = threading.Event()
+        try:
+            def run(i):
+                if i:
+                    # Import the plain module while the first thread is
+                    # expanding the .mpy module it imports
+                    sys.mpy_expanding.wait(5)
+                import plainouter
+                return hasattr(plainouter, 'X')
+            self.assertEqual(self.run_threads(run, 2), [True, True])
+        finally:
+            sys.path.remove(tmpdir)
+            for name in ('slowmac', 'plainouter'):
+                sys.modules.pop(name, None)
+            del sys.mpy_expanding
+            shutil.rmtree(tmpdir)
+
+class TestIncremental(MetaPythonTest):
+
+    source = '''$:
+    from metapython.parse import pure
+    @pure
+    def setj(value):
+        defcode result():
+            j = $value
+        return result
+$setj(1)
+def f():
+    return 1
+$setj(2)
+'''
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.dir, 'incr.mpy')
+        self.imp = core.ImportContext(self.fn)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def expand(self, text):
+        fp = open(self.fn, 'w')
+        fp.write(text)
+        fp.close()
+        result = self.imp.expand(self.fn)[1]
+        self.assertEqual(result, core.expand_file(self.fn)[2])
+        return result
+
+    def testReuse(self):
+        self.expand(self.source)
+        self.assertEqual(self.imp.memo.reused, 0)
+        text = self.expand(self.source.replace(
+                'return 1', '# comment\n    return 2'))
+        self.assert_('return 2' in text)
+        self.assertEqual(self.imp.memo.reused, 2)
+        self.assertEqual(self.imp.memo.expanded, 1)
+        self.assertEqual(self.imp.namespace['f'](), 2)
+        # Reused output is placed at the statement's new line, leaving the
+        # remembered statements where they were
+        self.assertEqual(self.imp.lines,
+                         ((8, (self.fn, 6)), (9, None), (10, None),
+                          (11, None), (11, None), (12, (self.fn, 6))))
+        origins = [ stmt.origin for output in self.imp.memo.outputs.values()
+                    for stmt in output ]
+        self.assertEqual(sorted(origins), [8, 11])
+
+    def testImpure(self):
+        # Macros are only reused if declared pure
+        self.expand(self.source.replace('@pure', ''))
+        self.expand(self.source.replace('@pure', '').replace(
+                'return 1', 'return 2'))
+        self.assertEqual(self.imp.memo.reused, 0)
+
+    def testImplicitInputs(self):
+        # Calls passing values computed by the meta-program are re-run
+        source = self.source.replace('$setj(2)', '''$:
+    import os
+    value = int(os.environ['MPY_TEST_VALUE'])
+$setj(value)''')
+        os.environ['MPY_TEST_VALUE'] = '2'
+        try:
+            self.expand(source)
+            os.environ['MPY_TEST_VALUE'] = '3'
+            self.expand(source)
+        finally:
+            del os.environ['MPY_TEST_VALUE']
+        self.assertEqual(self.imp.memo.reused, 1)
+        self.assert_(3 in self.imp.namespace.values())
+
+    def testStateChange(self):
+        self.expand(self.source)
+        self.expand(self.source.replace('$value', '$value + 1'))
+        self.assertEqual(self.imp.memo.reused, 0)
+        self.assertEqual(self.imp.memo.expanded, 3)
+        self.assertEqual(self.imp.namespace.values().count(3), 1)
+
+    def testSideEffects(self):
+        source = '''$for i in range(2):
+    x = $i
+'''
+        self.expand(source)
+        self.expand(source + 'y = 1\n')
+        self.assertEqual(self.imp.memo.reused, 0)
+        self.assertEqual(self.imp.namespace['x'], 1)
+
+class CacheFixture(object):
+    '''Temporary directory holding the module "cached", for the tests of
+    the cache and of the tools built on it'''
+
+    source = """'''Cached module'''
+values = []
+$for i in range(3):
+    values.append($i)
+"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.dir, 'cached.mpy')
+        self.write(self.source)
+        self.dont_write_bytecode = getattr(sys, 'dont_write_bytecode', False)
+        sys.dont_write_bytecode = False
+
+    def tearDown(self):
+        sys.dont_write_bytecode = self.dont_write_bytecode
+        sys.modules.pop('cached', None)
+        shutil.rmtree(self.dir)
+
+    def write(self, text):
+        fp = open(self.fn, 'w')
+        fp.write(text)
+        fp.close()
+
+    def import_(self):
+        sys.modules.pop('cached', None)
+        return core.import_file(self.fn)
+
+    def import_fresh(self):
+        '''Import "cached" in a fresh interpreter, returning the repr of its
+        docstring and whether the parser was loaded'''
+        import subprocess
+        root = os.path.dirname(os.path.dirname(os.path.abspath(
+                    metapython.__file__)))
+        env = dict(os.environ, PYTHONPATH=root, METAPYTHON_STORE='',
+                   METAPYTHON_SERVER='')
+        script = '''import sys
+import metapython
+metapython.install_import_hook()
+import cached
+print repr(cached.__doc__), 'metapython.parse' in sys.modules
+'''
+        child = subprocess.Popen([sys.executable, '-c', script], cwd=self.dir,
+                                 env=env, stdout=subprocess.PIPE)
+        return child.communicate()[0]
+
+class TestCache(CacheFixture, MetaPythonTest):
+
+    def testStore(self):
+        mod = self.import_()
+        self.assert_(os.path.exists(cache.cache_path(self.fn)))
+        doc, text, code, deps, table = cache.load(self.fn)
+        self.assertEqual(doc, mod.__doc__)
+        self.assertEqual(text, mod.__expanded__)
+        self.assertEqual(deps, ())
+
+    def testHit(self):
+        mod0 = self.import_()
+        def fail(fn, name=None):
+            raise AssertionError('cache miss')
+        expand_file = core.expand_file
+        core.expand_file = fail
+        try:
+            mod1 = self.import_()
+        finally:
+            core.expand_file = expand_file
+        self.assertEqual(mod1.__doc__, "'''Cached module'''")
+        self.assertEqual(mod1.values, [0, 1, 2])
+        self.assertEqual(mod1.__expanded__, mod0.__expanded__)
+
+    def testNamespace(self):
+        self.write('''$import os
+$:
+    n = 2
+values = range($n)
+''')
+        cold = self.import_()
+        warm = self.import_()
+        self.assertEqual(sorted(dir(cold)), sorted(dir(warm)))
+        self.assert_('n' not in dir(cold) and 'os' not in dir(cold))
+
+    def testEditedWhileExpanding(self):
+        expand_file = core.expand_file
+        def edit(fn, name=None):
+            result = expand_file(fn, name)
+            self.write(self.source + 'edited = True\n')
+            os.utime(self.fn, (0, 0))
+            return result
+        core.expand_file = edit
+        try:
+            self.import_()
+        finally:
+            core.expand_file = expand_file
+        # The expansion of the old text is not taken for the new one
+        self.assertEqual(cache.load(self.fn), None)
+        self.assert_(self.import_().edited)
+
+    def testMetaNames(self):
+        # Names imported at import time are not visible at run time, whether
+        # or not the module is loaded from the cache
+        self.write('''$import os
+sep = os.sep
+''')
+        self.assertRaises(NameError, self.import_)
+        self.write('''$import os
+import os
+sep = os.sep
+''')
+        self.assertEqual(self.import_().sep, os.sep)
+        self.assertEqual(self.import_().sep, os.sep)
+
+    def testStartup(self):
+        mod = self.import_()
+        # A fresh interpreter importing the cached module never loads the
+        # parser
+        self.assertEqual(self.import_fresh(), '%r False\n' % mod.__doc__)
+
+    def testStale(self):
+        self.import_()
+        self.write(self.source.replace('range(3)', 'range(4)'))
+        self.assertEqual(cache.load(self.fn), None)
+        mod = self.import_()
+        self.assertEqual(mod.values, [0, 1, 2, 3])
+
+class TestBuild(MetaPythonTest):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.pkg = os.path.join(self.dir, 'buildpkg')
+        os.mkdir(self.pkg)
+        self.write('__init__.py', '')
+        self.write('macros.mpy', '''
+def setx(value):
+    defcode result(?x):
+        x = $value
+    return result
+''')
+        self.write('user.mpy', '''$from buildpkg.macros import setx
+$setx(42)
+''')
+        self.path = list(sys.path)
+
+    def tearDown(self):
+        sys.path[:] = self.path
+        for name in sys.modules.keys():
+            if name.startswith('buildpkg'):
+                del sys.modules[name]
+        shutil.rmtree(self.dir)
+
+    def write(self, name, text):
+        fp = open(os.path.join(self.pkg, name), 'w')
+        fp.write(text)
+        fp.close()
+
+    def build(self, **kw):
+        from cStringIO import StringIO
+        log = StringIO()
+        failed = build.build([self.dir], jobs=1, log=log, **kw)
+        return failed, log.getvalue().splitlines()
+
+    def testBuild(self):
+        failed, log = self.build(compile_pyc=True)
+        self.assertEqual(failed, 0)
+        self.assertEqual(log[-1].split(',')[:2], ['2 built', ' 0 up to date'])
+        out_fn = os.path.join(self.pkg, 'user.py')
+        self.assertEqual(build.read_dependencies(out_fn),
+                         [ os.path.join(self.pkg, 'macros.mpy') ])
+        self.assert_(os.path.exists(out_fn + 'c'))
+        ns = {}
+        execfile(out_fn, ns)
+        self.assertEqual(ns['x'], 42)
+
+    def testSkip(self):
+        self.build()
+        failed, log = self.build()
+        self.assertEqual(log[-1].split(',')[:2], ['0 built', ' 2 up to date'])
+        # Changing the macros rebuilds their users
+        later = time.time() + 10
+        os.utime(os.path.join(self.pkg, 'macros.mpy'), (later, later))
+        failed, log = self.build()
+        self.assertEqual(log[-1].split(',')[:2], ['2 built', ' 0 up to date'])
+
+    def testBuildDir(self):
+        out = os.path.join(self.dir, 'out')
+        failed, log = self.build(build_dir=out)
+        self.assert_(os.path.exists(
+                os.path.join(out, 'buildpkg', 'user.py')))
+        self.assert_(not os.path.exists(os.path.join(self.pkg, 'user.py')))
+
+    def testFailure(self):
+        from cStringIO import StringIO
+        # A failing meta-program is reported with its error, without
+        # stopping in the debugger
+        self.write('broken.mpy', '$(x = )\n')
+        log = StringIO()
+        sys.stdout, stdout = log, sys.stdout
+        try:
+            status = build.build([self.dir], jobs=1, log=log)
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(status, 1)
+        self.assert_('FAILED' in log.getvalue())
+        self.assert_('SyntaxError' in log.getvalue())
+        self.assert_('(Pdb)' not in log.getvalue())
+        self.assert_(parse.debug_on_error)
+        self.assert_(os.path.exists(os.path.join(self.pkg, 'user.py')))
+
+class TestBundle(TestBuild):
+
+    def setUp(self):
+        TestBuild.setUp(self)
+        self.bundle_fn = os.path.join(self.dir, 'app.bundle')
+        self.meta_path = list(sys.meta_path)
+
+    def tearDown(self):
+        sys.meta_path[:] = self.meta_path
+        TestBuild.tearDown(self)
+
+    def testImport(self):
+        from cStringIO import StringIO
+        self.assertEqual(build.build_bundle([self.pkg], self.bundle_fn,
+                                            log=StringIO()), 0)
+        # The bundle needs neither the sources nor the expander
+        os.remove(os.path.join(self.pkg, 'user.mpy'))
+        os.remove(os.path.join(self.pkg, 'macros.mpy'))
+        sys.path.insert(0, self.dir)
+        b = bundle.install(self.bundle_fn)
+        try:
+            self.assertEqual(b.names(), ['buildpkg.macros', 'buildpkg.user'])
+            def fail(fn, name=None):
+                raise AssertionError('expanded')
+            expand_file = core.expand_file
+            core.expand_file = fail
+            try:
+                from buildpkg import user
+            finally:
+                core.expand_file = expand_file
+            self.assertEqual(user.x, 42)
+            self.assert_(user.__loader__ is b)
+            self.assertEqual(user.__mpy_depends__,
+                             (os.path.join(self.pkg, 'macros.mpy'),))
+            self.assertEqual(len(lines.line_table(user)),
+                             len(user.__expanded__.splitlines()))
+        finally:
+            b.close()
+
+    def testFailure(self):
+        from cStringIO import StringIO
+        self.write('broken.mpy', '$(x = )\n')
+        log = StringIO()
+        sys.stdout, stdout = log, sys.stdout
+        try:
+            status = build.build_bundle([self.dir], self.bundle_fn, log=log)
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(status, 1)
+        self.assert_('SyntaxError' in log.getvalue())
+        self.assert_('(Pdb)' not in log.getvalue())
+        self.assert_(parse.debug_on_error)
+        self.assert_(not os.path.exists(self.bundle_fn))
+
+    def testBadBundle(self):
+        fp = open(self.bundle_fn, 'wb')
+        fp.write('not a bundle')
+        fp.close()
+        self.assertRaises(ImportError, bundle.Bundle, self.bundle_fn)
+
+class DependenciesFixture(CacheFixture):
+    '''CacheFixture in which "cached" uses the macro module "cachemacros"'''
+
+    macros = '''from metapython.parse import pure
+@pure
+def setx(value):
+    defcode result(?x):
+        x = $value
+    return result
+'''
+
+    source = '''$import cachemacros
+$(cachemacros.setx(42))
+'''
+
+    def setUp(self):
+        CacheFixture.setUp(self)
+        self.macros_fn = os.path.join(self.dir, 'cachemacros.mpy')
+        self.write_macros(self.macros)
+        sys.path.insert(0, self.dir)
+        core.install_import_hook()
+        core.MetaImporter.invalidate_caches()
+
+    def tearDown(self):
+        sys.path.remove(self.dir)
+        sys.modules.pop('cachemacros', None)
+        CacheFixture.tearDown(self)
+
+    def write_macros(self, text):
+        fp = open(self.macros_fn, 'w')
+        fp.write(text)
+        fp.close()
+
+class TestDependencies(DependenciesFixture, MetaPythonTest):
+
+    def testStore(self):
+        mod = self.import_()
+        self.assertEqual(mod.x, 42)
+        self.assertEqual(mod.__mpy_depends__, (self.macros_fn,))
+        self.assertEqual(cache.load(self.fn)[3], (self.macros_fn,))
+        self.assertEqual(cache.dependencies(self.fn), (self.macros_fn,))
+
+    def testHit(self):
+        self.import_()
+        mod = self.import_()
+        self.assertEqual(mod.__mpy_depends__, (self.macros_fn,))
+
+    def testStartup(self):
+        self.import_()
+        # Checking the macro module's stamp doesn't load the parser either
+        self.assertEqual(self.import_fresh(), 'None False\n')
+
+    def testStale(self):
+        self.import_()
+        fns = [ self.fn, self.macros_fn ]
+        self.assertEqual(cache.stale(fns), [])
+        self.assertEqual(cache.dependents(self.macros_fn, fns), [self.fn])
+        # Changing the macros invalidates the user's expansion
+        self.write_macros(self.macros.replace('$value', '$value + 1'))
+        self.assertEqual(cache.load(self.fn), None)
+        self.assertEqual(cache.stale(fns), fns)
+        sys.modules.pop('cachemacros')
+        mod = self.import_()
+        self.assertEqual(mod.x, 43)
+
+    def testImportedPackage(self):
+        pkg = os.path.join(self.dir, 'cachepkg')
+        os.mkdir(pkg)
+        open(os.path.join(pkg, '__init__.py'), 'w').close()
+        macros_fn = os.path.join(pkg, 'macros.mpy')
+        fp = open(macros_fn, 'w')
+        fp.write(self.macros)
+        fp.close()
+        self.write('$import cachepkg.macros\n$(cachepkg.macros.setx(42))\n')
+        try:
+            # The macros are already imported when the module is expanded
+            __import__('cachepkg.macros')
+            mod = self.import_()
+            self.assertEqual(mod.__mpy_depends__, (macros_fn,))
+            fp = open(macros_fn, 'w')
+            fp.write(self.macros.replace('$value', '$value + 1'))
+            fp.close()
+            self.assertEqual(cache.load(self.fn), None)
+        finally:
+            for name in ('cachepkg', 'cachepkg.macros'):
+                sys.modules.pop(name, None)
+
+class TestLazy(DependenciesFixture, MetaPythonTest):
+
+    def setUp(self):
+        DependenciesFixture.setUp(self)
+        core.install_import_hook(lazy=True)
+
+    def tearDown(self):
+        core.lazy_imports = False
+        DependenciesFixture.tearDown(self)
+
+    def import_(self):
+        mod = DependenciesFixture.import_(self)
+        self.assert_(not core.is_loaded(mod))
+        core.load_lazy(mod)
+        return mod
+
+    def testLazy(self):
+        mod = core.import_file(self.fn)
+        self.assert_(isinstance(mod, core.LazyModule))
+        self.assert_(sys.modules['cached'] is mod)
+        self.assert_(not core.is_loaded(mod))
+        self.assert_('cachemacros' not in sys.modules)
+        self.assertEqual(mod.x, 42)
+        self.assert_(core.is_loaded(mod))
+        self.assertEqual(mod.__mpy_depends__, (self.macros_fn,))
+        # The meta-program's own imports are not lazy
+        self.assert_(core.is_loaded(sys.modules['cachemacros']))
+        self.assertRaises(AttributeError, getattr, mod, 'y')
+
+    def testError(self):
+        import traceback
+        self.write('x = 1\ny = 1 / 0\n')
+        mod = core.import_file(self.fn)
+        for i in range(2):
+            try:
+                mod.y
+            except ZeroDivisionError:
+                fn, lineno = traceback.extract_tb(sys.exc_info()[2])[-1][:2]
+                self.assertEqual((fn, lineno), (self.fn, 2))
+            else:
+                self.fail('no error')
+        self.assert_(not core.is_loaded(mod))
+
+    def testSyntaxError(self):
+        self.write('x = 1\ny = = 2\n')
+        mod = core.import_file(self.fn)
+        try:
+            mod.x
+        except SyntaxError, e:
+            self.assertEqual((e.filename, e.lineno), (self.fn, 2))
+        else:
+            self.fail('no error')
+
+class TickingClock(object):
+    '''Stands in for the time module: each call to time() advances it by one
+    second, so that a phase takes time if and only if it is marked'''
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        self.now += 1
+        return self.now
+
+class TestTrace(DependenciesFixture, MetaPythonTest):
+
+    expand_phases = ('parse', 'defcode', 'quote', 'meta', 'pop', 'compile')
+
+    def setUp(self):
+        DependenciesFixture.setUp(self)
+        trace.clear()
+        trace.enable()
+        trace.time = TickingClock()
+
+    def tearDown(self):
+        trace.time = time
+        trace.disable()
+        trace.clear()
+        DependenciesFixture.tearDown(self)
+
+    def testPhases(self):
+        # Running the macro module takes a long time
+        self.write_macros(self.macros + '''
+from metapython import trace
+trace.time.now += 1000
+''')
+        self.import_()
+        # The macros finish expanding first; their time is not counted for
+        # the module importing them
+        macros, cached = trace.records
+        self.assertEqual((macros.name, cached.name), ('cachemacros', 'cached'))
+        self.assert_(macros.phases['exec'] > 1000)
+        self.assert_(cached.total < 1000)
+        self.assert_(cached.tokens_in > 0 and cached.tokens_out > 0)
+        self.assertEqual(cached.appends, 2)
+        self.assertEqual(cached.total, sum(cached.phases.values()))
+        self.assertEqual(
+            [ phase for phase in trace.PHASES if cached.phases[phase] ],
+            list(self.expand_phases) + ['exec'])
+
+    def testCacheHit(self):
+        self.import_()
+        traces = []
+        trace.add_listener(traces.append)
+        try:
+            self.import_()
+        finally:
+            trace.remove_listener(traces.append)
+        self.assertEqual([ t.name for t in traces ], ['cached'])
+        # Loading from the cache skips the expansion phases
+        self.assertEqual(
+            [ phase for phase in trace.PHASES if traces[0].phases[phase] ],
+            ['load', 'exec'])
+        summary = trace.summary().splitlines()
+        self.assertEqual(len(summary), 5)
+        self.assert_(summary[-1].startswith('total (3)'))
+
+    def testError(self):
+        self.write('x = = 1\n')
+        self.assertRaises(SyntaxError, self.import_)
+        self.assertEqual(trace.records[-1].name, 'cached')
+        self.assert_(trace.records[-1].error.startswith('SyntaxError: '))
+        self.assertEqual(trace.current(), trace._NULL)
+
+    def testDisabled(self):
+        trace.disable()
+        self.import_()
+        self.assertEqual(trace.records, [])
+
+class TestProfiler(DependenciesFixture, MetaPythonTest):
+
+    nested = '''
+def twice(value):
+    defcode result(?x, ?y):
+        $setx(value)
+        y = $value
+    return result
+'''
+
+    def setUp(self):
+        DependenciesFixture.setUp(self)
+        profiler.clear()
+        profiler.enable()
+
+    def tearDown(self):
+        profiler.disable()
+        profiler.clear()
+        DependenciesFixture.tearDown(self)
+
+    def testProfile(self):
+        import json
+        from cStringIO import StringIO
+        self.write_macros(self.macros + self.nested)
+        self.write('$import cachemacros\n$(cachemacros.twice(3))\n')
+        mod = self.import_()
+        self.assertEqual((mod.x, mod.y), (3, 3))
+        stats = dict((s.name, s) for s in profiler.stats())
+        # $value is not a macro call
+        self.assertEqual(sorted(stats),
+                         ['cachemacros.setx', 'cachemacros.twice'])
+        twice, setx = stats['cachemacros.twice'], stats['cachemacros.setx']
+        self.assertEqual((twice.calls, setx.calls), (1, 1))
+        self.assertAlmostEqual(twice.self_time + setx.cumulative,
+                               twice.cumulative, 9)
+        self.assertEqual(setx.tokens_in, len('$ setx ( value )'.split()))
+        self.assertEqual(setx.tokens_out, len('x = 3'.split()))
+        self.assertEqual(setx.ratio, 0.6)
+        report = profiler.report().splitlines()
+        self.assertEqual(len(report), 3)
+        self.assert_(report[1].split()[0] in stats)
+        fp = StringIO()
+        profiler.write_json(fp)
+        data = json.loads(fp.getvalue())
+        self.assertEqual([ d['name'] for d in data ],
+                         [ s.name for s in profiler.stats() ])
+
+    def testResolved(self):
+        # Calls are counted for the function called, whatever its name at
+        # the call site
+        self.write('''$import cachemacros
+$from cachemacros import setx as assign
+$(assign(1))
+$:
+    def setx(value):
+        return cachemacros.setx(value + 1)
+$setx(2)
+''')
+        self.assertEqual(self.import_().x, 3)
+        stats = dict((s.name, s.calls) for s in profiler.stats())
+        self.assertEqual(stats, {'cachemacros.setx': 1, 'cached.setx': 1})
+
+    def testDisabled(self):
+        profiler.disable()
+        self.import_()
+        self.assertEqual(profiler.stats(), [])
+
+class TestLines(DependenciesFixture, MetaPythonTest):
+
+    source = '''"""Module"""
+$import cachemacros
+
+$(cachemacros.setx(42))
+def f():
+    return (x +
+            1)
+'''
+
+    def testTable(self):
+        mod = self.import_()
+        self.assertEqual(mod.__expanded__.splitlines(),
+                         ['"""Module"""', 'x = 42', 'def f():',
+                          '    return (x + 1)'])
+        self.assertEqual(lines.line_table(mod), (1, 4, 5, 6))
+        self.assertEqual(lines.source_line(mod, 2), 4)
+        self.assertEqual(lines.expanded_lines(mod, 6), [4])
+        # The same from the cache
+        self.assertEqual(lines.line_table(self.import_()), (1, 4, 5, 6))
+
+    def testDefinition(self):
+        mod = self.import_()
+        # x = 42 comes from the defcode block of cachemacros.setx
+        self.assertEqual(lines.definition(mod, 2), (self.macros_fn, 5))
+        self.assertEqual(lines.definition(mod, 3), None)
+        self.assertEqual(lines.definition(self.import_(), 2),
+                         (self.macros_fn, 5))
+
+    def testUnordered(self):
+        # Code objects cannot go back to earlier lines, but the line table
+        # can
+        block = parse.parse_string('x = 1\ny = 2\n')
+        block.statements[0].origin = 5
+        block.statements[1].origin = 3
+        table = []
+        text, code = parse.compile_located(block, 'unordered.mpy',
+                                           lines=table)
+        self.assertEqual(table, [(5, None), (3, None)])
+        self.assertEqual(code.co_firstlineno, 5)
+
+    def testRegister(self):
+        import linecache
+        mod = self.import_()
+        self.assertEqual(lines.register(mod), [ lines.expanded_filename(mod) ])
+        linecache.checkcache()
+        self.assertEqual(linecache.getline(lines.expanded_filename(mod), 2),
+                         'x = 42\n')
+
+class TestStore(DependenciesFixture, MetaPythonTest):
+
+    def setUp(self):
+        DependenciesFixture.setUp(self)
+        self.store = store.DirectoryStore(os.path.join(self.dir, 'store'))
+        store.set_store(self.store)
+
+    def tearDown(self):
+        store.set_store(None)
+        DependenciesFixture.tearDown(self)
+
+    def import_without_expanding(self, fn):
+        sys.modules.pop('cached', None)
+        def fail(fn, name=None):
+            raise AssertionError('expanded')
+        expand_file = core.expand_file
+        core.expand_file = fail
+        try:
+            return core.import_file(fn)
+        finally:
+            core.expand_file = expand_file
+
+    def testShared(self):
+        self.import_()
+        # A copy elsewhere (with its macros) is not expanded again
+        other = os.path.join(self.dir, 'vendored')
+        os.mkdir(other)
+        fn = os.path.join(other, 'cached.mpy')
+        shutil.copy(self.fn, fn)
+        shutil.copy(self.macros_fn, other)
+        mod = self.import_without_expanding(fn)
+        self.assertEqual(mod.x, 42)
+        self.assertEqual(mod.__mpy_depends__,
+                         (os.path.join(other, 'cachemacros.mpy'),))
+        self.assertNotEqual(cache.load(fn), None)
+        self.assertEqual(cache.load(fn)[2].co_filename, fn)
+
+    def testDependencies(self):
+        self.import_()
+        self.write_macros(self.macros.replace('$value', '$value + 1'))
+        sys.modules.pop('cachemacros')
+        self.assertEqual(store.lookup(self.fn, 'cached'), None)
+        self.assertEqual(self.import_().x, 43)
+        # Both expansions are kept
+        self.write_macros(self.macros)
+        os.remove(cache.cache_path(self.fn))
+        self.assertEqual(self.import_without_expanding(self.fn).x, 42)
+
+    def testModuleName(self):
+        self.import_()
+        self.assertNotEqual(store.lookup(self.fn, 'cached'), None)
+        self.assertEqual(store.lookup(self.fn, 'other'), None)
+
+    def testOptIn(self):
+        saved = os.environ.pop('METAPYTHON_STORE', None)
+        try:
+            self.assertEqual(store.default_store(), None)
+            os.environ['METAPYTHON_STORE'] = ''
+            self.assertEqual(store.default_store(), None)
+            os.environ['METAPYTHON_STORE'] = self.store.root
+            self.assertEqual(store.default_store().root, self.store.root)
+        finally:
+            if saved is None:
+                os.environ.pop('METAPYTHON_STORE', None)
+            else:
+                os.environ['METAPYTHON_STORE'] = saved
+
+class TestWatch(DependenciesFixture, MetaPythonTest):
+
+    def tearDown(self):
+        core.retain_contexts = False
+        core._contexts.clear()
+        DependenciesFixture.tearDown(self)
+
+    def testCheck(self):
+        mod = self.import_()
+        watcher = watch.Watcher()
+        self.assertEqual(watcher.check(), [])
+        self.write(self.source + 'y = 1\n')
+        self.assertEqual(watcher.check(), [mod])
+        self.assertEqual(mod.y, 1)
+        self.assertEqual(watcher.check(), [])
+        # Changing the macros reloads them first, then their users
+        self.write_macros(self.macros.replace('$value', '$value + 1'))
+        reloaded = watcher.check()
+        self.assertEqual([ m.__name__ for m in reloaded ],
+                         ['cachemacros', 'cached'])
+        self.assert_(sys.modules['cached'] is mod)
+        self.assertEqual(mod.x, 43)
+
+    def testIncremental(self):
+        watcher = watch.Watcher()
+        mod = self.import_()
+        watcher.check()
+        self.write(self.source + 'y = 1\n')
+        watcher.check()
+        self.assertEqual(core._contexts['cached'].memo.reused, 1)
+
+    def testStop(self):
+        watcher = watch.Watcher()
+        self.assert_(core.retain_contexts)
+        self.import_()
+        self.assert_('cached' in core._contexts)
+        watcher.stop()
+        self.assert_(not core.retain_contexts)
+        self.assertEqual(core._contexts, {})
+        # A watcher leaves the setting as it found it
+        core.retain_contexts = True
+        watch.Watcher().stop()
+        self.assert_(core.retain_contexts)
+
+    def testFailure(self):
+        from cStringIO import StringIO
+        mod = self.import_()
+        watcher = watch.Watcher(log=StringIO())
+        watcher.check()
+        self.write('x = = 1\n')
+        self.assertEqual(watcher.check(), [])
+        self.assertEqual(mod.x, 42)
+        self.assert_('Failed to reload cached' in watcher.log.getvalue())
+
+    def testThread(self):
+        mod = self.import_()
+        watcher = watch.start(0.01)
+        try:
+            time.sleep(0.05)
+            self.write(self.source + 'y = 2\n')
+            for i in range(500):
+                if getattr(mod, 'y', None) == 2:
+                    break
+                time.sleep(0.01)
+        finally:
+            watcher.stop()
+        self.assertEqual(mod.y, 2)
+
+class TestServer(DependenciesFixture, MetaPythonTest):
+
+    def setUp(self):
+        DependenciesFixture.setUp(self)
+        self.path = os.path.join(self.dir, 'server.sock')
+        self.server = server.ExpansionServer(self.path)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.environ = os.environ.get('METAPYTHON_SERVER')
+        os.environ['METAPYTHON_SERVER'] = self.path
+
+    def tearDown(self):
+        if self.environ is None:
+            del os.environ['METAPYTHON_SERVER']
+        else:
+            os.environ['METAPYTHON_SERVER'] = self.environ
+        self.server.shutdown()
+        self.thread.join()
+        core.retain_contexts = False
+        core._contexts.clear()
+        DependenciesFixture.tearDown(self)
+
+    def testFetch(self):
+        doc, text, code, deps, table = server.fetch(self.fn, 'cached')
+        self.assertEqual(deps, (self.macros_fn,))
+        ns = {}
+        exec code in ns
+        self.assertEqual(ns['x'], 42)
+        server.fetch(self.fn, 'cached')
+        self.assertEqual((self.server.misses, self.server.hits), (1, 1))
+        # Changing the source re-expands it
+        self.write(self.source + 'y = 1\n')
+        text = server.fetch(self.fn, 'cached')[1]
+        self.assert_('y = 1' in text)
+        self.assertEqual(self.server.misses, 2)
+
+    def testImport(self):
+        mod = self.import_()
+        self.assertEqual(mod.x, 42)
+        self.assertEqual(mod.__mpy_depends__, (self.macros_fn,))
+        self.assertEqual(self.server.misses, 1)
+        self.assertNotEqual(cache.load(self.fn), None)
+
+    def testFallback(self):
+        self.assertEqual(
+            server.fetch(self.fn, 'cached', self.path + '.missing'), None)
+        self.write('x = = 1\n')
+        self.assertEqual(server.fetch(self.fn, 'cached'), None)
+        # Without METAPYTHON_SERVER no server is used
+        del os.environ['METAPYTHON_SERVER']
+        self.assertEqual(server.socket_path(), None)
+        os.environ['METAPYTHON_SERVER'] = ''
+        self.write(self.source)
+        self.assertEqual(server.fetch(self.fn, 'cached'), None)
+        self.assertEqual(self.import_().x, 42)
+        self.assertEqual(self.server.misses, 1)
+
+    def testPrivate(self):
+        self.assertEqual(os.stat(self.path).st_mode & 077, 0)
+        # Only a socket owned by the current user is used, not a link to it
+        link = os.path.join(self.dir, 'link.sock')
+        os.symlink(self.path, link)
+        self.assertEqual(server.fetch(self.fn, 'cached', link), None)
+        self.assertEqual(self.server.misses, 0)
+        # The default socket's directory must be private
+        tempdir = tempfile.tempdir
+        tempfile.tempdir = self.dir
+        try:
+            self.assertEqual(os.path.dirname(server.default_path()),
+                             server.runtime_dir())
+            os.mkdir(server.runtime_dir(), 0755)
+            self.assertRaises(OSError, server.ExpansionServer)
+        finally:
+            tempfile.tempdir = tempdir
+
+class TestFinder(MetaPythonTest):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        core.MetaImporter.invalidate_caches()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        core.MetaImporter.invalidate_caches()
+
+    def touch(self, name):
+        open(os.path.join(self.dir, name), 'w').close()
+
+    def testFind(self):
+        self.touch('found.mpy')
+        self.touch('plain.py')
+        loader = core.MetaImporter.find_module('pkg.found', [self.dir])
+        self.assertEqual(loader.path, os.path.join(self.dir, 'found.mpy'))
+        self.assertEqual(
+            core.MetaImporter.find_module('plain', [self.dir]), None)
+
+    def testNegativeCache(self):
+        self.assertEqual(
+            core.MetaImporter.find_module('later', [self.dir]), None)
+        self.assert_(('later', (self.dir,)) in core.MetaImporter._misses)
+        # Creating the module changes the directory's mtime, which
+        # invalidates the failed lookup
+        self.touch('later.mpy')
+        os.utime(self.dir, (0, 0))
+        self.assertNotEqual(
+            core.MetaImporter.find_module('later', [self.dir]), None)
+
+    def testLoadDirectly(self):
+        fp = open(os.path.join(self.dir, 'direct.mpy'), 'w')
+        fp.write('x = 42\n')
+        fp.close()
+        sys.path.insert(0, self.dir)
+        try:
+            loader = core.MetaImporter().find_module('direct')
+            self.assert_(not imp.lock_held())
+            mod = loader.load_module('direct')
+        finally:
+            sys.path.remove(self.dir)
+            sys.modules.pop('direct', None)
+        self.assertEqual(mod.x, 42)
+        self.assert_(not imp.lock_held())
+
 if __name__ == '__main__':
     unittest.main()